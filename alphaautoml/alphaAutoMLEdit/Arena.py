@@ -66,14 +66,15 @@ class Arena():
             logger.info("Turn %s", it)
             logger.info("Player %s", curPlayer)
             self.display(board)
-        game_ended = self.game.getGameEnded(board, 1)
+        # Wait for the score of the final pipeline, if it is still being computed
+        game_ended = self.game.getGameEnded(board, 1, wait=True)
         if verbose:
             if game_ended == 1:
                 self.f.write('Working Pipeline\n')
             elif game_ended == 2:
                 self.f.write('Non-Working Pipeline\n')
         #return game_ended==1 and curPlayer == 1
-        return self.game.getGameEnded(board, 1)
+        return game_ended
 
     def playGames(self, num, verbose=False):
         """
@@ -24,6 +24,8 @@ class MCTS():
         self.Es = {}        # stores game.getGameEnded ended for board s
         self.Vals = {}
         self.Vs = {}       # stores game.getValidMoves for board s
+        self.virtual_Nsa = {}  # stores virtual visits of s,a by pending simulations
+        self.virtual_Ns = {}   # stores virtual visits of board s by pending simulations
         self.count = 0
 
     def getActionProb(self, canonicalBoard, temp=1):
@@ -35,9 +37,18 @@ class MCTS():
             probs: a policy vector where the probability of the ith action is
                    proportional to Nsa[(s,a)]**(1./temp)
         """
-        for i in range(1, self.args.get('numMCTSSims')):
-            logger.info('MCTS SIMULATION %s', i)
-            self.search(canonicalBoard)
+        batch_size = self.args.get('mctsBatchSize', 1)
+        if batch_size > 1:
+            i = 1
+            while i < self.args.get('numMCTSSims'):
+                size = min(batch_size, self.args.get('numMCTSSims') - i)
+                logger.info('MCTS SIMULATIONS %s-%s', i, i + size - 1)
+                self.search_batch(canonicalBoard, size)
+                i += size
+        else:
+            for i in range(1, self.args.get('numMCTSSims')):
+                logger.info('MCTS SIMULATION %s', i)
+                self.search(canonicalBoard)
 
         s = self.game.stringRepresentation(canonicalBoard)
         counts = [0] * self.game.getActionSize()
@@ -97,15 +108,9 @@ class MCTS():
 
         if s not in self.Ps:
             # leaf node
-            self.Ps[s], v = self.nnet.predict(self.game.getTrainBoard(canonicalBoard))
+            pi, v = self.nnet.predict(self.game.getTrainBoard(canonicalBoard))
             logger.info('Prediction %s', v)
-            #logger.info('CALLING VALID MOVES')
-            valids = self.game.getValidMoves(canonicalBoard, 1)
-            self.Ps[s] = self.Ps[s]*valids      # masking invalid moves
-            self.Ps[s] /= np.sum(self.Ps[s])    # renormalize
-            self.Vals[s] = v
-            self.Vs[s] = valids
-            self.Ns[s] = 0
+            self.expand(s, canonicalBoard, pi, v)
             return v
 
         valids = self.Vs[s]
@@ -113,19 +118,54 @@ class MCTS():
         #Check if valid moves are available. Quit if no more legal moves are possible
         if not any(valids):
             return 0
-        
+
+        a = self.best_action(s)
+        next_s, next_player = self.game.getNextState(canonicalBoard, player, a)
+        next_s = self.game.getCanonicalForm(next_s, next_player)
+
+        #logger.info('NEXT STATE SEARCH RECURSION')
+        v = self.search(next_s, next_player)
+
+        self.update(s, a, v)
+
+        return v
+
+    def expand(self, s, canonicalBoard, pi, v):
+        """
+        Stores the policy and value predicted by the neural network for a leaf.
+        """
+        #logger.info('CALLING VALID MOVES')
+        valids = self.game.getValidMoves(canonicalBoard, 1)
+        self.Ps[s] = pi*valids      # masking invalid moves
+        self.Ps[s] /= np.sum(self.Ps[s])    # renormalize
+        self.Vals[s] = v
+        self.Vs[s] = valids
+        self.Ns[s] = 0
+
+    def best_action(self, s):
+        """
+        Picks the action with the highest upper confidence bound. Pending
+        simulations of search_batch count as visits with a value of 0 (virtual
+        loss), so that simulations of the same batch spread over the tree.
+        """
+        valids = self.Vs[s]
+        cpuct = self.args.get('cpuct')
+        sqrt_ns = math.sqrt(self.Ns[s] + self.virtual_Ns.get(s, 0))
         cur_best = -float('inf')
         best_act = -1
 
-        # pick the action with the highest upper confidence bound
         actions = []
         for a in range(self.game.getActionSize()):
             if valids[a]:
                 #logger.info('MCTS ACTION %s', a)
+                virtual = self.virtual_Nsa.get((s,a), 0)
                 if (s,a) in self.Qsa:
-                    u = self.Qsa[(s,a)] + self.args.get('cpuct')*self.Ps[s][a]*math.sqrt(self.Ns[s])/(1+self.Nsa[(s,a)])
+                    n = self.Nsa[(s,a)] + virtual
+                    u = self.Qsa[(s,a)]*self.Nsa[(s,a)]/n + cpuct*self.Ps[s][a]*sqrt_ns/(1+n)
+                elif virtual:
+                    u = cpuct*self.Ps[s][a]*sqrt_ns/(1+virtual)
                 else:
-                    u = self.args.get('cpuct')*self.Ps[s][a]*math.sqrt(self.Ns[s])     # Q = 0 ?
+                    u = cpuct*self.Ps[s][a]*sqrt_ns     # Q = 0 ?
 
                 if u > cur_best:
                     cur_best = u
@@ -139,12 +179,9 @@ class MCTS():
             a = best_act
         #logger.info('BEST ACTIONS %s', actions)
         #logger.info('MCTS BEST ACTION %s', best_act)
-        next_s, next_player = self.game.getNextState(canonicalBoard, player, a)
-        next_s = self.game.getCanonicalForm(next_s, next_player)
-
-        #logger.info('NEXT STATE SEARCH RECURSION')
-        v = self.search(next_s, next_player)
+        return a
 
+    def update(self, s, a, v):
         if (s,a) in self.Qsa:
             self.Qsa[(s,a)] = (self.Nsa[(s,a)]*self.Qsa[(s,a)] + v)/(self.Nsa[(s,a)]+1)
             self.Nsa[(s,a)] += 1
@@ -155,4 +192,75 @@ class MCTS():
 
         self.Ns[s] += 1
 
-        return v
+    def search_batch(self, canonicalBoard, batch_size):
+        """
+        This function performs batch_size iterations of MCTS, like search(),
+        but the leaves they reach are evaluated with a single call to the
+        neural network. While a simulation waits for its leaf to be evaluated,
+        its path gets a virtual loss, so the next simulations pick other paths.
+        """
+        virtual_loss = self.args.get('virtualLoss', 1)
+        leaves = {}     # leaf s -> (board, paths reaching it)
+        finished = []   # (path, v)
+        for _ in range(batch_size):
+            path, s, board, v = self.select(canonicalBoard)
+            for (ps, a) in path:
+                self.virtual_Nsa[(ps,a)] = self.virtual_Nsa.get((ps,a), 0) + virtual_loss
+                self.virtual_Ns[ps] = self.virtual_Ns.get(ps, 0) + virtual_loss
+            if v is not None:
+                finished.append((path, v))
+            elif s in leaves:
+                leaves[s][1].append(path)
+            else:
+                leaves[s] = (board, [path])
+
+        if leaves:
+            states = list(leaves)
+            pis, vs = self.nnet.predict_batch([self.game.getTrainBoard(leaves[s][0]) for s in states])
+            for s, pi, v in zip(states, pis, vs):
+                logger.info('Prediction %s', v)
+                self.expand(s, leaves[s][0], pi, v)
+                finished.extend((path, v) for path in leaves[s][1])
+
+        # Remove the virtual loss and back up the values
+        for path, v in finished:
+            for (s, a) in reversed(path):
+                self.virtual_Nsa[(s,a)] -= virtual_loss
+                self.virtual_Ns[s] -= virtual_loss
+                self.update(s, a, v)
+
+    def select(self, canonicalBoard, player=1):
+        """
+        Walks down the tree from canonicalBoard, like search(), until it
+        reaches a leaf or a terminal node.
+
+        Returns:
+            path: the (s,a) pairs that were followed
+            s, board: the node that was reached
+            v: its value, or None if it is a leaf that needs to be evaluated
+        """
+        path = []
+        while True:
+            self.game.display(canonicalBoard)
+
+            s = self.game.stringRepresentation(canonicalBoard)
+            game_ended = self.game.getGameEnded(canonicalBoard, player)
+
+            if s not in self.Es:
+                self.Es[s] = game_ended
+            if self.Es[s] != 0:
+                # terminal node
+                return path, s, canonicalBoard, self.Vals[s] if not self.Vals.get(s) is None else 0
+
+            if s not in self.Ps:
+                # leaf node
+                return path, s, canonicalBoard, None
+
+            #Check if valid moves are available. Quit if no more legal moves are possible
+            if not any(self.Vs[s]):
+                return path, s, canonicalBoard, 0
+
+            a = self.best_action(s)
+            path.append((s, a))
+            next_s, player = self.game.getNextState(canonicalBoard, player, a)
+            canonicalBoard = self.game.getCanonicalForm(next_s, player)
@@ -36,6 +36,18 @@ class NeuralNet():
         """
         pass
 
+    def predict_batch(self, boards):
+        """
+        Input:
+            boards: a list of boards in their canonical form.
+
+        Returns:
+            pis: the policy vectors of the boards, as predict() returns them
+            vs: the values of the boards
+        """
+        predictions = [self.predict(board) for board in boards]
+        return [pi for pi, _ in predictions], [v for _, v in predictions]
+
     def save_checkpoint(self, folder, filename):
         """
         Saves the current neural network (with its parameters) in
@@ -132,6 +132,19 @@ class NNetWrapper(NeuralNet):
         #logger.info('PREDICTION TIME TAKEN : {0:03f}'.format(time.time()-start))
         return torch.exp(pi).data.cpu().numpy()[0], v.data.cpu().numpy()[0][0]
 
+    def predict_batch(self, boards):
+        """
+        boards: list of np arrays with boards, evaluated in one forward pass
+        """
+        boards = torch.from_numpy(np.array([board[0:self.board_size] for board in boards], dtype='f'))
+        if args.get('cuda'): boards = boards.contiguous().cuda()
+
+        self.nnet.eval()
+        with torch.no_grad():
+            pis, vs = self.nnet.forward_batch(boards)
+
+        return torch.exp(pis).data.cpu().numpy(), vs.data.cpu().numpy()[:, 0]
+
     def loss_pi(self, targets, outputs):
         return -torch.sum(targets*outputs)/targets.size()[0]
 
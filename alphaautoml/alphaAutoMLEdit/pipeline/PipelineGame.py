@@ -4,7 +4,7 @@ import os
 import pickle
 import math
 import logging
-from copy import deepcopy
+from copy import copy
 sys.path.append('..')
 from ..Game import Game
 from .PipelineLogic import Board
@@ -16,11 +16,14 @@ logger = logging.getLogger(__name__)
 
 class PipelineGame(Game):
     # FIXEME: Maybe the input parameters can be in json
-    def __init__(self, input={}, eval_pipeline=None):
+    def __init__(self, input={}, eval_pipeline=None, evaluator=None):
         self.steps = 0
         self.args = input['ARGS']
         self.evaluations = {}
         self.eval_times = {}
+        # If an evaluator is given, pipelines are scored asynchronously
+        self.evaluator = evaluator
+        self.pending_evaluations = {}  # pipeline id -> pipeline
 
         self.grammar = input['GRAMMAR']
         self.pipeline_size = input['PIPELINE_SIZE']
@@ -50,54 +53,53 @@ class PipelineGame(Game):
             
         self.m = len(self.dataset_metafeatures)+2
         self.p = input['PIPELINE_SIZE']
-        self.action_size = 0
+        # Template board holding the grammar tables, boards themselves are tuples
+        self.board = Board(self.m, self.grammar, self.pipeline_size, self.metric)
+        self.action_size = len(self.board.valid_moves)
 
                 
+    def _get_board(self, board):
+        # Shallow copy of the template board, sharing its grammar tables
+        b = copy(self.board)
+        b.set_metafeatures(board)
+        b.set_pipeline(board)
+        return b
+
     def getInitBoard(self):
-        # return initial board (numpy board)
-        b = Board(self.m, self.grammar, self.pipeline_size, self.metric)
-        b.set_metafeatures(self.dataset_metafeatures+[self.data_types[self.data_type]]+[self.problem_types[self.problem]])
-        self.action_size = len(b.valid_moves)
-        return b.pieces_m + b.pieces_p
+        # return initial board (tuple)
+        metafeatures = self.dataset_metafeatures+[self.data_types[self.data_type]]+[self.problem_types[self.problem]]
+        return tuple(metafeatures) + self.board.pieces_p
 
     def getBoardSize(self):
         # (a,b) tuple
-        b = Board(self.m, self.grammar, self.pipeline_size, self.metric)
-        return b.get_board_size()
+        return self.board.get_board_size()
 
     def getActionSize(self):
         # return number of actions
-        board = Board(self.m, self.grammar, self.pipeline_size, self.metric)
-        return len(board.valid_moves)
+        return self.action_size
 
     def getNextState(self, board, player, action):
         # if player takes action on board, return next (board,player)
         # action must be a valid move
-        b = Board(self.m, self.grammar, self.pipeline_size, self.metric)
-        b.set_metafeatures(board)
-        b.set_pipeline(board)
-        #logger.info('PREV STATE %s', b.pieces_p)
-        b.execute_move(action, player)
-        #logger.info('NEXT STATE %s', b.pieces_p)
-        return (b.pieces_m+b.pieces_p, -player)
+        pipeline = self.board.next_pipeline(board[self.m:], action)
+        return (tuple(board[:self.m]) + pipeline, -player)
 
     def getValidMoves(self, board, player):
         # return a fixed size binary vector
-        b = Board(self.m, self.grammar, self.pipeline_size, self.metric)
-        b.set_metafeatures(board)
-        b.set_pipeline(board)
+        b = self._get_board(board)
         #logger.info('CURR STATE %s', b.pieces_p)
         legalMoves =  b.get_legal_moves()
         #logger.info('VALID MOVES %s', [b.valid_moves[i] for i in range(0, len(legalMoves)) if legalMoves[i] == 1])
         return np.array(legalMoves)
 
-    def getEvaluation(self, board):
+    def getEvaluation(self, board, wait=False):
 
-        b = Board(self.m, self.grammar, self.pipeline_size, self.metric)
-        pipeline_enums = b.get_pipeline(board)
+        pipeline_enums = self.board.get_pipeline(board)
         if not any(pipeline_enums):
             return 0.0
-        pipeline = b.get_pipeline_primitives(pipeline_enums)
+        pipeline = self.board.get_pipeline_primitives(pipeline_enums)
+        if self.evaluator is not None:
+            return self.getAsyncEvaluation(pipeline, wait)
         eval_val = self.evaluations.get(",".join(pipeline))
 
         if eval_val is None:
@@ -113,14 +115,51 @@ class PipelineGame(Game):
             self.eval_times[",".join(pipeline)] = time.time()
 
         return eval_val
-    
-    def getGameEnded(self, board, player, eval_val=None):
+
+    def getAsyncEvaluation(self, pipeline, wait=False):
+        """Returns the score of the pipeline, sending it to the evaluator if needed.
+
+        Returns None while the pipeline is being scored, unless wait is True.
+        """
+        key = ",".join(pipeline)
+        self.receiveEvaluations()
+        if key not in self.evaluations and key not in self.pending_evaluations.values():
+            self.steps = self.steps + 1
+            pipeline_id = None
+            try:
+                pipeline_id = self.evaluator.submit(pipeline, 'AlphaZero')
+            except:
+                logger.warning('Error in Pipeline Execution %s', key)
+                traceback.print_exc()
+            if pipeline_id is None:
+                self.evaluations[key] = float('inf')
+                self.eval_times[key] = time.time()
+            else:
+                self.pending_evaluations[pipeline_id] = key
+        while wait and key in self.pending_evaluations.values():
+            if not self.receiveEvaluations(block=True):
+                break
+
+        return self.evaluations.get(key)
+
+    def receiveEvaluations(self, block=False):
+        # Store the scores that came back from the evaluator
+        results = self.evaluator.receive(block)
+        for pipeline_id, eval_val in results:
+            key = self.pending_evaluations.pop(pipeline_id, None)
+            if key is None:  # Not sent by the game (templates)
+                continue
+            if eval_val is None:
+                eval_val = float('inf')
+            self.evaluations[key] = eval_val
+            self.eval_times[key] = time.time()
+        return results
+
+    def getGameEnded(self, board, player, eval_val=None, wait=False):
         # return 0 if not ended, 1 if x won, -1 if x lost
         # player = 1
 
-        b = Board(self.m, self.grammar, self.pipeline_size, self.metric)
-        b.set_metafeatures(board)
-        b.set_pipeline(board)
+        b = self._get_board(board)
         if not b.is_terminal_pipeline():
             return 0
         if len(self.evaluations) > 0:
@@ -132,7 +171,10 @@ class PipelineGame(Game):
                    win_threshold = sorted_evals[-1]
                 b.win_threshold = win_threshold
 
-        eval_val = self.getEvaluation(board)
+        eval_val = self.getEvaluation(board, wait)
+        if eval_val is None:
+            # Still being scored, it is a finished game that wasn't won (yet)
+            return 2
 
         if b.findWin(player, eval_val):
             logger.info('findwin %s',player)
@@ -147,27 +189,25 @@ class PipelineGame(Game):
 
     def getCanonicalForm(self, board, player):
         # return state if player==1, else return -state if player==-1
-        return deepcopy(board)
+        # Boards are immutable tuples, no need to copy them
+        return board
 
     def stringRepresentation(self, board):
-        # 3x3 numpy array (canonical board)
-        return np.asarray(board).tostring()
+        # The metafeatures are the same for the whole game, the pipeline tuple identifies the board
+        return tuple(board[self.m:])
 
     def getTrainBoard(self, board):
-        b = Board(self.m, self.grammar, self.pipeline_size, self.metric)
-        b.set_metafeatures(board)
-        b.set_pipeline(board)
-        return b.get_train_board()
+        return self._get_board(board).get_train_board()
 
     def getTrainExamples(self, board, pi):
         assert(len(pi) == self.getActionSize())  # 1 for pass
-        b = Board(self.m, self.grammar, self.pipeline_size, self.metric)
-        b.set_metafeatures(board)
-        b.set_pipeline(board)
+        b = self._get_board(board)
         if not b.is_terminal_pipeline():
             eval_val = float('inf')
         else:
             eval_val = self.getEvaluation(board)
+            if eval_val is None:
+                eval_val = float('inf')
         train_board = b.get_train_board()
         if 'error' in self.metric.lower():
             return (train_board, pi, eval_val if eval_val!= float('inf') and eval_val <= math.pow(10,15) else math.pow(10,15))
@@ -175,8 +215,7 @@ class PipelineGame(Game):
             return (train_board, pi, eval_val if eval_val != float('inf') else 0)
 
     def get_pipeline_primitives(self, board):
-        b = Board(self.m, self.grammar, self.pipeline_size, self.metric)
-        return b.get_pipeline_primitives(b.get_pipeline(board))
+        return self.board.get_pipeline_primitives(self.board.get_pipeline(board))
         
     def display(self, b):
         board = self.get_pipeline_primitives(b)
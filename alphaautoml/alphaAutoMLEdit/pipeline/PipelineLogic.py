@@ -13,6 +13,8 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+MAX_LEGAL_MOVES_CACHE = 100000
+
 
 class Board():
 
@@ -27,19 +29,47 @@ class Board():
         self.valid_moves = [i for i, j in sorted(grammar['RULES'].items(), key=lambda x: x[1])]
         self.rules = grammar['RULES']
         self.rules_lookup = grammar['RULES_LOOKUP']
+        self._compile_grammar()
+        self.legal_moves_cache = {}  # Shared by the copies of this board
         #logger.info('NUMBER of VALID MOVES %s', len(self.valid_moves))
         
         # Create the empty board array.
-        self.pieces_m = [0] * self.m
+        self.pieces_m = (0,) * self.m
         start_pipeline = [self.terminals[p] if p in self.terminals else self.non_terminals[p] for p in
                     [self.start]]
 
-        self.pieces_p = [0] * (self.p - len(start_pipeline)) + start_pipeline
+        self.pieces_p = (0,) * (self.p - len(start_pipeline)) + tuple(start_pipeline)
 
         if 'error' in metric.lower():  # TODO: change it
             win_threshold = -1 * win_threshold
         self.win_threshold = win_threshold
 
+    def _compile_grammar(self):
+        """Turns the grammar into integer tables, so rule strings are only parsed once.
+        """
+        # symbol id -> name
+        self.symbol_names = {i: name for name, i in self.non_terminals.items()}
+        self.symbol_names.update((i, name) for name, i in self.terminals.items())
+        self.non_terminal_ids = frozenset(self.non_terminals.values())
+        self.num_symbols = max(self.symbol_names) + 1
+
+        # action -> (non-terminal id, ids it is replaced with)
+        self.rule_lhs = []
+        self.rule_rhs = []
+        for s in self.valid_moves:
+            self.rule_lhs.append(self.non_terminals[s[:s.index('-')].strip()])
+            r = [self.non_terminals[p] if p in self.non_terminals else self.terminals[p]
+                 for p in s[s.index('-')+2:].strip().split(' ')]
+            self.rule_rhs.append(tuple(x for x in r if x != 0))
+        self.rule_lhs_array = np.array(self.rule_lhs, dtype=int)
+        self.rule_rhs_length = np.array([len(r) for r in self.rule_rhs], dtype=int)
+        self.rule_rhs_unique = np.array([len(set(r)) == len(r) for r in self.rule_rhs], dtype=bool)
+
+        # non-terminal id -> mask of the actions expanding it
+        self.rule_masks = {}
+        for nt in self.non_terminal_ids:
+            self.rule_masks[nt] = self.rule_lhs_array == nt
+
     # add [][] indexer syntax to the Board
     def __getitem__(self, index):
         return self.pieces_p[index]
@@ -51,16 +81,13 @@ class Board():
         return board[0:self.m]
 
     def set_metafeatures(self, board):
-        self.pieces_m = board[0:self.m]
+        self.pieces_m = tuple(board[0:self.m])
 
     def set_pipeline(self, board):
-        self.pieces_p = board[self.m:]
+        self.pieces_p = tuple(board[self.m:])
 
     def is_terminal_pipeline(self):
-        for p in self.pieces_p:
-            if p != 0 and p in list(self.non_terminals.values()):  # Empty symbol ID = 0
-                return False
-        return True
+        return not any(p in self.non_terminal_ids for p in self.pieces_p)  # Empty symbol ID = 0
     
     def findWin(self, player, eval_val=None):
         """Find win of the given color in row, column, or diagonal
@@ -75,28 +102,50 @@ class Board():
     def get_legal_moves(self):
         """Returns all the legal moves.
         """
+        pipeline = tuple(p for p in self.pieces_p if p != 0)
+        valid_moves = self.legal_moves_cache.get(pipeline)
+        if valid_moves is None:
+            valid_moves = self._compute_legal_moves(pipeline)
+            if len(self.legal_moves_cache) >= MAX_LEGAL_MOVES_CACHE:
+                self.legal_moves_cache.clear()
+            self.legal_moves_cache[pipeline] = valid_moves
 
-        valid_moves = np.asarray([0]*len(self.valid_moves))
-        pipeline = [p for p in self.pieces_p if p != 0]
+        return valid_moves.tolist()
 
-        for p in pipeline:
-            if p in list(self.non_terminals.values()):
-                #logger.info('GET LEGAL MOVES %s', p)
-                rules = [self.rules[key]-1 for key in self.rules_lookup[list(self.non_terminals.keys())[p-1]] if len(self.next_state(self.rules[key]-1)) <= self.p and len(set(self.next_state(self.rules[key]-1))) == len(self.next_state(self.rules[key]-1))]
-                np.put(valid_moves, rules, [1]*len(rules))
+    def _compute_legal_moves(self, pipeline):
+        counts = np.bincount(np.array(pipeline, dtype=int), minlength=self.num_symbols)
+
+        # Rules expanding one of the non-terminals of the pipeline
+        valid = np.zeros(len(self.valid_moves), dtype=bool)
+        for p in set(pipeline):
+            if p in self.non_terminal_ids:
+                valid |= self.rule_masks[p]
+
+        # Every occurrence of the non-terminal is replaced, check the new length
+        lhs_counts = counts[self.rule_lhs_array]
+        valid &= len(pipeline) + lhs_counts * (self.rule_rhs_length - 1) <= self.p
+
+        # The new pipeline can't have the same symbol twice
+        valid &= self.rule_rhs_unique
+        valid &= (lhs_counts == 1) | (self.rule_rhs_length == 0)
+        duplicated = set(np.flatnonzero(counts > 1))
+        for action in np.flatnonzero(valid):
+            lhs = self.rule_lhs[action]
+            if duplicated - {lhs} or any(counts[r] and r != lhs for r in self.rule_rhs[action]):
+                valid[action] = False
+
+        return valid.astype(int)
 
-        return valid_moves.tolist()
-        
     def has_legal_moves(self):
-        return len(np.where(np.asarray(self.get_legal_moves()) == 1)[0]) > 0
+        return any(self.get_legal_moves())
 
-    def next_state(self, action):
-        s = self.valid_moves[action]
-        nt = self.non_terminals[s[:s.index('-')].strip()]
-        r = [self.non_terminals[p] if p in self.non_terminals.keys() else self.terminals[p] for p in s[s.index('-')+2:].strip().split(' ')]
-        r = [x for x in r if x != 0]
+    def next_state(self, action, pipeline=None):
+        if pipeline is None:
+            pipeline = self.pieces_p
+        nt = self.rule_lhs[action]
+        r = self.rule_rhs[action]
         s = []
-        for p in self.pieces_p:
+        for p in pipeline:
             if p == 0:
                 continue
             
@@ -107,9 +156,15 @@ class Board():
 
         return s
 
+    def next_pipeline(self, pipeline, action):
+        """Returns the pipeline (padded tuple) obtained by applying a move.
+        """
+        s = self.next_state(action, pipeline)
+        return (0,) * (self.p - len(s)) + tuple(s)
+
     def get_pipeline_primitives(self, pipeline):
         #logger.info('PIPELINE PRIMITIVES FOR %s', pipeline)
-        return [list(self.terminals.keys())[list(self.terminals.values()).index(i)] if i in list(self.terminals.values()) else list(self.non_terminals.keys())[list(self.non_terminals.values()).index(i)] for i in pipeline if not i == 0]
+        return [self.symbol_names[i] for i in pipeline if not i == 0]
 
     def get_train_board(self):
         logger.info('TRAIN BOARD: %s', '|'.join(self.get_pipeline_primitives(self.pieces_p)))
@@ -120,7 +175,7 @@ class Board():
                  pipeline[p] = 1
             #pipeline[p-1] = 1
 
-        return self.pieces_m + pipeline
+        return list(self.pieces_m) + pipeline
 
     def get_board_size(self):
         return self.m+(len(self.terminals)+len(self.non_terminals))
@@ -130,10 +185,6 @@ class Board():
         color gives the color of the piece to play (1=x,-1=o)
         """
         logger.info('MOVE ACTION: %s', self.valid_moves[action])
-        s = self.next_state(action)
-        
-        s = [0] * (self.p - len(s)) + s
-
-        self.pieces_p = s
+        self.pieces_p = self.next_pipeline(self.pieces_p, action)
 
 
@@ -26,6 +26,16 @@ class PipelineNNet(nn.Module):
         s = s.view(-1, 1, self.board_size)
         lstm_out, hidden = self.lstm(s)
         s = lstm_out[:,-1]
+        return self._heads(s)
+
+    def forward_batch(self, s):
+        # Each board is a sequence of length 1, so boards don't affect each other like in forward()
+        s = s.view(1, -1, self.board_size)
+        lstm_out, hidden = self.lstm(s)
+        s = lstm_out[-1]
+        return self._heads(s)
+
+    def _heads(self, s):
         pi = self.probFC(s)                                                                         # batch_size x 512
         v = self.valueFC(s)                                                                          # batch_size x 512
                 
@@ -1,10 +1,9 @@
 import logging
 import os
 import json
-import pickle
 import itertools
 from d3m_ta2_nyu.workflow import database
-from d3m import index
+from d3m_ta2_nyu.primitive_loader import get_primitive_metadata, get_type_name
 from d3m.container import Dataset, DataFrame, ndarray, List
 from d3m_ta2_nyu.utils import is_collection, get_collection_type
 
@@ -39,6 +38,14 @@ CONTAINER_CAST = {
 }
 
 
+CONTAINER_TYPES = {get_type_name(container_type): container_type for container_type in CONTAINER_CAST}
+
+
+def get_container_type(primitive_name, argument):
+    type_name = get_primitive_metadata(primitive_name)['class_type_arguments'][argument]
+    return CONTAINER_TYPES.get(type_name, type_name)
+
+
 def make_pipeline_module(db, pipeline, name, package='d3m', version='2019.10.10'):
     pipeline_module = database.PipelineModule(pipeline=pipeline, package=package, version=version, name=name)
     db.add(pipeline_module)
@@ -49,11 +56,11 @@ def make_data_module(db, pipeline, targets, features):
     input_data = make_pipeline_module(db, pipeline, 'dataset', 'data', '0.0')
     db.add(database.PipelineParameter(
         pipeline=pipeline, module=input_data,
-        name='targets', value=pickle.dumps(targets),
+        name='targets', value=database.encode_value(targets),
     ))
     db.add(database.PipelineParameter(
         pipeline=pipeline, module=input_data,
-        name='features', value=pickle.dumps(features),
+        name='features', value=database.encode_value(features),
     ))
     return input_data
 
@@ -61,17 +68,13 @@ def make_data_module(db, pipeline, targets, features):
 def connect(db, pipeline, from_module, to_module, from_output='produce', to_input='inputs'):
     if 'index' not in from_output:
         if not from_module.name.startswith('dataset'):
-            from_module_primitive = index.get_primitive(from_module.name)
-            from_module_output = from_module_primitive.metadata.query()['primitive_code']['class_type_arguments'][
-                'Outputs']
+            from_module_output = get_container_type(from_module.name, 'Outputs')
         else:
             from_module_output = Dataset
 
-        to_module_primitive = index.get_primitive(to_module.name)
-        to_module_input = to_module_primitive.metadata.query()['primitive_code']['class_type_arguments'][
-            'Inputs']
+        to_module_input = get_container_type(to_module.name, 'Inputs')
 
-        arguments = to_module_primitive.metadata.query()['primitive_code']['arguments']
+        arguments = get_primitive_metadata(to_module.name)['arguments']
 
         if to_input not in arguments:
              raise NameError('Argument %s not found in %s' % (to_input, to_module.name))
@@ -101,7 +104,7 @@ def connect(db, pipeline, from_module, to_module, from_output='produce', to_inpu
 def set_hyperparams(db, pipeline, module, **hyperparams):
     db.add(database.PipelineParameter(
         pipeline=pipeline, module=module,
-        name='hyperparams', value=pickle.dumps(hyperparams),
+        name='hyperparams', value=database.encode_value(hyperparams),
     ))
 
 
@@ -347,8 +350,7 @@ class BaseBuilder:
                 connect(db, pipeline, prev_step, current_step)
                 prev_step = current_step
 
-                to_module_primitive = index.get_primitive(primitive)
-                if 'outputs' in to_module_primitive.metadata.query()['primitive_code']['arguments']:
+                if 'outputs' in get_primitive_metadata(primitive)['arguments']:
                     connect(db, pipeline, step4, current_step, to_input='outputs')
 
             if 'ROC_AUC' in metrics[0]['metric'].name:
@@ -937,8 +939,7 @@ class AudioBuilder(BaseBuilder):
                 connect(db, pipeline, prev_step, step)
                 prev_step = step
 
-                to_module_primitive = index.get_primitive(preprocessor)
-                if 'outputs' in to_module_primitive.metadata.query()['primitive_code']['arguments']:
+                if 'outputs' in get_primitive_metadata(preprocessor)['arguments']:
                     connect(db, pipeline, step2, step, to_input='outputs')
 
             step5 = make_pipeline_module(db, pipeline, estimator)
@@ -1049,8 +1050,7 @@ class SemisupervisedClassificationBuilder(BaseBuilder):
                     connect(db, pipeline, otherprev_step, step)
                     otherprev_step = step
 
-                    to_module_primitive = index.get_primitive(preprocessor)
-                    if 'outputs' in to_module_primitive.metadata.query()['primitive_code']['arguments']:
+                    if 'outputs' in get_primitive_metadata(preprocessor)['arguments']:
                         connect(db, pipeline, step4, step, to_input='outputs')
 
                 step_blackbox = make_pipeline_module(db, pipeline, blackbox)
@@ -1068,8 +1068,7 @@ class SemisupervisedClassificationBuilder(BaseBuilder):
                                 blackbox={ "type": "PRIMITIVE", "data": count_steps }
                                 )
                 count_steps += 1
-                to_module_primitive = index.get_primitive(estimator)
-                if 'outputs' in to_module_primitive.metadata.query()['primitive_code']['arguments']:
+                if 'outputs' in get_primitive_metadata(estimator)['arguments']:
                     connect(db, pipeline, step4, step5, to_input='outputs')
 
                 if 'ROC_AUC' in metrics[0]['metric'].name:
@@ -1163,8 +1162,7 @@ class CollaborativeFilteringBuilder:
                 connect(db, pipeline, prev_step, current_step)
                 prev_step = current_step
 
-                to_module_primitive = index.get_primitive(primitive)
-                if 'outputs' in to_module_primitive.metadata.query()['primitive_code']['arguments']:
+                if 'outputs' in get_primitive_metadata(primitive)['arguments']:
                     connect(db, pipeline, step4, current_step, to_input='outputs')
 
             step5 = make_pipeline_module(db, pipeline, 'd3m.primitives.data_transformation.'
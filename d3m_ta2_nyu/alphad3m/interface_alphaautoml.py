@@ -63,6 +63,8 @@ config = {
         'numMCTSSims': 5,
         'arenaCompare': 40,
         'cpuct': 1,
+        'mctsBatchSize': 1,  # Leaves evaluated per network call, more than 1 enables batched search
+        'virtualLoss': 1,
 
         'checkpoint': join(os.environ.get('D3MOUTPUTDIR'), 'temp', 'nn_models'),
         'load_model': False,
@@ -107,13 +109,65 @@ def select_encoders(feature_types):
     return encoders
 
 
-def send(msg_queue, pipeline_id):
-    msg_queue.send(('eval', pipeline_id))
-    return msg_queue.recv()
+class PipelineEvaluator(object):
+    """Sends pipelines to the TA2 to be scored, without waiting for the scores.
+
+    Up to `max_pending` pipelines are scored at the same time. The TA2 sends
+    back ``('score', pipeline_id, score)`` messages as they finish, in any
+    order.
+    """
+    def __init__(self, msg_queue, max_pending=1, build_pipeline=None):
+        self.msg_queue = msg_queue
+        self.max_pending = max(1, max_pending)
+        self.build_pipeline = build_pipeline
+        self.pending = set()
+        self._results = []
+
+    def submit(self, primitive_names, origin):
+        """Build a pipeline and send it for scoring.
+
+        :return: The pipeline ID, or None if the pipeline is not valid.
+        """
+        pipeline_id = self.build_pipeline(primitive_names, origin)
+        if not pipeline_id:
+            return None
+        self.send(pipeline_id)
+        return pipeline_id
+
+    def send(self, pipeline_id):
+        while len(self.pending) >= self.max_pending:
+            self._read(block=True)
+        self.msg_queue.send(('eval', pipeline_id))
+        self.pending.add(pipeline_id)
+
+    def receive(self, block=False):
+        """Get the scores received since the last call, as ``(pipeline_id, score)`` pairs.
+
+        :param block: Wait for at least one score, if some are pending.
+        """
+        self._read(block=block and not self._results and bool(self.pending))
+        results, self._results = self._results, []
+        return results
+
+    def _read(self, block):
+        while block or self.msg_queue.poll():
+            block = False
+            msg, *args = self.msg_queue.recv()
+            if msg != 'score':
+                raise RuntimeError("Got unknown message from TA2: %r" % msg)
+            pipeline_id, score = args
+            self.pending.discard(pipeline_id)
+            self._results.append((pipeline_id, score))
+
+    def wait(self):
+        """Wait until all the pipelines sent are scored.
+        """
+        while self.pending:
+            self._read(block=True)
 
 
 def generate_by_templates(task_keywords, dataset, pipeline_template, targets, features,
-                          features_metadata, privileged_data, metrics, msg_queue, DBSession):
+                          features_metadata, privileged_data, metrics, evaluator, DBSession):
     task_keywords = set(task_keywords)
 
     if task_keywords & {TaskKeyword.GRAPH_MATCHING, TaskKeyword.LINK_PREDICTION, TaskKeyword.VERTEX_NOMINATION,
@@ -137,11 +191,12 @@ def generate_by_templates(task_keywords, dataset, pipeline_template, targets, fe
     for imputer, classifier in templates:
         pipeline_id = BaseBuilder.make_template(imputer, classifier, dataset, pipeline_template, targets, features,
                                                 features_metadata, privileged_data, metrics, DBSession=DBSession)
-        send(msg_queue, pipeline_id)
+        evaluator.send(pipeline_id)
 
 
 @database.with_sessionmaker
-def generate(task_keywords, dataset, pipeline_template, metrics, problem, targets, features, msg_queue, DBSession):
+def generate(task_keywords, dataset, pipeline_template, metrics, problem, targets, features, msg_queue, DBSession,
+             max_pending_evaluations=1):
     with open(dataset[7:]) as fin:
         dataset_doc = json.load(fin)
 
@@ -149,28 +204,28 @@ def generate(task_keywords, dataset, pipeline_template, metrics, problem, target
     csv_path = denormalize_dataset(dataset, targets, features, DBSession)
     features_metadata = profile_data(csv_path, target_names, dataset_doc)
     privileged_data = get_privileged_data(problem, task_keywords)
+    evaluator = PipelineEvaluator(msg_queue, max_pending_evaluations)
 
     if os.environ.get('SKIPTEMPLATES', 'not') == 'not':
         generate_by_templates(task_keywords, dataset, pipeline_template, targets,
-                              features, features_metadata, privileged_data, metrics, msg_queue, DBSession)
+                              features, features_metadata, privileged_data, metrics, evaluator, DBSession)
 
     if 'TA2_DEBUG_BE_FAST' in os.environ:
+        evaluator.wait()
         sys.exit(0)
 
     builder = None
     task_name = 'CLASSIFICATION' if TaskKeyword.CLASSIFICATION in task_keywords else 'REGRESSION'
 
-    def eval_pipeline(primitive_names, origin):
+    def build_pipeline(primitive_names, origin):
         pipeline_id = builder.make_d3mpipeline(primitive_names, origin, dataset, pipeline_template, targets,
                                                features, features_metadata, privileged_data, metrics, DBSession=DBSession)
         #execute(pipeline_id, dataset, problem, join(os.environ.get('D3MOUTPUTDIR'), 'output_dataframe.csv'), None,
         #        db_filename=join(os.environ.get('D3MOUTPUTDIR'), 'temp', 'db.sqlite3'))
-        # Evaluate the pipeline if syntax is correct:
-        if pipeline_id:
-            msg_queue.send(('eval', pipeline_id))
-            return msg_queue.recv()
-        else:
-            return None
+        # Evaluate the pipeline if syntax is correct
+        return pipeline_id
+
+    evaluator.build_pipeline = build_pipeline
 
     if TaskKeyword.CLUSTERING in task_keywords:
         task_name = 'CLUSTERING'
@@ -262,7 +317,7 @@ def generate(task_keywords, dataset, pipeline_template, metrics, problem, target
 
     game = PipelineGame(config_updated, my_eval)'''
     ############
-    game = PipelineGame(config_updated, eval_pipeline)
+    game = PipelineGame(config_updated, evaluator=evaluator)
     nnet = NNetWrapper(game)
 
     ########
@@ -282,5 +337,6 @@ def generate(task_keywords, dataset, pipeline_template, metrics, problem, target
 
     c = Coach(game, nnet, config['ARGS'])
     c.learn()
+    evaluator.wait()
 
     sys.exit(0)
@@ -0,0 +1,118 @@
+"""Cache of loaded D3M datasets, shared by the processes of a search.
+
+Parsing a big D3M dataset takes longer than fitting most pipelines on its
+sample, so the loaded `Dataset` is pickled once under the output folder and the
+following loads (in any process) read that snapshot instead. A snapshot is
+keyed by the URI and the modification times of the dataset files, so changing
+the dataset invalidates it.
+"""
+
+import copy
+import hashlib
+import json
+import logging
+import os
+import pickle
+from d3m.container import Dataset
+
+
+logger = logging.getLogger(__name__)
+
+_dataset_docs = {}
+
+
+def load_dataset_doc(dataset_path):
+    """Read a ``datasetDoc.json`` file, parsing it only once per process.
+    """
+    mtime = os.stat(dataset_path).st_mtime_ns
+    key = dataset_path, mtime
+    if key not in _dataset_docs:
+        with open(dataset_path) as fin:
+            _dataset_docs[key] = json.load(fin)
+    return copy.deepcopy(_dataset_docs[key])
+
+
+def _get_cache_folder():
+    if 'D3MOUTPUTDIR' not in os.environ:
+        return None
+    return os.path.join(os.environ['D3MOUTPUTDIR'], 'temp', 'dataset_cache')
+
+
+def _get_snapshot_name(dataset_uri):
+    if not (dataset_uri.startswith('file://') and dataset_uri.endswith('datasetDoc.json')):
+        return None
+    dataset_path = dataset_uri[7:]
+    dataset_folder = os.path.dirname(dataset_path)
+
+    # The dataset changed if its description or any of its resources did
+    files = [dataset_path]
+    for data_resource in load_dataset_doc(dataset_path)['dataResources']:
+        files.append(os.path.join(dataset_folder, data_resource['resPath']))
+    version = hashlib.sha1()
+    for filename in files:
+        stat = os.stat(filename)
+        version.update(('%s %d %d\n' % (filename, stat.st_mtime_ns, stat.st_size)).encode('utf-8'))
+
+    uri_hash = hashlib.sha1(dataset_uri.encode('utf-8')).hexdigest()
+    return '%s-%s' % (uri_hash, version.hexdigest())
+
+
+def get_dataset_version(dataset_uri):
+    """Get a key identifying the current version of a dataset.
+
+    :return: The key, or None if the dataset is not a D3M dataset on the local disk.
+    """
+    try:
+        return _get_snapshot_name(dataset_uri)
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def load_dataset(dataset_uri):
+    """Load a dataset, from its snapshot if there is one.
+
+    Datasets that are not D3M datasets on the local disk are loaded directly.
+    """
+    cache_folder = _get_cache_folder()
+    name = get_dataset_version(dataset_uri)
+    if cache_folder is None or name is None:
+        return Dataset.load(dataset_uri)
+
+    snapshot_path = os.path.join(cache_folder, name + '.pkl')
+    try:
+        with open(snapshot_path, 'rb') as fin:
+            dataset = pickle.load(fin)
+        logger.info('Loaded dataset %s from snapshot', dataset_uri)
+        return dataset
+    except FileNotFoundError:
+        pass
+    except Exception:
+        logger.warning('Invalid dataset snapshot %s, loading dataset', snapshot_path)
+
+    dataset = Dataset.load(dataset_uri)
+    try:
+        _write_snapshot(cache_folder, name, dataset)
+    except Exception:
+        logger.exception('Error writing snapshot of dataset %s', dataset_uri)
+    return dataset
+
+
+def _write_snapshot(cache_folder, name, dataset):
+    if not os.path.exists(cache_folder):
+        os.makedirs(cache_folder, exist_ok=True)
+
+    # Remove snapshots of older versions of this dataset
+    uri_hash = name.split('-', 1)[0]
+    for filename in os.listdir(cache_folder):
+        if filename.startswith(uri_hash + '-') and filename.endswith('.pkl') and filename != name + '.pkl':
+            try:
+                os.remove(os.path.join(cache_folder, filename))
+            except OSError:
+                pass
+
+    # Write under a temporary name so other processes never see partial files
+    snapshot_path = os.path.join(cache_folder, name + '.pkl')
+    temp_path = '%s.%d.tmp' % (snapshot_path, os.getpid())
+    with open(temp_path, 'wb') as fout:
+        pickle.dump(dataset, fout, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, snapshot_path)
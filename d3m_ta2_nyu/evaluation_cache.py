@@ -0,0 +1,75 @@
+"""Scores of pipelines, kept across searches.
+
+Searches on the same dataset generate many of the same pipelines. Once a
+pipeline is scored, its scores are stored in the database under a key made of
+the dataset version, the problem, the metrics, the scoring configuration and
+the steps of the pipeline (as written by `to_d3m_json()`, without its ID). The
+next search that generates the same pipeline gets its scores from there
+instead of scoring it again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from d3m_ta2_nyu.data_ingestion.dataset_cache import get_dataset_version
+from d3m_ta2_nyu.workflow import database
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_pipeline_signature(json_pipeline):
+    """Canonical signature of a pipeline, that doesn't depend on its ID.
+    """
+    data = json.dumps([json_pipeline['steps'], json_pipeline['outputs']], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def get_evaluation_key(json_pipeline, dataset_uri, sample_size, problem, metrics, scoring_config, report_rank):
+    """Get the key under which the scores of a pipeline are stored.
+
+    :return: The key, or None if the evaluation can't be cached.
+    """
+    if 'TA2_NO_EVALUATION_CACHE' in os.environ:
+        return None
+    dataset_version = get_dataset_version(dataset_uri)
+    if dataset_version is None:
+        return None
+    context = [
+        dataset_version,
+        sample_size,
+        problem['problem']['task_keywords'],
+        problem['inputs'],
+        metrics,
+        scoring_config,
+        report_rank,
+    ]
+    data = json.dumps(context, sort_keys=True, default=str)
+    context_hash = hashlib.sha256(data.encode('utf-8')).hexdigest()
+    return '%s-%s' % (context_hash, get_pipeline_signature(json_pipeline))
+
+
+def get_scores(db, key):
+    """Get the stored scores for a key.
+
+    :return: A tuple ``(scores, fidelity)`` where scores is a list of
+        `CrossValidationScore`, or None.
+    """
+    evaluation = db.query(database.Evaluation).get(key)
+    if evaluation is None:
+        return None
+    scores = [database.CrossValidationScore(fold=fold, metric=metric, value=value)
+              for fold, metric, value in json.loads(evaluation.scores)]
+    return scores, evaluation.fidelity
+
+
+def store_scores(db, key, scores, fidelity=None):
+    """Store the scores (list of `CrossValidationScore`) for a key.
+    """
+    db.merge(database.Evaluation(
+        key=key,
+        fidelity=fidelity,
+        scores=json.dumps([[None if score.fold is None else int(score.fold), score.metric, float(score.value)]
+                           for score in scores]),
+    ))
@@ -0,0 +1,205 @@
+"""Storage of fitted pipelines.
+
+A fitted pipeline is stored as a folder ``fitted_solution_<id>/``. The big
+NumPy arrays it holds (forests, vocabularies, weights) are taken out of the
+pickle and written as ``.npy`` files next to it, so they are written without
+copies and loaded by mapping the files in memory instead of reading them. A
+``manifest.json`` lists the files with their SHA-256 digest.
+
+Fitted pipelines written by older versions as a single
+``fitted_solution_<id>.pkl`` file can still be loaded. That file is also what
+`export_fitted_solution()` writes for clients that want a plain pickle, in a
+subprocess (`export()`) since it has to load the primitives.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import numpy as np
+
+
+# Arrays smaller than this stay in the pickle
+MIN_ARRAY_SIZE = 1024 ** 2
+MANIFEST_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+def _get_folder(storage_dir, pipeline_id):
+    return os.path.join(storage_dir, 'fitted_solution_%s' % pipeline_id)
+
+
+def _get_legacy_path(storage_dir, pipeline_id):
+    return os.path.join(storage_dir, 'fitted_solution_%s.pkl' % pipeline_id)
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fin:
+        chunk = fin.read(1024 ** 2)
+        while chunk:
+            digest.update(chunk)
+            chunk = fin.read(1024 ** 2)
+    return digest.hexdigest()
+
+
+class _ArrayPickler(pickle.Pickler):
+    """Pickler writing the big arrays to separate ``.npy`` files.
+    """
+    def __init__(self, file, folder):
+        pickle.Pickler.__init__(self, file, pickle.HIGHEST_PROTOCOL)
+        self.folder = folder
+        self.arrays = {}
+        self._ids = {}
+
+    def persistent_id(self, obj):
+        if type(obj) not in (np.ndarray, np.memmap) or obj.dtype.hasobject or obj.nbytes < MIN_ARRAY_SIZE:
+            return None
+        # Keep a reference to the array, so its id is not reused
+        if id(obj) in self._ids:
+            return self._ids[id(obj)][0]
+        name = 'array_%d.npy' % len(self._ids)
+        path = os.path.join(self.folder, name)
+        np.save(path, obj, allow_pickle=False)
+        self.arrays[name] = _file_digest(path)
+        self._ids[id(obj)] = name, obj
+        return name
+
+
+class _ArrayUnpickler(pickle.Unpickler):
+    def __init__(self, file, folder, mmap):
+        pickle.Unpickler.__init__(self, file)
+        self.folder = folder
+        self.mmap = mmap
+        self._arrays = {}
+
+    def persistent_load(self, name):
+        if name not in self._arrays:
+            # Copy-on-write, primitives that modify their arrays get private pages
+            self._arrays[name] = np.load(os.path.join(self.folder, name), mmap_mode='c' if self.mmap else None,
+                                         allow_pickle=False)
+        return self._arrays[name]
+
+
+def save_fitted_solution(runtime, storage_dir, pipeline_id):
+    """Store a fitted pipeline (`d3m.runtime.Runtime`).
+    """
+    folder = _get_folder(storage_dir, pipeline_id)
+    temp_folder = '%s.%d.tmp' % (folder, os.getpid())
+    os.makedirs(temp_folder)
+    try:
+        with open(os.path.join(temp_folder, 'runtime.pkl'), 'wb') as fout:
+            pickler = _ArrayPickler(fout, temp_folder)
+            pickler.dump(runtime)
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'pickle': _file_digest(os.path.join(temp_folder, 'runtime.pkl')),
+            'arrays': pickler.arrays,
+        }
+        with open(os.path.join(temp_folder, 'manifest.json'), 'w') as fout:
+            json.dump(manifest, fout, indent=2, sort_keys=True)
+
+        # Write under a temporary name so other processes never see partial folders
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+        os.rename(temp_folder, folder)
+    except BaseException:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        raise
+    logger.info('Stored fitted pipeline %s, %d arrays in separate files', pipeline_id, len(pickler.arrays))
+
+
+def get_fitted_solution_stat(storage_dir, pipeline_id):
+    """Get the path, modification time and size of a stored fitted pipeline.
+
+    :raise FileNotFoundError: if the fitted pipeline doesn't exist.
+    """
+    manifest_path = os.path.join(_get_folder(storage_dir, pipeline_id), 'manifest.json')
+    if os.path.exists(manifest_path):
+        folder = os.path.dirname(manifest_path)
+        size = sum(os.stat(os.path.join(folder, name)).st_size for name in os.listdir(folder))
+        return folder, os.stat(manifest_path).st_mtime_ns, size
+    path = _get_legacy_path(storage_dir, pipeline_id)
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+def load_fitted_solution(storage_dir, pipeline_id, mmap=True, verify_arrays=False):
+    """Load a fitted pipeline.
+
+    :param mmap: Map the array files in memory instead of reading them.
+    :param verify_arrays: Also check the digests of the array files (this
+        reads them all).
+    """
+    folder = _get_folder(storage_dir, pipeline_id)
+    manifest_path = os.path.join(folder, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        with open(_get_legacy_path(storage_dir, pipeline_id), 'rb') as fin:
+            return pickle.load(fin)
+
+    with open(manifest_path) as fin:
+        manifest = json.load(fin)
+    if manifest['version'] != MANIFEST_VERSION:
+        raise ValueError("Unknown version %r of fitted pipeline %s" % (manifest['version'], pipeline_id))
+    pickle_path = os.path.join(folder, 'runtime.pkl')
+    if _file_digest(pickle_path) != manifest['pickle']:
+        raise ValueError("Fitted pipeline %s is corrupted" % pipeline_id)
+    if verify_arrays:
+        for name, digest in manifest['arrays'].items():
+            if _file_digest(os.path.join(folder, name)) != digest:
+                raise ValueError("Array %s of fitted pipeline %s is corrupted" % (name, pipeline_id))
+
+    with open(pickle_path, 'rb') as fin:
+        return _ArrayUnpickler(fin, folder, mmap).load()
+
+
+def get_exported_fitted_solution(storage_dir, pipeline_id):
+    """Get the path of the single pickle file of a fitted pipeline.
+
+    :return: A tuple ``(path, up_to_date)``, or None if the fitted pipeline
+        doesn't exist.
+    """
+    path = _get_legacy_path(storage_dir, pipeline_id)
+    try:
+        folder, mtime, _ = get_fitted_solution_stat(storage_dir, pipeline_id)
+    except FileNotFoundError:
+        return None
+    up_to_date = folder == path or (os.path.exists(path) and os.stat(path).st_mtime_ns >= mtime)
+    return path, up_to_date
+
+
+def export_fitted_solution(storage_dir, pipeline_id):
+    """Write a fitted pipeline as a single pickle file, for clients.
+
+    This loads the fitted pipeline, importing its primitives.
+
+    :return: The path of the file, or None if the fitted pipeline doesn't exist.
+    """
+    exported = get_exported_fitted_solution(storage_dir, pipeline_id)
+    if exported is None:
+        return None
+    path, up_to_date = exported
+    if up_to_date:
+        return path
+
+    runtime = load_fitted_solution(storage_dir, pipeline_id, mmap=False, verify_arrays=True)
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(temp_path, 'wb') as fout:
+            pickle.dump(runtime, fout)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return path
+
+
+def export(msg_queue, storage_dir, pipeline_id):
+    """Run `export_fitted_solution()`, in a subprocess.
+    """
+    if export_fitted_solution(storage_dir, pipeline_id) is None:
+        raise FileNotFoundError("Fitted pipeline %s doesn't exist" % pipeline_id)
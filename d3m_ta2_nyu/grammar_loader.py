@@ -1,4 +1,7 @@
 import os
+import copy
+import hashlib
+import json
 import logging
 import itertools
 from nltk.grammar import Production, Nonterminal, CFG, is_terminal, is_nonterminal
@@ -7,6 +10,12 @@ logger = logging.getLogger(__name__)
 BASE_GRAMMAR_PATH = os.path.join(os.path.dirname(__file__), '../resource/base_grammar.bnf')
 COMPLETE_GRAMMAR_PATH = os.path.join(os.environ.get('D3MOUTPUTDIR'), 'temp', 'complete_grammar.bnf')
 TASK_GRAMMAR_PATH = os.path.join(os.environ.get('D3MOUTPUTDIR'), 'temp', 'task_grammar.bnf')
+FORMATTED_GRAMMARS_DIR = os.path.join(os.environ.get('D3MOUTPUTDIR'), 'temp', 'grammars')
+# Increase when the formatted grammars change, to ignore the ones already stored
+FORMATTED_GRAMMAR_VERSION = 1
+
+# key -> formatted grammar
+_formatted_grammars = {}
 
 
 def load_grammar(grammar_path):
@@ -57,16 +66,22 @@ def create_taskgrammar(grammar, task, encoders):
         else:
             new_productions.append(Production(start_token, start_production.rhs()))
 
+    # Keep the productions whose left-hand side is used by the productions kept so far
+    used_tokens = set()
+    for new_production in new_productions:
+        used_tokens.update(new_production.rhs())
+    added_productions = set(new_productions)
     for production in grammar.productions():
-        for new_production in new_productions:
-            if production.lhs() in new_production.rhs() and production not in new_productions:
-                if production.lhs().symbol() == 'ENCODERS':  # Use encoders only for types of features in the dataset
-                    if len(encoders) > 0:
-                        new_productions.append(Production(production.lhs(), [Nonterminal(e) for e in encoders]))
-                    else:
-                        new_productions.append(Production(production.lhs(), ['E']))
+        if production.lhs() in used_tokens and production not in added_productions:
+            if production.lhs().symbol() == 'ENCODERS':  # Use encoders only for types of features in the dataset
+                if len(encoders) > 0:
+                    production = Production(production.lhs(), [Nonterminal(e) for e in encoders])
                 else:
-                    new_productions.append(production)
+                    production = Production(production.lhs(), ['E'])
+            if production not in added_productions:
+                new_productions.append(production)
+                added_productions.add(production)
+                used_tokens.update(production.rhs())
 
     task_grammar = CFG(start_token, new_productions)
 
@@ -76,12 +91,47 @@ def create_taskgrammar(grammar, task, encoders):
     return task_grammar
 
 
+def get_grammar_key(task, primitives, encoders):
+    """Get the key under which the formatted grammar for a task is cached.
+    """
+    with open(BASE_GRAMMAR_PATH) as fin:
+        base_grammar = fin.read()
+    data = json.dumps([FORMATTED_GRAMMAR_VERSION, base_grammar, task, list(encoders), primitives], sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
 def format_grammar(task, primitives, encoders=[]):
+    """Get the grammar for a task, in the style of the pipeline game.
+
+    Formatted grammars are cached in memory and in ``D3MOUTPUTDIR/temp``,
+    keyed by the base grammar, task, encoders and primitives, so the other
+    searches don't build them again.
+    """
+    key = get_grammar_key(task, primitives, encoders)
+    if key not in _formatted_grammars:
+        path = os.path.join(FORMATTED_GRAMMARS_DIR, '%s.json' % key)
+        if os.path.isfile(path):
+            logger.info('Loading formatted grammar for task %s from %s', task, path)
+            with open(path) as fin:
+                _formatted_grammars[key] = json.load(fin)
+        else:
+            _formatted_grammars[key] = _format_grammar(task, primitives, encoders)
+            os.makedirs(FORMATTED_GRAMMARS_DIR, exist_ok=True)
+            temp_path = '%s.%d.tmp' % (path, os.getpid())
+            with open(temp_path, 'w') as fout:
+                json.dump(_formatted_grammars[key], fout)
+            os.replace(temp_path, path)
+
+    return copy.deepcopy(_formatted_grammars[key])
+
+
+def _format_grammar(task, primitives, encoders):
     grammar = create_completegrammar(primitives)
     grammar = create_taskgrammar(grammar, task, encoders)
     formatted_grammar = {'NON_TERMINALS': {}, 'TERMINALS': {}, 'RULES': {}, 'RULES_LOOKUP': {}}
     formatted_grammar['START'] = grammar.start().symbol()
     terminals = []
+    seen_terminals = set()
 
     logger.info('Formating grammar to style of pipeline game')
     for production in grammar.productions():
@@ -98,8 +148,9 @@ def format_grammar(task, primitives, encoders=[]):
         formatted_grammar['RULES_LOOKUP'][non_terminal].append(production_str)
 
         for token in production.rhs():
-            if is_terminal(token) and token != 'E' and token not in terminals:
+            if is_terminal(token) and token != 'E' and token not in seen_terminals:
                 terminals.append(token)
+                seen_terminals.add(token)
 
     formatted_grammar['TERMINALS'] = {t: i+len(formatted_grammar['NON_TERMINALS']) for i, t in enumerate(terminals, 1)}
     formatted_grammar['TERMINALS']['E'] = 0  # Special case for the empty symbol
@@ -9,8 +9,6 @@ import calendar
 import datetime
 import grpc
 import logging
-import pickle
-import d3m_ta2_nyu.workflow.convert
 import d3m_automl_rpc.core_pb2 as pb_core
 import d3m_automl_rpc.core_pb2_grpc as pb_core_grpc
 import d3m_automl_rpc.problem_pb2 as pb_problem
@@ -23,8 +21,9 @@ from d3m_ta2_nyu import __version__
 
 from google.protobuf.timestamp_pb2 import Timestamp
 from d3m_ta2_nyu.grpc_api.grpc_logger import log_service
-from d3m_ta2_nyu.primitive_loader import get_primitives_by_name
+from d3m_ta2_nyu.primitive_loader import get_primitive_metadata, get_primitives_by_name
 from d3m_ta2_nyu.utils import PersistentQueue
+from d3m_ta2_nyu.workflow.database import decode_value
 from d3m_automl_rpc.utils import decode_pipeline_description, decode_problem_description, decode_performance_metric, \
     encode_raw_value
 from d3m.metadata import pipeline as pipeline_module
@@ -79,7 +78,7 @@ class CoreService(pb_core_grpc.CoreServicer):
         return pb_core.HelloResponse(
             user_agent=user_agent,
             version=version,
-            allowed_value_types=['RAW', 'DATASET_URI', 'CSV_URI'],
+            allowed_value_types=['RAW', 'DATASET_URI', 'CSV_URI', 'PICKLE_BLOB'],
             supported_extensions=[],
             supported_task_keywords=[],  # TODO: Add supported_task_keywords using core package enums
             supported_performance_metrics=[],  # TODO: Add supported_performance_metrics using core package enums
@@ -473,12 +472,16 @@ class CoreService(pb_core_grpc.CoreServicer):
         pipeline_id = UUID(hex=request.fitted_solution_id)
         dataset = request.inputs[0].dataset_uri
         steps_to_expose = list(request.expose_outputs)
+        # Small outputs are sent in the response if the client prefers it to a CSV file
+        value_types = list(request.expose_value_types)
+        inline_outputs = 'PICKLE_BLOB' in value_types and \
+            ('CSV_URI' not in value_types or value_types.index('PICKLE_BLOB') < value_types.index('CSV_URI'))
 
         if dataset.startswith('/'):
             logger.warning("Dataset is a path, turning it into a file:// URL")
             dataset = 'file://' + dataset
 
-        job_id = self._ta2.test_pipeline(pipeline_id, dataset, steps_to_expose)
+        job_id = self._ta2.test_pipeline(pipeline_id, dataset, steps_to_expose, inline_outputs)
         self._requests[job_id] = PersistentQueue()
 
         return pb_core.ProduceSolutionResponse(
@@ -504,14 +507,20 @@ class CoreService(pb_core_grpc.CoreServicer):
                 pipeline_id = kwargs['pipeline_id']
                 storage_dir = kwargs['storage_dir']
                 steps_to_expose = kwargs['steps_to_expose']
+                outputs = kwargs.get('outputs', {})
+                exposed_outputs = {}
+                for step_id in steps_to_expose:
+                    if step_id in outputs:
+                        exposed_outputs[step_id] = pb_value.Value(pickle_blob=outputs[step_id])
+                    else:
+                        exposed_outputs[step_id] = pb_value.Value(csv_uri='file://%s/produce_%s_%s.csv' %
+                                                                          (storage_dir, pipeline_id, step_id))
                 yield pb_core.GetProduceSolutionResultsResponse(
                     progress=pb_core.Progress(
                         state=pb_core.COMPLETED,
                         status="Execution completed",
                     ),
-                    exposed_outputs={step_id: pb_value.Value(csv_uri='file://%s/produce_%s_%s.csv' %
-                                                                     (storage_dir, pipeline_id, step_id))
-                                     for step_id in steps_to_expose},
+                    exposed_outputs=exposed_outputs,
                 )
                 break
             elif event == 'testing_error':
@@ -622,12 +631,11 @@ class CoreService(pb_core_grpc.CoreServicer):
                 inputs[conn.to_input_name] = '%s.%s' % (step,
                                                         conn.from_output_name)
 
-        klass = d3m_ta2_nyu.workflow.convert.get_class(mod.name)
-        metadata = klass.metadata.query()
+        metadata = get_primitive_metadata(mod.name)
         metadata_items = {
             key: metadata[key]
             for key in ('id', 'version', 'python_path', 'name', 'digest')
-            if key in metadata
+            if metadata.get(key) is not None
         }
 
         arguments = {
@@ -642,7 +650,7 @@ class CoreService(pb_core_grpc.CoreServicer):
         # If hyperparameters are set, export them
         step_hyperparams = {}
         if mod.id in params and 'hyperparams' in params[mod.id]:
-            hyperparams = pickle.loads(params[mod.id]['hyperparams'])
+            hyperparams = decode_value(params[mod.id]['hyperparams'])
             for k, v in hyperparams.items():
                 step_hyperparams[k] = pb_pipeline.PrimitiveStepHyperparameter(
                     value=pb_pipeline.ValueArgument(
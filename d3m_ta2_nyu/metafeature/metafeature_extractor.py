@@ -1,6 +1,5 @@
 import os
 import logging
-import pickle
 import frozendict
 from d3m_ta2_nyu.workflow import database
 from d3m.container import Dataset
@@ -142,11 +141,11 @@ class ComputeMetafeatures():
         input_data = make_data_module('dataset')
         db.add(database.PipelineParameter(
             pipeline=pipeline, module=input_data,
-            name='targets', value=pickle.dumps(self.targets),
+            name='targets', value=database.encode_value(self.targets),
         ))
         db.add(database.PipelineParameter(
             pipeline=pipeline, module=input_data,
-            name='features', value=pickle.dumps(self.features),
+            name='features', value=database.encode_value(self.features),
         ))
 
         # FIXME: Denormalize?
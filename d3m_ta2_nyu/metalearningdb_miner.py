@@ -2,12 +2,18 @@ import os
 import json
 import copy
 import logging
+import sqlite3
 from os.path import join
 from collections import OrderedDict
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(message)s')
 logger = logging.getLogger(__name__)
 
+METALEARNINGDB_PATH = join(os.path.dirname(__file__), '../resource/metalearningdb.json')
+METALEARNINGDB_INDEX_PATH = join(os.path.dirname(__file__), '../resource/metalearningdb.sqlite3')
+# Number of rows inserted at a time when building the index
+INSERT_BATCH_SIZE = 10000
+
 
 IGNORE_PRIMITIVES = {'d3m.primitives.data_transformation.construct_predictions.Common',
                      'd3m.primitives.data_transformation.extract_columns_by_semantic_types.Common',
@@ -18,88 +24,211 @@ IGNORE_PRIMITIVES = {'d3m.primitives.data_transformation.construct_predictions.C
                      'd3m.primitives.data_cleaning.column_type_profiler.Simon'}
 
 
+def _get_source(path):
+    """Get the path, modification time and size of the file an index is built from.
+    """
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+def _read_index_source():
+    """Get the source recorded in the index, None if the index predates it.
+    """
+    conn = sqlite3.connect(METALEARNINGDB_INDEX_PATH)
+    try:
+        return conn.execute('SELECT path, mtime_ns, size FROM source').fetchone()
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        conn.close()
+
+
+def _is_index_outdated():
+    if not os.path.exists(METALEARNINGDB_INDEX_PATH):
+        return True
+    if not os.path.exists(METALEARNINGDB_PATH):
+        return False
+    source = _read_index_source()
+    if source is None:
+        logger.warning('Metalearning database index has no source information, rebuilding it')
+        return True
+    json_source = _get_source(METALEARNINGDB_PATH)
+    # Indexes built from the dump files don't depend on the merged JSON file
+    if source[0] == json_source[0] and tuple(source) != json_source:
+        logger.warning('%s changed since the index was built, rebuilding it', METALEARNINGDB_PATH)
+        return True
+    return False
+
+
+def _write_index(runs, source_path):
+    """Write the index of the metalearning database from an iterable of runs.
+
+    Each run is a tuple ``(task, problem_id, pipeline_digest, steps, score)``
+    where steps is a list of ``(primitive_id, python_path)`` pairs. The path,
+    modification time and size of ``source_path`` are stored to know when the
+    index is outdated.
+    """
+    source = _get_source(source_path)
+    temp_path = '%s.%d.tmp' % (METALEARNINGDB_INDEX_PATH, os.getpid())
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    conn = sqlite3.connect(temp_path)
+    try:
+        conn.execute('CREATE TABLE pipeline_runs (task TEXT, problem_id TEXT, pipeline_digest TEXT, '
+                     'primitive_ids TEXT, steps TEXT, score REAL)')
+        count = 0
+        batch = []
+        for task, problem_id, pipeline_digest, steps, score in runs:
+            primitive_ids = ' '.join(sorted({primitive_id for primitive_id, _ in steps}))
+            batch.append((task, problem_id, pipeline_digest, primitive_ids, json.dumps(steps), score))
+            if len(batch) >= INSERT_BATCH_SIZE:
+                conn.executemany('INSERT INTO pipeline_runs VALUES (?, ?, ?, ?, ?, ?)', batch)
+                count += len(batch)
+                batch = []
+        conn.executemany('INSERT INTO pipeline_runs VALUES (?, ?, ?, ?, ?, ?)', batch)
+        count += len(batch)
+        conn.execute('CREATE INDEX ix_pipeline_runs_task ON pipeline_runs (task)')
+        conn.execute('CREATE TABLE source (path TEXT, mtime_ns INTEGER, size INTEGER)')
+        conn.execute('INSERT INTO source VALUES (?, ?, ?)', source)
+        conn.commit()
+    except BaseException:
+        conn.close()
+        os.remove(temp_path)
+        raise
+    conn.close()
+    os.replace(temp_path, METALEARNINGDB_INDEX_PATH)
+    logger.info('Wrote %d pipeline runs to %s', count, METALEARNINGDB_INDEX_PATH)
+
+
+def _get_steps(pipeline):
+    return [(step['primitive']['id'], step['primitive']['python_path']) for step in pipeline['steps']]
+
+
+def _get_indexed_task(problem):
+    task = get_problem_task(problem)
+    # Runs of problems that can't be targeted are kept without a task
+    return task if isinstance(task, str) else None
+
+
 def merge_pipeline_files(pipelines_file, pipeline_runs_file, problems_file, n=-1, verbose=False):
+    """Write the index of the metalearning database from the dump files.
+
+    The runs are streamed, only the primitives of the pipelines and the
+    tasks of the problems are kept in memory.
+    """
     logger.info('Adding pipelines to lookup table...')
     pipelines = {}
     with open(pipelines_file, 'r') as f:
         for line in f:
             pipeline = json.loads(line)
-            pipelines[pipeline['digest']] = pipeline
+            try:
+                pipelines[pipeline['digest']] = _get_steps(pipeline)
+            except KeyError:
+                if verbose:
+                    logger.error('Pipeline %s has steps that are not primitives', pipeline['id'])
 
     logger.info('Adding problems to lookup table...')
     problems = {}
     with open(problems_file, 'r') as f:
         for line in f:
             problem = json.loads(line)
-            problems[problem['digest']] = problem['problem']
-            problems[problem['digest']]['id'] = problem['id']
+            problems[problem['digest']] = problem['id'], _get_indexed_task(problem['problem'])
+
+    def read_runs():
+        count = 0
+        with open(pipeline_runs_file, 'r') as f:
+            for line in f:
+                if count == n:
+                    break
+                try:
+                    run = json.loads(line)
+                    if run['run']['phase'] != 'PRODUCE':
+                        continue
+                    steps = pipelines[run['pipeline']['digest']]
+                    problem_id, task = problems[run['problem']['digest']]
+                    score = run['run']['results']['scores'][0]['value']
+                except Exception as e:
+                    if verbose:
+                        logger.error('Skipping pipeline run: %r', e)
+                    continue
+                count += 1
+                yield task, problem_id, run['pipeline']['digest'], steps, score
 
     logger.info('Merging pipeline information with pipeline_runs_file (this might take a while)...')
-    merged = []
-    with open(pipeline_runs_file, 'r') as f:
-        for line in f:
-            if len(merged) == n:
-                break
-            try:
-                run = json.loads(line)
-                if run['run']['phase'] != 'PRODUCE':
-                    continue
-                pipeline = pipelines[run['pipeline']['digest']]
-                problem = problems[run['problem']['digest']]
-                data = {
-                    'pipeline_id': pipeline['id'],
-                    'pipeline_digest': pipeline['digest'],
-                    'pipeline_source': pipeline['source'],
-                    'inputs': pipeline['inputs'],
-                    'outputs': pipeline['outputs'],
-                    'problem': problem,
-                    'start': run['start'],
-                    'end': run['end'],
-                    'steps': pipeline['steps'],
-                    'scores': run['run']['results']['scores']
-                }
-                merged.append(json.dumps(data))
-            except Exception as e:
-                if (verbose):
-                    logger.error(problem['id'], repr(e))
+    _write_index(read_runs(), pipeline_runs_file)
     logger.info('Done.')
 
-    with open(join(os.path.dirname(__file__), '../resource/metalearningdb.json'), 'w') as fout:
-        fout.write('\n'.join(merged))
 
+def index_metalearningdb(path=None):
+    """Write the index of the metalearning database from a merged JSON file.
+
+    That is the file written by previous versions of `merge_pipeline_files()`,
+    `METALEARNINGDB_PATH` by default.
+    """
+    if path is None:
+        path = METALEARNINGDB_PATH
+
+    def read_runs():
+        with open(path) as fin:
+            for line in fin:
+                pipeline_run = json.loads(line)
+                try:
+                    steps = _get_steps(pipeline_run)
+                    score = pipeline_run['scores'][0]['value']
+                except (KeyError, IndexError):
+                    continue
+                yield (_get_indexed_task(pipeline_run['problem']), pipeline_run['problem'].get('id'),
+                       pipeline_run['pipeline_digest'], steps, score)
+
+    logger.info('Indexing metalearning database %s...', path)
+    _write_index(read_runs(), path)
+
+
+def iter_metalearningdb(task):
+    """Iterate on the pipelines of the metalearning database for a task.
+
+    Only the runs of the task are read from the index (which is created from
+    the merged JSON file if needed, or rebuilt if that file changed).
+
+    :return: An iterator of ``(primitives, score)`` where primitives is a
+        dict of the primitive IDs to their path.
+    """
+    if _is_index_outdated():
+        index_metalearningdb()
 
-def load_metalearningdb(task):
     primitives_by_name = load_primitives_by_name()
     primitive_ids = set(primitives_by_name.values())
     ignore_primitives_ids = set()
-    all_pipelines = []
-    task_pipelines = []
 
     logger.info('Loading pipelines from metalearning database...')
 
-    with open(join(os.path.dirname(__file__), '../resource/metalearningdb.json')) as fin:
-        for line in fin:
-            all_pipelines.append(json.loads(line))
-
     for ignore_primitive in IGNORE_PRIMITIVES:
         if ignore_primitive in primitives_by_name:
             ignore_primitives_ids.add(primitives_by_name[ignore_primitive])
 
-    for pipeline_run in all_pipelines:
-        pipeline_primitives = pipeline_run['steps']
-        if is_target_task(pipeline_run['problem'], task) and is_available_primitive(pipeline_primitives, primitive_ids):
-            primitives = filter_primitives(pipeline_primitives, ignore_primitives_ids)
+    count = 0
+    conn = sqlite3.connect(METALEARNINGDB_INDEX_PATH)
+    try:
+        cursor = conn.execute('SELECT steps, score FROM pipeline_runs WHERE task = ?', (task,))
+        for steps, score in cursor:
+            steps = json.loads(steps)
+            if not is_available_primitive(steps, primitive_ids):
+                continue
+            primitives = filter_primitives(steps, ignore_primitives_ids)
             if len(primitives) > 0:
-                score = pipeline_run['scores'][0]['value']
-                task_pipelines.append((primitives, score))
+                count += 1
+                yield primitives, score
+    finally:
+        conn.close()
 
-    logger.info('Found %d pipelines for task %s', len(task_pipelines), task)
+    logger.info('Found %d pipelines for task %s', count, task)
 
-    return task_pipelines
+
+def load_metalearningdb(task):
+    return list(iter_metalearningdb(task))
 
 
 def create_vectors_from_metalearningdb(task, grammar):
-    pipelines_metalearningdb = load_metalearningdb(task)
     primitives_by_type = load_primitives_by_type()
     primitives_by_name = load_primitives_by_name()
     current_primitive_ids = {}
@@ -113,7 +242,7 @@ def create_vectors_from_metalearningdb(task, grammar):
         if primitive_name != 'E':  # Special symbol for empty primitive
             current_primitive_ids[primitives_by_name[primitive_name]] = current_primitives[primitive_name]
 
-    primitives_distribution = analyze_distribution(pipelines_metalearningdb)
+    primitives_distribution = analyze_distribution(iter_metalearningdb(task))
     action_probabilities = {}
     actions = [i for i, j in sorted(rules.items(), key=lambda x: x[1])]
     for primitive_type, primitives_info in primitives_distribution.items():
@@ -122,7 +251,8 @@ def create_vectors_from_metalearningdb(task, grammar):
             action_probabilities[action] = distribution
     count_inputs = 0
     unique_pipelines = {}
-    for pipeline, score in pipelines_metalearningdb:
+    # Stream the pipelines, only the distinct pipelines and their scores are kept
+    for pipeline, score in iter_metalearningdb(task):
         if all(primitive in current_primitive_ids for primitive in pipeline):
             count_inputs += 1
             pipeline_representation = ' '.join(sorted(pipeline.values()))
@@ -270,14 +400,18 @@ def analyze_distribution(pipelines_metalearningdb):
 
 
 def is_available_primitive(pipeline_primitives, current_primitives):
-    for primitive in pipeline_primitives:
-        if primitive['primitive']['id'] not in current_primitives:
-            logger.warning('Primitive %s is not longer available' % primitive['primitive']['python_path'])
+    for primitive_id, python_path in pipeline_primitives:
+        if primitive_id not in current_primitives:
+            logger.warning('Primitive %s is not longer available' % python_path)
             return False
     return True
 
 
 def is_target_task(problem, task):
+    return task == get_problem_task(problem)
+
+
+def get_problem_task(problem):
     problem_task = None
     if 'task_type' in problem:
         problem_task = [problem['task_type']]
@@ -286,18 +420,15 @@ def is_target_task(problem, task):
             #if 'CLASSIFICATION' in problem['task_keywords'] and '1491_one_hundred_plants_margin' in problem['id']:
             problem_task = 'CLASSIFICATION'
 
-    if task == problem_task:
-        return True
-
-    return False
+    return problem_task
 
 
-def filter_primitives(pipeline_steps, ignore_primitives):
+def filter_primitives(pipeline_primitives, ignore_primitives):
     primitives = OrderedDict()
 
-    for pipeline_step in pipeline_steps:
-        if pipeline_step['primitive']['id'] not in ignore_primitives:
-                primitives[pipeline_step['primitive']['id']] = pipeline_step['primitive']['python_path']
+    for primitive_id, python_path in pipeline_primitives:
+        if primitive_id not in ignore_primitives:
+                primitives[primitive_id] = python_path
 
     return primitives
 
@@ -12,10 +12,18 @@ import pickle
 import socket
 from queue import Empty
 import subprocess
+import threading
 import traceback
 import sys
 
 
+logger = logging.getLogger(__name__)
+
+
+# Seconds given to a worker to exit after its connection is closed
+WORKER_EXIT_TIMEOUT = 5
+
+
 class Receiver(object):
     def __init__(self):
         self._listener = socket.socket(getattr(socket, 'AF_UNIX'))
@@ -31,31 +39,37 @@ class Receiver(object):
             raise
 
         self._sockets = [self._listener]
+        # Messages can be sent from other threads while receiving
+        self._lock = threading.Lock()
 
     def recv(self, timeout=None):
         done = False
         while not done:
             done = True
-            for sock in multiprocessing.connection.wait(self._sockets,
-                                                        timeout):
+            with self._lock:
+                sockets = list(self._sockets)
+            for sock in multiprocessing.connection.wait(sockets, timeout):
                 if sock == self._listener:
                     s, addr = self._listener.accept()
                     conn = multiprocessing.connection.Connection(s.detach())
-                    self._sockets.append(conn)
+                    with self._lock:
+                        self._sockets.append(conn)
                     done = False
                 else:
                     try:
                         msg = sock.recv()
                     except EOFError:
-                        self._sockets.remove(sock)
+                        with self._lock:
+                            self._sockets.remove(sock)
                     else:
                         return msg
         raise Empty
 
     def send(self, msg):
-        for sock in self._sockets:
-            if sock != self._listener:
-                sock.send(msg)
+        with self._lock:
+            sockets = [sock for sock in self._sockets if sock != self._listener]
+        for sock in sockets:
+            sock.send(msg)
 
     def close(self):
         try:
@@ -64,14 +78,21 @@ class Receiver(object):
             os.unlink(self.address)
 
 
-def run_process(target, tag, msg_queue, **kwargs):
+def run_process(target, tag, msg_queue, worker_pool=None, affinity=None, **kwargs):
     """Call a Python function by name in a subprocess.
 
     :param target: Fully-qualified name of function to call.
     :param tag: Tag to add to logger to identify that process.
-    :return: A `subprocess.Popen` object.
+    :param worker_pool: A `WorkerPool` to run the function in, instead of
+        starting a new process.
+    :param affinity: If set, prefer a worker that already ran a job with the
+        same affinity (and might have its data loaded).
+    :return: A `subprocess.Popen` object, or a `PoolProcess` object with the
+        same interface.
     """
     assert isinstance(msg_queue, Receiver)
+    if worker_pool is not None and worker_pool.usable:
+        return worker_pool.run(target, tag, msg_queue, affinity=affinity, **kwargs)
     data = msg_queue.address, kwargs
     proc = subprocess.Popen(
         [
@@ -87,14 +108,188 @@ def run_process(target, tag, msg_queue, **kwargs):
     return proc
 
 
-def _invoke(tag, target):
-    """Invoked in the subprocess to setup logging and start the function.
+class _Worker(object):
+    def __init__(self, proc, conn):
+        self.proc = proc
+        self.conn = conn
+        self.jobs = 0
+        self.affinities = set()
 
-    Arguments are read from ``sys.argv``.
+
+class WorkerPool(object):
+    """Pool of long-lived worker processes, that don't use fork either.
+
+    Workers import the heavy modules once when they start, then run the
+    functions sent to them over a connection, one at a time. A worker is
+    replaced after running `max_jobs` jobs, or if it dies. Workers are only
+    started on first use. When no worker is idle (they are starting or being
+    replaced), jobs run in a new process instead of waiting.
     """
-    data = pickle.loads(base64.b64decode(sys.argv[1]))
-    address, kwargs = data
+    def __init__(self, size, preload=(), max_jobs=20):
+        self.size = size
+        self.preload = list(preload)
+        self.max_jobs = max_jobs
+        self.usable = True
+        self._listener = None
+        self._lock = threading.Lock()
+        self._idle = []
+        self._spawned = {}
+
+    def _start(self):
+        self._listener = multiprocessing.connection.Listener(family='AF_UNIX',
+                                                                  backlog=self.size)
+        thread = threading.Thread(target=self._accept_workers)
+        thread.setDaemon(True)
+        thread.start()
+        for _ in range(self.size):
+            self._spawn()
+
+    def _spawn(self):
+        data = self._listener.address, self.preload
+        proc = subprocess.Popen(
+            [
+                sys.executable,
+                '-c',
+                'from d3m_ta2_nyu.multiprocessing import _worker; _worker()',
+                base64.b64encode(pickle.dumps(data)),
+            ],
+            stdin=subprocess.DEVNULL)
+        self._spawned[proc.pid] = proc
+
+    def _accept_workers(self):
+        while True:
+            conn = self._listener.accept()
+            try:
+                pid = conn.recv()
+            except EOFError:
+                conn.close()
+                continue
+            with self._lock:
+                proc = self._spawned.pop(pid, None)
+                if proc is None:
+                    conn.close()
+                    continue
+                self._idle.append(_Worker(proc, conn))
+
+    def _acquire(self, affinity=None):
+        with self._lock:
+            if self._listener is None:
+                self._start()
+            # Check that workers didn't die before connecting
+            for pid, proc in list(self._spawned.items()):
+                if proc.poll() is not None:
+                    del self._spawned[pid]
+                    logger.error("Worker process failed to start, "
+                                 "returned %d", proc.returncode)
+                    self.usable = False
+            if not self.usable or not self._idle:
+                return None
+            for i, worker in enumerate(self._idle):
+                if affinity is not None and affinity in worker.affinities:
+                    return self._idle.pop(i)
+            return self._idle.pop()
+
+    def _release(self, worker, crashed):
+        worker.jobs += 1
+        with self._lock:
+            if not crashed and worker.jobs < self.max_jobs:
+                self._idle.append(worker)
+                return
+            worker.conn.close()
+            self._spawn()
+        # The worker exits when its connection is closed, reap it
+        try:
+            worker.proc.wait(WORKER_EXIT_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logger.warning("Worker process %d didn't exit, killing it", worker.proc.pid)
+            worker.proc.kill()
+            worker.proc.wait()
+
+    def run(self, target, tag, msg_queue, affinity=None, **kwargs):
+        """Call a Python function by name in one of the workers.
+
+        :param affinity: If set, prefer an idle worker that already ran a job
+            with the same affinity.
+        :return: A `PoolProcess` object, or a `subprocess.Popen` object if
+            no worker is idle or the workers can't be started.
+        """
+        worker = self._acquire(affinity)
+        if worker is None:
+            if self.usable:
+                logger.info("No idle worker, starting a process")
+            else:
+                logger.warning("Worker pool is not usable, starting a process")
+            return run_process(target, tag, msg_queue, **kwargs)
+        if affinity is not None:
+            worker.affinities.add(affinity)
+        worker.conn.send((target, tag, msg_queue.address, kwargs))
+        return PoolProcess(self, worker)
+
+
+class PoolProcess(object):
+    """A job running in a `WorkerPool`, with the `subprocess.Popen` methods.
+    """
+    def __init__(self, pool, worker):
+        self._pool = pool
+        self._worker = worker
+        self._lock = threading.Lock()
+        self._error = b''
+        self.pid = worker.proc.pid
+        self.returncode = None
+
+    def _receive(self, timeout):
+        # Must be called with self._lock held
+        if self.returncode is not None:
+            return
+        conn = self._worker.conn
+        if not conn.poll(timeout):
+            return
+        try:
+            returncode, error = conn.recv()
+        except (EOFError, OSError):
+            # Worker died (or was killed) while running the job
+            returncode = self._worker.proc.wait()
+            error = "Worker process died, returned %d\n" % returncode
+            crashed = True
+        else:
+            crashed = False
+        self._error = error.encode('utf-8')
+        self.returncode = returncode
+        self._pool._release(self._worker, crashed)
+
+    def poll(self):
+        if self._lock.acquire(False):
+            try:
+                self._receive(0)
+            finally:
+                self._lock.release()
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if not self._lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise subprocess.TimeoutExpired('worker %d' % self.pid, timeout)
+        try:
+            self._receive(timeout)
+        finally:
+            self._lock.release()
+        if self.returncode is None:
+            raise subprocess.TimeoutExpired('worker %d' % self.pid, timeout)
+        return self.returncode
+
+    def communicate(self):
+        self.wait()
+        return None, self._error
 
+    def terminate(self):
+        if self.returncode is None:
+            self._worker.proc.terminate()
+
+    def kill(self):
+        if self.returncode is None:
+            self._worker.proc.kill()
+
+
+def _setup_logging(tag):
     tag = '{}-{}'.format(tag, os.getpid())
 
     logging.getLogger().handlers = []
@@ -102,12 +297,28 @@ def _invoke(tag, target):
         level=logging.INFO,
         format="%(asctime)s:%(levelname)s:{}:%(name)s:%(message)s".format(tag),
         stream=sys.stdout)
+    return tag
 
-    msg_queue = multiprocessing.connection.Client(address)
 
+def _get_function(target):
     module, function = target.rsplit('.', 1)
     module = importlib.import_module(module)
-    function = getattr(module, function)
+    return getattr(module, function)
+
+
+def _invoke(tag, target):
+    """Invoked in the subprocess to setup logging and start the function.
+
+    Arguments are read from ``sys.argv``.
+    """
+    data = pickle.loads(base64.b64decode(sys.argv[1]))
+    address, kwargs = data
+
+    tag = _setup_logging(tag)
+
+    msg_queue = multiprocessing.connection.Client(address)
+
+    function = _get_function(target)
 
     try:
         function(msg_queue=msg_queue, **kwargs)
@@ -116,3 +327,42 @@ def _invoke(tag, target):
         error = traceback.format_exc()
         sys.stderr.write(error)
         sys.exit(1)
+
+
+def _worker():
+    """Main loop of the `WorkerPool` processes.
+
+    Arguments are read from ``sys.argv``.
+    """
+    address, preload = pickle.loads(base64.b64decode(sys.argv[1]))
+
+    _setup_logging('worker')
+    for module in preload:
+        importlib.import_module(module)
+
+    conn = multiprocessing.connection.Client(address)
+    conn.send(os.getpid())
+
+    while True:
+        try:
+            target, tag, address, kwargs = conn.recv()
+        except EOFError:
+            break
+
+        tag = _setup_logging(tag)
+        returncode, error = 0, ''
+        msg_queue = multiprocessing.connection.Client(address)
+        try:
+            function = _get_function(target)
+            function(msg_queue=msg_queue, **kwargs)
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                returncode = e.code
+            elif e.code is not None:
+                returncode, error = 1, '%s\n' % e.code
+        except Exception:
+            logging.exception("Uncaught exception in subprocess %s", tag)
+            returncode, error = 1, traceback.format_exc()
+        finally:
+            msg_queue.close()
+        conn.send((returncode, error))
@@ -1,6 +1,11 @@
+import json
 import logging
+import math
+import os
 import numpy as np
-from smac.configspace import ConfigurationSpace
+from multiprocessing import Process, Queue
+from queue import Empty
+from smac.configspace import Configuration, ConfigurationSpace
 from ConfigSpace.hyperparameters import IntegerHyperparameter, FloatHyperparameter, CategoricalHyperparameter, \
     OrdinalHyperparameter
 from smac.facade.smac_facade import SMAC
@@ -11,6 +16,11 @@ from d3m_ta2_nyu.parameter_tuning.primitive_config import load_primitive_configs
 MAX_RUNS = 100
 logger = logging.getLogger(__name__)
 
+# Runner and scenario of the parallel SMAC instances, inherited by the forked processes
+_parallel_tuning = None
+# Seconds between the checks that the SMAC processes are still running
+INSTANCE_POLL_INTERVAL = 5
+
 
 def build_configspace(primitives):
     # Build Configuration Space which defines all parameters and their ranges
@@ -62,19 +72,136 @@ class HyperparameterTuning(object):
                 break
 
         self.runcount = min(self.runcount, MAX_RUNS)
+        self.trials = []
+
+    def get_configurations(self, values_list):
+        """Build the configurations from their values, dropping the invalid ones.
+        """
+        configurations = []
+        for values in values_list:
+            try:
+                configuration = Configuration(self.configspace, values=values)
+            except (ValueError, KeyError) as e:
+                logger.warning('Ignoring invalid initial configuration: %s', e)
+            else:
+                if configuration not in configurations:
+                    configurations.append(configuration)
+        return configurations
+
+    def tune(self, runner, wallclock, output_dir, n_jobs=1, initial_configurations=None):
+        """Find the best configuration.
+
+        With n_jobs > 1, that many SMAC instances run in parallel processes,
+        each evaluating its own configurations. They share their run histories
+        through output_dir (pSMAC), so each one's model learns from all the
+        evaluations.
 
-    def tune(self, runner, wallclock, output_dir):
+        SMAC starts from the initial configurations (list of values) if given,
+        instead of from the default one. The evaluated configurations and their
+        costs are kept in ``self.trials``.
+        """
+        n_jobs = max(1, min(n_jobs, self.runcount))
+        initial_configurations = self.get_configurations(initial_configurations or [])
         # Scenario object
         cutoff = wallclock / (self.runcount / 10)  # Allow long pipelines to try to execute one fourth of the iterations limit
-        scenario = Scenario({"run_obj": "quality",  # We optimize quality (alternatively runtime)
-                             "runcount-limit": self.runcount,  # Maximum function evaluations
-                             "wallclock-limit": wallclock,
-                             "cutoff_time": cutoff,
-                             "cs": self.configspace,  # Configuration space
-                             "deterministic": "true",
-                             "output_dir": output_dir,
-                             "abort_on_first_run_crash": False
-                             })
-        smac = SMAC(scenario=scenario, rng=np.random.RandomState(42), tae_runner=runner)
-
-        return smac.optimize()
+        scenario = {"run_obj": "quality",  # We optimize quality (alternatively runtime)
+                    "runcount-limit": int(math.ceil(self.runcount / n_jobs)),  # Maximum function evaluations
+                    "wallclock-limit": wallclock,
+                    "cutoff_time": cutoff,
+                    "cs": self.configspace,  # Configuration space
+                    "deterministic": "true",
+                    "output_dir": output_dir,
+                    "abort_on_first_run_crash": False
+                    }
+        if n_jobs == 1:
+            smac = SMAC(scenario=Scenario(scenario), rng=np.random.RandomState(42), tae_runner=runner,
+                        initial_configurations=initial_configurations or None)
+            incumbent = smac.optimize()
+            self.trials = _get_trials(smac)
+            return incumbent
+
+        scenario.update({"shared_model": True,
+                         "input_psmac_dirs": os.path.join(output_dir, 'run_*')})
+        global _parallel_tuning
+        # Each instance starts from its share of the initial configurations
+        _parallel_tuning = runner, scenario, [initial_configurations[i::n_jobs] for i in range(n_jobs)]
+        # Not a Pool: its processes are daemonic, and SMAC runs each evaluation in a child process (pynisher)
+        queue = Queue()
+        processes = [Process(target=_run_smac, args=(index, queue)) for index in range(n_jobs)]
+        try:
+            for process in processes:
+                process.start()
+            results = _collect_results(queue, processes)
+        finally:
+            _parallel_tuning = None
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+        if not results:
+            raise RuntimeError("All the SMAC instances failed")
+
+        # The instances read each other's runs, only keep one of each
+        trials = {}
+        for _, _, instance_trials in results:
+            for values, cost in instance_trials:
+                trials[json.dumps(values, sort_keys=True, default=str)] = values, cost
+        self.trials = list(trials.values())
+
+        # Keep the best incumbent of all the instances
+        values, cost, _ = min(results, key=lambda r: r[1])
+        logger.info('Best configuration of %d SMAC instances has cost %s', n_jobs, cost)
+        return Configuration(self.configspace, values=values)
+
+
+def _get_trials(smac):
+    """Get the configurations (values) evaluated by SMAC and their cost, except the crashed ones.
+    """
+    runhistory = smac.get_runhistory()
+    cost_for_crash = smac.solver.scenario.cost_for_crash
+    trials = []
+    for configuration in runhistory.get_all_configs():
+        cost = runhistory.get_cost(configuration)
+        if not np.isnan(cost) and cost < cost_for_crash:
+            trials.append((configuration.get_dictionary(), cost))
+    return trials
+
+
+def _collect_results(queue, processes):
+    """Get the results of the SMAC processes, until they all sent theirs or exited.
+    """
+    results = []
+    received = 0
+    while received < len(processes):
+        try:
+            result = queue.get(timeout=INSTANCE_POLL_INTERVAL)
+        except Empty:
+            if not any(process.is_alive() for process in processes):
+                # Get what was sent just before exiting
+                try:
+                    result = queue.get(timeout=1)
+                except Empty:
+                    logger.error('%d SMAC processes exited without a result', len(processes) - received)
+                    break
+            else:
+                continue
+        received += 1
+        if result is not None:
+            results.append(result)
+    return results
+
+
+def _run_smac(index, queue):
+    runner, scenario, initial_configurations = _parallel_tuning
+    try:
+        smac = SMAC(scenario=Scenario(scenario), rng=np.random.RandomState(42 + index), tae_runner=runner,
+                    run_id=index + 1, initial_configurations=initial_configurations[index] or None)
+        incumbent = smac.optimize()
+        runhistory = smac.get_runhistory()
+        cost = float('inf')
+        if incumbent in runhistory.config_ids and not np.isnan(runhistory.get_cost(incumbent)):
+            cost = runhistory.get_cost(incumbent)
+        queue.put((incumbent.get_dictionary(), cost, _get_trials(smac)))
+    except Exception:
+        logger.exception('SMAC instance %d failed', index + 1)
+        queue.put(None)
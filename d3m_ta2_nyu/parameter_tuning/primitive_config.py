@@ -1,5 +1,6 @@
 import typing
 import logging
+import functools
 import json
 import os
 from d3m import index
@@ -14,17 +15,22 @@ from ConfigSpace.hyperparameters import CategoricalHyperparameter, UniformFloatH
 
 HYPERPARAMETERS_FROM_METALEARNING_PATH = os.path.join(os.path.dirname(__file__), '../../resource/hyperparams.json')
 
-PRIMITIVES = {}
-primitives_info = get_primitives_by_type()
-for primitive_type in primitives_info:
-    for primitive_name in primitives_info[primitive_type]:
-        PRIMITIVES[primitive_name] = primitive_type
-
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=1)
+def get_primitive_types():
+    primitive_types = {}
+    primitives_info = get_primitives_by_type()
+    for primitive_type in primitives_info:
+        for primitive_name in primitives_info[primitive_type]:
+            primitive_types[primitive_name] = primitive_type
+
+    return primitive_types
+
+
 def is_tunable(primitive_name):
-    primitive_type = PRIMITIVES.get(primitive_name, None)
+    primitive_type = get_primitive_types().get(primitive_name, None)
 
     if primitive_type in {'CLASSIFICATION', 'REGRESSION', 'TIME_SERIES_CLASSIFICATION', 'TIME_SERIES_FORECASTING',
                           'SEMISUPERVISED_CLASSIFICATION', 'COMMUNITY_DETECTION', 'GRAPH_MATCHING', 'LINK_PREDICTION',
@@ -0,0 +1,98 @@
+"""Early stopping of the configurations evaluated while tuning.
+
+SMAC's cutoff time only stops slow runs. To stop bad ones, the folds of a
+configuration are evaluated one at a time, and the evaluation stops as soon
+as its mean cost so far is worse than the median of the previous
+configurations after the same number of folds. SMAC is then given a
+pessimistic cost for it.
+
+SMAC evaluates each configuration in a child process, so the costs of the
+complete configurations are kept in a file that every evaluation reads and
+appends to (this also shares them between parallel SMAC instances).
+"""
+
+import json
+import logging
+import os
+import numpy as np
+
+
+STARTUP_TRIALS = 4
+logger = logging.getLogger(__name__)
+
+
+class MedianPruner(object):
+    """Median pruner.
+
+    :param path: File where the complete configurations are kept. If None,
+        they are only kept in this object, which is only seen by the current
+        process.
+    """
+    def __init__(self, path=None, startup_trials=STARTUP_TRIALS):
+        self.path = path
+        self.startup_trials = startup_trials
+        self._trials = []
+        self.current = []
+
+    @property
+    def trials(self):
+        """Mean cost after each fold, of the configurations evaluated on all the folds.
+        """
+        if self.path is None:
+            return self._trials
+        trials = []
+        try:
+            with open(self.path) as fin:
+                for line in fin:
+                    try:
+                        trials.append(json.loads(line))
+                    except ValueError:
+                        # Being written by another evaluation
+                        pass
+        except FileNotFoundError:
+            pass
+        return trials
+
+    def start(self):
+        """Start evaluating a new configuration.
+        """
+        self.current = []
+
+    def report(self, cost):
+        """Report the cost of the next fold.
+
+        :return: False if the evaluation should stop.
+        """
+        fold_costs = [cost]
+        if self.current:
+            fold_costs.append(self.current[-1] * len(self.current))
+        self.current.append(sum(fold_costs) / (len(self.current) + 1))
+
+        step = len(self.current) - 1
+        trials = self.trials
+        previous = [trial[step] for trial in trials if len(trial) > step]
+        if len(previous) < self.startup_trials:
+            return True
+        median = np.median(previous)
+        if self.current[-1] > median:
+            logger.info('Pruning configuration, cost %s after %d folds, median is %s',
+                        self.current[-1], len(self.current), median)
+            return False
+        return True
+
+    def finish(self):
+        """The configuration was evaluated on all the folds.
+        """
+        if self.path is None:
+            self._trials.append(self.current)
+        else:
+            with open(self.path, 'a') as fout:
+                fout.write(json.dumps(self.current) + '\n')
+
+    def get_pruned_cost(self):
+        """Cost to report for a configuration that was stopped.
+
+        This is the worst cost of the complete configurations, so SMAC doesn't
+        think it is better than it is.
+        """
+        return max([self.current[-1]] + [trial[-1] for trial in self.trials])
@@ -0,0 +1,90 @@
+"""Hyperparameters tried while tuning, kept across searches.
+
+Every configuration evaluated by SMAC is stored in the database, split by
+primitive, with its cost and the dataset and task it was evaluated on. The
+next tuning of a pipeline using the same primitives starts SMAC from the best
+of those configurations (preferring the ones found on the same dataset) along
+with the defaults from ``hyperparams.json``, instead of from the defaults
+alone.
+"""
+
+import json
+import logging
+import math
+from d3m_ta2_nyu.data_ingestion.dataset_cache import get_dataset_version
+from d3m_ta2_nyu.workflow import database
+
+
+TOP_K = 5
+logger = logging.getLogger(__name__)
+
+
+def get_tuning_context(dataset_uri, problem):
+    """Get the dataset and task under which trials are stored.
+    """
+    dataset = get_dataset_version(dataset_uri) or dataset_uri
+    task = '_'.join(sorted(keyword.name for keyword in problem['problem']['task_keywords']))
+    return dataset, task
+
+
+def _get_primitive_values(primitive_name, values):
+    prefix = primitive_name + '|'
+    return {name[len(prefix):]: value for name, value in values.items() if name.startswith(prefix)}
+
+
+def get_initial_configurations(db, primitives, default_values, dataset, task, k=TOP_K):
+    """Get the configurations SMAC should start from.
+
+    The i-th configuration combines the i-th best trial of each primitive,
+    using the default values for the primitives that have fewer trials.
+
+    :param primitives: Names of the tuned primitives.
+    :param default_values: Values (dict) of the default configuration.
+    :return: A list of configuration values, starting with the defaults.
+    """
+    best_trials = {}
+    for primitive_name in primitives:
+        trials = (
+            db.query(database.TuningTrial)
+            .filter(database.TuningTrial.primitive == primitive_name)
+            .filter(database.TuningTrial.task == task)
+            .order_by((database.TuningTrial.dataset == dataset).desc(),
+                      database.TuningTrial.cost)
+        )
+        best_trials[primitive_name] = []
+        for trial in trials:
+            hyperparams = json.loads(trial.hyperparams)
+            if hyperparams not in best_trials[primitive_name]:
+                best_trials[primitive_name].append(hyperparams)
+                if len(best_trials[primitive_name]) == k:
+                    break
+
+    configurations = [default_values]
+    for i in range(max([len(trials) for trials in best_trials.values()] + [0])):
+        values = dict(default_values)
+        for primitive_name, trials in best_trials.items():
+            if i < len(trials):
+                prefix = primitive_name + '|'
+                values = {name: value for name, value in values.items() if not name.startswith(prefix)}
+                values.update((prefix + name, value) for name, value in trials[i].items())
+        if values not in configurations:
+            configurations.append(values)
+
+    logger.info('Starting tuning from %d configurations', len(configurations))
+    return configurations
+
+
+def store_trials(db, primitives, trials, dataset, task):
+    """Store the trials (list of ``(values, cost)``) of a tuning run.
+    """
+    for values, cost in trials:
+        if not math.isfinite(cost):
+            continue
+        for primitive_name in primitives:
+            db.add(database.TuningTrial(
+                primitive=primitive_name,
+                dataset=dataset,
+                task=task,
+                hyperparams=json.dumps(_get_primitive_values(primitive_name, values), sort_keys=True),
+                cost=cost,
+            ))
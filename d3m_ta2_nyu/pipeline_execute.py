@@ -2,10 +2,10 @@ import logging
 import d3m.runtime
 import d3m.metadata.base
 from sqlalchemy.orm import joinedload
-from d3m.container import Dataset
 from d3m.metadata import base as metadata_base
 from d3m_ta2_nyu.workflow import database, convert
-from multiprocessing import Manager, Process
+from d3m_ta2_nyu.data_ingestion.dataset_cache import load_dataset
+from d3m_ta2_nyu.utils import run_with_timeout
 
 
 logger = logging.getLogger(__name__)
@@ -25,7 +25,7 @@ def execute(pipeline_id, dataset, problem, results_path, msg_queue, db):
                 pipeline_id, dataset)
 
     # Load data
-    dataset = Dataset.load(dataset)
+    dataset = load_dataset(dataset)
     logger.info('Loaded dataset')
 
     json_pipeline = convert.to_d3m_json(pipeline)
@@ -37,12 +37,9 @@ def execute(pipeline_id, dataset, problem, results_path, msg_queue, db):
     runtime = d3m.runtime.Runtime(pipeline=d3m_pipeline, problem_description=problem,
                                   context=metadata_base.Context.TESTING)
 
-    manager = Manager()
-    return_dict = manager.dict()
-    p = Process(target=worker, args=(runtime, dataset, return_dict))
-    p.start()
-    p.join(180)  # Maximum 3 minutes
-    fit_results = return_dict['fit_results']
+    # Maximum 3 minutes, in a child process so a stuck fit can be stopped
+    fit_results = run_with_timeout(lambda: runtime.fit(inputs=[dataset]), 180,
+                                   'Reached timeout (%d seconds) to execute a pipeline')
     fit_results.check_success()
 
     if results_path is not None:
@@ -52,7 +49,3 @@ def execute(pipeline_id, dataset, problem, results_path, msg_queue, db):
         logger.info('NOT storing fit results')
 
     return fit_results.values
-
-
-def worker(runtime, dataset, return_dict):
-    return_dict['fit_results'] = runtime.fit(inputs=[dataset])
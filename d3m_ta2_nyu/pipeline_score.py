@@ -3,18 +3,24 @@ import os
 import json
 import pkg_resources
 import random
+import traceback
 import d3m.metadata.base
 import d3m.runtime
 from sqlalchemy.orm import joinedload
-from d3m.container import Dataset
+from d3m_ta2_nyu import evaluation_cache, prefix_cache
 from d3m_ta2_nyu.workflow import database, convert
-from d3m_ta2_nyu.utils import is_collection, get_dataset_sample
+from d3m_ta2_nyu.utils import is_collection, get_dataset_sample, get_dataset_size, time_limit
+from d3m_ta2_nyu.data_ingestion.dataset_cache import load_dataset, load_dataset_doc
 from d3m.metadata.pipeline import Pipeline
 from d3m.metadata.problem import PerformanceMetric, TaskKeyword
-from multiprocessing import Manager, Process
+from multiprocessing import Process, Queue
+from queue import Empty
 
 logger = logging.getLogger(__name__)
 
+# Seconds between the checks that the fold processes are still running
+FOLD_POLL_INTERVAL = 5
+
 
 with pkg_resources.resource_stream(
         'd3m_ta2_nyu',
@@ -38,8 +44,7 @@ with pkg_resources.resource_stream(
 
 
 def check_timeindicator(dataset_path):
-    with open(dataset_path) as fin:
-        dataset_doc = json.load(fin)
+    dataset_doc = load_dataset_doc(dataset_path)
 
     columns = dataset_doc['dataResources'][0]['columns']
     timeindicator_index = None
@@ -62,7 +67,7 @@ def check_timeindicator(dataset_path):
 
 @database.with_db
 def score(pipeline_id, dataset_uri, sample_dataset_uri, metrics, problem, scoring_config, timeout_run, report_rank,
-          msg_queue, db):
+          msg_queue, db, fold_workers=1, evaluation_key=None):
     dataset_uri_touse = dataset_uri
 
     if sample_dataset_uri:
@@ -70,7 +75,8 @@ def score(pipeline_id, dataset_uri, sample_dataset_uri, metrics, problem, scorin
     if TaskKeyword.FORECASTING in problem['problem']['task_keywords']:
         check_timeindicator(dataset_uri_touse[7:])
 
-    dataset = Dataset.load(dataset_uri_touse)
+    dataset = load_dataset(dataset_uri_touse)
+    fidelity = get_dataset_size(dataset)
     # Get pipeline from database
     pipeline = (
         db.query(database.Pipeline)
@@ -104,10 +110,12 @@ def score(pipeline_id, dataset_uri, sample_dataset_uri, metrics, problem, scorin
 
     if metrics[0]['metric'] == PerformanceMetric.F1 and TaskKeyword.SEMISUPERVISED in problem['problem']['task_keywords']:
         new_metrics = [{'metric': PerformanceMetric.F1_MACRO}]
-        scores = evaluate(pipeline, kfold_tabular_split, dataset, new_metrics, problem, scoring_config, dataset_uri, timeout_run)
+        scores = evaluate(pipeline, kfold_tabular_split, dataset, new_metrics, problem, scoring_config,
+                          dataset_uri_touse, timeout_run, fold_workers)
         scores = change_name_metric(scores, new_metrics, new_metric=metrics[0]['metric'].name)
     else:
-        scores = evaluate(pipeline, pipeline_split, dataset, metrics, problem, scoring_config, dataset_uri, timeout_run)
+        scores = evaluate(pipeline, pipeline_split, dataset, metrics, problem, scoring_config, dataset_uri_touse,
+                          timeout_run, fold_workers)
 
     logger.info("Evaluation results:\n%s", scores)
 
@@ -117,16 +125,28 @@ def score(pipeline_id, dataset_uri, sample_dataset_uri, metrics, problem, scorin
             scores = create_rank_metric(scores, metrics)
             scores_db = add_scores_db(scores, scores_db)
             logger.info("Evaluation results for RANK metric: \n%s", scores)
+        if evaluation_key is not None:
+            evaluation_cache.store_scores(db, evaluation_key, scores_db, fidelity)
 
     # TODO Should we rename CrossValidation table?
-    record_db = database.CrossValidation(pipeline_id=pipeline_id, scores=scores_db)  # Store scores
+    record_db = database.CrossValidation(pipeline_id=pipeline_id, fidelity=fidelity, scores=scores_db)  # Store scores
     db.add(record_db)
     db.commit()
 
 
-def evaluate(pipeline, data_pipeline, dataset, metrics, problem, scoring_config, dataset_uri, timeout_run):
+def evaluate(pipeline, data_pipeline, dataset, metrics, problem, scoring_config, dataset_uri, timeout_run,
+             fold_workers=1, fold_callback=None):
+    """Score a pipeline, returns the scores of each fold.
+
+    `dataset_uri` is the URI `dataset` was loaded from.
+
+    If `fold_callback` is set, it is called with the index and the scores of each fold as they are evaluated, and the
+    remaining folds are skipped if it returns False.
+    """
+    sampled = False
     if is_collection(dataset_uri[7:]):
         dataset = get_dataset_sample(dataset, problem)
+        sampled = True
 
     json_pipeline = convert.to_d3m_json(pipeline)
 
@@ -139,25 +159,17 @@ def evaluate(pipeline, data_pipeline, dataset, metrics, problem, scoring_config,
     d3m_pipeline = Pipeline.from_json_structure(json_pipeline, )
     if 'method' in scoring_config:
         scoring_config.pop('method')
+    # Key of the data for the prefix cache, from the version of the files (hashing the data would take too long)
+    data_key = prefix_cache.get_data_key(dataset_uri, sampled, data_pipeline.id, scoring_config)
 
-    manager = Manager()
-    return_dict = manager.dict()
-    p = Process(target=worker, args=(d3m_pipeline, data_pipeline, scoring_pipeline, problem, dataset, scoring_config, metrics, return_dict))
-    p.start()
-    p.join(timeout_run)
-    p.terminate()
-
-    if 'run_results' not in return_dict or 'run_scores' not in return_dict:
-        raise TimeoutError('Reached timeout (%d seconds) to score a pipeline' % timeout_run)
+    # We are already in a separate process, the timeout is enforced here and by the scheduler
+    with time_limit(timeout_run, 'Reached timeout (%d seconds) to score a pipeline'):
+        run_scores, errors = run_evaluation(json_pipeline, d3m_pipeline, data_pipeline, scoring_pipeline, problem,
+                                            dataset, scoring_config, metrics, fold_workers, fold_callback, data_key)
 
-    run_results = return_dict['run_results']
-    run_scores = return_dict['run_scores']
+    for error in errors:
+        raise RuntimeError(error)
 
-    for result in run_results:
-        if result.has_error():
-            raise RuntimeError(result.pipeline_run.status['message'])
-
-    #save_pipeline_runs(run_results.pipeline_runs)
     combined_folds = d3m.runtime.combine_folds([fold for fold in run_scores])
     scores = {}
 
@@ -169,21 +181,169 @@ def evaluate(pipeline, data_pipeline, dataset, metrics, problem, scoring_config,
     return scores
 
 
-def worker(d3m_pipeline, data_pipeline, scoring_pipeline, problem, dataset, scoring_config, metrics, return_dict):
-    run_scores, run_results = d3m.runtime.evaluate(
-        pipeline=d3m_pipeline,
+def run_evaluation(json_pipeline, d3m_pipeline, data_pipeline, scoring_pipeline, problem, dataset, scoring_config,
+                   metrics, fold_workers, fold_callback=None, data_key=None):
+    number_of_folds = int(scoring_config.get('number_of_folds', 1))
+    cache = prefix_cache.get_prefix_cache()
+    split = None
+    if cache is not None:
+        split = prefix_cache.split_pipeline(json_pipeline)
+    if split is not None or fold_callback is not None or (fold_workers > 1 and number_of_folds > 1):
+        run_scores, errors = evaluate_folds(d3m_pipeline, split, cache, data_pipeline, scoring_pipeline, problem,
+                                            dataset, scoring_config, metrics, min(fold_workers, number_of_folds),
+                                            fold_callback, data_key)
+    else:
+        run_scores, run_results = d3m.runtime.evaluate(
+            pipeline=d3m_pipeline,
+            data_pipeline=data_pipeline,
+            scoring_pipeline=scoring_pipeline,
+            problem_description=problem,
+            inputs=[dataset],
+            data_params=scoring_config,
+            metrics=metrics,
+            volumes_dir=os.environ.get('D3MSTATICDIR', None),
+            context=d3m.metadata.base.Context.TESTING,
+            random_seed=0,
+        )
+        #save_pipeline_runs(run_results.pipeline_runs)
+        errors = [result.pipeline_run.status['message'] for result in run_results if result.has_error()]
+
+    return run_scores, errors
+
+
+# Data of the folds being evaluated, inherited by the forked fold processes
+_folds_data = None
+
+
+def evaluate_folds(d3m_pipeline, split, cache, data_pipeline, scoring_pipeline, problem, dataset, scoring_config,
+                   metrics, fold_workers, fold_callback=None, data_key=None):
+    """Same as `d3m.runtime.evaluate()`, but can evaluate the folds in parallel and reuse the prefix outputs.
+
+    If `split` is set, the outputs of its prefix are taken from the `cache` (or stored there, under the `data_key` of
+    the dataset) and only the suffix is run. With more than one worker, only the scores tables are sent back from the fold processes. If `fold_callback`
+    returns False for a fold, the next folds are not evaluated.
+    """
+    global _folds_data
+
+    outputs, data_result = d3m.runtime.prepare_data(
+        [dataset],
         data_pipeline=data_pipeline,
-        scoring_pipeline=scoring_pipeline,
         problem_description=problem,
-        inputs=[dataset],
         data_params=scoring_config,
-        metrics=metrics,
-        volumes_dir=os.environ.get('D3MSTATICDIR', None),
         context=d3m.metadata.base.Context.TESTING,
         random_seed=0,
+        volumes_dir=os.environ.get('D3MSTATICDIR', None),
     )
-    return_dict['run_scores'] = run_scores
-    return_dict['run_results'] = run_results
+    if data_result.has_error():
+        return [], [data_result.pipeline_run.status['message']]
+
+    folds = list(zip(*outputs))
+    _folds_data = d3m_pipeline, split, cache, data_key, scoring_pipeline, problem, metrics, folds
+    try:
+        if fold_workers > 1:
+            logger.info('Evaluating %d folds with %d processes', len(folds), fold_workers)
+            results = _evaluate_folds_parallel(len(folds), fold_workers)
+            try:
+                return _collect_folds(results, fold_callback)
+            finally:
+                # Stops the fold processes still running, if the callback skipped the remaining folds
+                results.close()
+        else:
+            return _collect_folds((evaluate_fold(fold_index) for fold_index in range(len(folds))), fold_callback)
+    finally:
+        _folds_data = None
+
+
+def _evaluate_folds_parallel(fold_count, fold_workers):
+    """Evaluate the folds with up to `fold_workers` processes, yielding the results in order.
+
+    Those are not daemonic processes like the workers of `multiprocessing.Pool`, so the primitives can start their own.
+    """
+    queue = Queue()
+    processes = {}
+    results = {}
+    next_fold = 0
+    try:
+        for fold_index in range(fold_count):
+            while fold_index not in results:
+                while next_fold < fold_count and len(processes) < fold_workers:
+                    process = Process(target=_run_fold, args=(next_fold, queue))
+                    process.start()
+                    processes[next_fold] = process
+                    next_fold += 1
+                try:
+                    index, result = queue.get(timeout=FOLD_POLL_INTERVAL)
+                except Empty:
+                    # Processes that exit normally sent their result, the others died
+                    for index, process in list(processes.items()):
+                        if process.exitcode not in (None, 0):
+                            results[index] = None, "Fold process died, returned %d" % process.exitcode
+                            del processes[index]
+                else:
+                    results[index] = result
+                    processes.pop(index).join()
+            yield results.pop(fold_index)
+    finally:
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+def _run_fold(fold_index, queue):
+    try:
+        result = evaluate_fold(fold_index)
+    except Exception:
+        result = None, traceback.format_exc()
+    queue.put((fold_index, result))
+
+
+def _collect_folds(results, fold_callback):
+    run_scores = []
+    for fold_index, (scores, error) in enumerate(results):
+        if error is not None:
+            return run_scores, [error]
+        run_scores.append(scores)
+        if fold_callback is not None and not fold_callback(fold_index, scores):
+            logger.info('Skipping the remaining folds after fold %d', fold_index)
+            break
+
+    return run_scores, []
+
+
+def evaluate_fold(fold_index):
+    d3m_pipeline, split, cache, data_key, scoring_pipeline, problem, metrics, folds = _folds_data
+    train_inputs, test_inputs, score_inputs = folds[fold_index]
+    context = d3m.metadata.base.Context.TESTING
+    volumes_dir = os.environ.get('D3MSTATICDIR', None)
+
+    if split is not None:
+        train_values, test_values, error = prefix_cache.run_prefix(split, cache, data_key, fold_index, train_inputs,
+                                                                   test_inputs, problem)
+        if error is not None:
+            return None, error
+        # Primitives get the pipeline's random seed plus their step index, offset it so they get the same seeds
+        fitted_pipeline, _, result = d3m.runtime.fit(split.suffix, train_values, problem_description=problem,
+                                                     context=context, random_seed=split.offset,
+                                                     volumes_dir=volumes_dir, is_standard_pipeline=False)
+    else:
+        fitted_pipeline, _, result = d3m.runtime.fit(d3m_pipeline, [train_inputs], problem_description=problem,
+                                                     context=context, random_seed=0, volumes_dir=volumes_dir)
+        test_values = [test_inputs]
+    if result.has_error():
+        return None, result.pipeline_run.status['message']
+
+    predictions, result = d3m.runtime.produce(fitted_pipeline, test_values)
+    if result.has_error():
+        return None, result.pipeline_run.status['message']
+
+    scores, result = d3m.runtime.score(predictions, [score_inputs], scoring_pipeline=scoring_pipeline,
+                                       problem_description=problem, metrics=metrics, predictions_random_seed=0,
+                                       context=context, random_seed=0, volumes_dir=volumes_dir)
+    if result.has_error():
+        return None, result.pipeline_run.status['message']
+
+    return scores, None
 
 
 def create_rank_metric(scores, metrics):
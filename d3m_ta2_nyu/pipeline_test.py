@@ -1,21 +1,136 @@
+import collections
 import logging
 import os
 import pickle
 from os.path import join
-from d3m.container import Dataset, DataFrame
+from d3m.container import DataFrame, Dataset
+from d3m.metadata.pipeline import PrimitiveStep
+from d3m.metadata.problem import TaskKeyword
 from d3m_ta2_nyu.workflow import database
+from d3m_ta2_nyu.data_ingestion.dataset_cache import load_dataset
+from d3m_ta2_nyu.fitted_solution import get_fitted_solution_stat, load_fitted_solution
+from d3m_ta2_nyu.utils import get_dataset_size, get_entry_point
 
 logger = logging.getLogger(__name__)
 
+# Size (of the files) of the fitted pipelines kept loaded by all the worker processes, split between them
+MAX_FITTED_RUNTIMES_SIZE = int(os.environ.get('TA2_FITTED_RUNTIMES_CACHE_SIZE', 2 * 1024 ** 3))
+# Outputs smaller than this (pickled) can be sent back with the results, instead of written to CSV files
+MAX_INLINE_OUTPUT_SIZE = 1024 ** 2
+
+# Test datasets bigger than this (rows of the main resource) are produced in chunks, if the pipeline allows it
+PRODUCE_CHUNK_SIZE = 100000
+
+# Tasks where each row is predicted on its own
+ROW_WISE_TASK_KEYWORDS = {
+    TaskKeyword.CLASSIFICATION, TaskKeyword.REGRESSION, TaskKeyword.BINARY, TaskKeyword.MULTICLASS,
+    TaskKeyword.MULTILABEL, TaskKeyword.UNIVARIATE, TaskKeyword.MULTIVARIATE, TaskKeyword.TABULAR, TaskKeyword.TEXT,
+    TaskKeyword.IMAGE, TaskKeyword.AUDIO,
+}
+
+# Primitives whose produce() looks at other rows than the one it predicts
+CROSS_ROW_FAMILIES = {
+    'CLUSTERING', 'COLLABORATIVE_FILTERING', 'COMMUNITY_DETECTION', 'DATA_AUGMENTATION', 'GRAPH_CLUSTERING',
+    'GRAPH_MATCHING', 'LINK_PREDICTION', 'OBJECT_DETECTION', 'SEMISUPERVISED_CLASSIFICATION',
+    'TIME_SERIES_FORECASTING', 'TIME_SERIES_SEGMENTATION', 'VERTEX_NOMINATION',
+}
+
+# path -> (mtime, size, runtime), least recently used first
+_fitted_runtimes = collections.OrderedDict()
+
+
+def load_fitted_runtime(storage_dir, pipeline_id, max_size=MAX_FITTED_RUNTIMES_SIZE):
+    """Load a fitted pipeline, keeping the most recently used ones in memory.
+
+    Workers of the pool run many jobs, so producing again with the same
+    pipeline doesn't need to unpickle it again.
+
+    :param max_size: Size of the files of the fitted pipelines to keep loaded.
+    """
+    path, mtime, size = get_fitted_solution_stat(storage_dir, pipeline_id)
+    entry = _fitted_runtimes.get(path)
+    if entry is not None and entry[0] == mtime:
+        logger.info('Using loaded fitted pipeline %s', pipeline_id)
+        _fitted_runtimes.move_to_end(path)
+        return entry[2]
+
+    runtime = load_fitted_solution(storage_dir, pipeline_id)
+    _fitted_runtimes[path] = mtime, size, runtime
+
+    # Evict the least recently used pipelines, always keep the new one
+    total_size = sum(size for _, size, _ in _fitted_runtimes.values())
+    while total_size > max_size and len(_fitted_runtimes) > 1:
+        _, (_, size, _) = _fitted_runtimes.popitem(last=False)
+        total_size -= size
+
+    return runtime
+
+
+def can_produce_in_chunks(runtime):
+    """Check that the predictions of a fitted pipeline for a row only depend on that row.
+    """
+    problem = runtime.problem_description
+    if problem is None or not set(problem['problem']['task_keywords']) <= ROW_WISE_TASK_KEYWORDS:
+        return False
+    for step in runtime.pipeline.steps:
+        if not isinstance(step, PrimitiveStep):
+            return False
+        if step.primitive.metadata.to_json_structure()['primitive_family'] in CROSS_ROW_FAMILIES:
+            return False
+    return True
+
+
+def iter_dataset_chunks(dataset, chunk_size):
+    """Split a dataset in chunks of rows of its main resource, the other resources are shared.
+    """
+    res_id = get_entry_point(dataset)
+    data = dataset[res_id]
+    for start in range(0, len(data), chunk_size):
+        chunk = data.iloc[start:start + chunk_size]
+        resources = dict(dataset)
+        resources[res_id] = chunk
+        metadata = dataset.metadata.update((res_id,), {'dimension': {'length': len(chunk)}})
+        yield Dataset(resources, metadata)
+
+
+def produce_in_chunks(runtime, dataset, steps_to_expose, output_paths, chunk_size=PRODUCE_CHUNK_SIZE):
+    """Produce a chunk at a time, appending the exposed outputs to their CSV files.
+
+    This way only the intermediate data of one chunk is in memory at a time.
+    """
+    files = {}
+    try:
+        for i, chunk in enumerate(iter_dataset_chunks(dataset, chunk_size)):
+            logger.info('Producing chunk %d', i)
+            results = runtime.produce(inputs=[chunk], outputs_to_expose=steps_to_expose)
+            results.check_success()
+            for step_id in results.values:
+                if step_id in steps_to_expose and isinstance(results.values[step_id], DataFrame):
+                    if step_id not in files:
+                        files[step_id] = open(output_paths[step_id], 'w', newline='')
+                        results.values[step_id].to_csv(files[step_id])
+                    else:
+                        results.values[step_id].to_csv(files[step_id], header=False)
+    finally:
+        for fout in files.values():
+            fout.close()
+
 
 @database.with_db
-def test(pipeline_id, dataset, storage_dir, steps_to_expose, msg_queue, db):
-    dataset = Dataset.load(dataset)
+def test(pipeline_id, dataset, storage_dir, steps_to_expose, msg_queue, db, inline_outputs=False, pool_size=1):
+    dataset = load_dataset(dataset)
     logger.info('Loaded dataset')
 
-    runtime = None
-    with open(os.path.join(storage_dir, 'fitted_solution_%s.pkl' % pipeline_id), 'rb') as fin:
-        runtime = pickle.load(fin)
+    # Each worker of the pool gets its share of the cache
+    runtime = load_fitted_runtime(storage_dir, pipeline_id, MAX_FITTED_RUNTIMES_SIZE // pool_size)
+
+    output_paths = {step_id: join(storage_dir, 'produce_%s_%s.csv' % (pipeline_id, step_id))
+                    for step_id in steps_to_expose}
+    if 'TA2_NO_CHUNKED_PRODUCE' not in os.environ and \
+            (get_dataset_size(dataset) or 0) > PRODUCE_CHUNK_SIZE and can_produce_in_chunks(runtime):
+        logger.info('Producing in chunks of %d rows, storing results at %s', PRODUCE_CHUNK_SIZE, storage_dir)
+        produce_in_chunks(runtime, dataset, steps_to_expose, output_paths)
+        return
 
     results = runtime.produce(inputs=[dataset], outputs_to_expose=steps_to_expose)
     results.check_success()
@@ -23,4 +138,13 @@ def test(pipeline_id, dataset, storage_dir, steps_to_expose, msg_queue, db):
     logger.info('Storing produce results at %s', storage_dir)
     for step_id in results.values:
         if step_id in steps_to_expose and isinstance(results.values[step_id], DataFrame):
-            results.values[step_id].to_csv(join(storage_dir, 'produce_%s_%s.csv' % (pipeline_id, step_id)))
+            if inline_outputs:
+                # Send the path of the pickle, big messages would block until the job is polled
+                blob_path = join(storage_dir, 'produce_%s_%s.pkl' % (pipeline_id, step_id))
+                with open(blob_path, 'wb') as fout:
+                    pickle.dump(results.values[step_id], fout)
+                if os.path.getsize(blob_path) <= MAX_INLINE_OUTPUT_SIZE:
+                    msg_queue.send(('inline_output', step_id, blob_path))
+                    continue
+                os.remove(blob_path)
+            results.values[step_id].to_csv(output_paths[step_id])
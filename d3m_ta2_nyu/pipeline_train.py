@@ -1,13 +1,14 @@
 import os
 import logging
-import pickle
 import d3m.runtime
 import d3m.metadata.base
 from os.path import join
 from sqlalchemy.orm import joinedload
-from d3m.container import Dataset, DataFrame
+from d3m.container import DataFrame
 from d3m.metadata import base as metadata_base
 from d3m_ta2_nyu.workflow import database, convert
+from d3m_ta2_nyu.data_ingestion.dataset_cache import load_dataset
+from d3m_ta2_nyu.fitted_solution import save_fitted_solution
 
 
 logger = logging.getLogger(__name__)
@@ -27,7 +28,7 @@ def train(pipeline_id, dataset, problem, storage_dir, steps_to_expose, msg_queue
                 pipeline_id, dataset)
 
     # Load data
-    dataset = Dataset.load(dataset)
+    dataset = load_dataset(dataset)
     logger.info('Loaded dataset')
 
     # Training step - fit pipeline on training data
@@ -52,5 +53,4 @@ def train(pipeline_id, dataset, problem, storage_dir, steps_to_expose, msg_queue
         if step_id in steps_to_expose and isinstance(results.values[step_id], DataFrame):
             results.values[step_id].to_csv(join(storage_dir, 'fit_%s_%s.csv' % (pipeline_id, step_id)))
 
-    with open(join(storage_dir, 'fitted_solution_%s.pkl' % pipeline_id), 'wb') as fout:
-        pickle.dump(fitted_pipeline, fout)
+    save_fitted_solution(fitted_pipeline, storage_dir, pipeline_id)
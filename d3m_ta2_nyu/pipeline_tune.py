@@ -2,27 +2,25 @@ import logging
 import os
 import sys
 import shutil
-import pickle
 from os.path import join
-from d3m import index
 from copy import deepcopy
 from sqlalchemy.orm import joinedload
-from d3m.container import Dataset
+from d3m_ta2_nyu.data_ingestion.dataset_cache import load_dataset
 from d3m_ta2_nyu.pipeline_score import evaluate, kfold_tabular_split, score
-from d3m_ta2_nyu.workflow import database
+from d3m_ta2_nyu.workflow import database, convert
 from d3m_ta2_nyu.parameter_tuning.primitive_config import is_tunable
 from d3m_ta2_nyu.parameter_tuning.bayesian import HyperparameterTuning, get_new_hyperparameters
+from d3m_ta2_nyu.parameter_tuning.pruning import MedianPruner
+from d3m_ta2_nyu.parameter_tuning.tuning_trials import get_tuning_context, get_initial_configurations, store_trials
 from d3m.metadata.problem import PerformanceMetric, TaskKeyword
 from d3m_ta2_nyu.ta2 import create_outputfolders
 
 logger = logging.getLogger(__name__)
 
-PRIMITIVES = index.search()
-
 
 @database.with_db
 def tune(pipeline_id, metrics, problem, dataset_uri, sample_dataset_uri, report_rank, timeout_tuning, timeout_run,
-         msg_queue, db):
+         msg_queue, db, n_jobs=1):
     timeout_tuning = timeout_tuning * 0.9  # FIXME: Save 10% of timeout to score the best config
     # Load pipeline from database
     pipeline = (
@@ -46,9 +44,9 @@ def tune(pipeline_id, metrics, problem, dataset_uri, sample_dataset_uri, report_
     logger.info('Tuning primitives: %s', ', '.join(tunable_primitives.values()))
 
     if sample_dataset_uri:
-        dataset = Dataset.load(sample_dataset_uri)
+        dataset = load_dataset(sample_dataset_uri)
     else:
-        dataset = Dataset.load(dataset_uri)
+        dataset = load_dataset(dataset_uri)
 
     task_keywords = problem['problem']['task_keywords']
     scoring_config = {'shuffle': 'true',
@@ -59,6 +57,24 @@ def tune(pipeline_id, metrics, problem, dataset_uri, sample_dataset_uri, report_
     metrics_to_use = deepcopy(metrics)
     if metrics[0]['metric'] == PerformanceMetric.F1 and TaskKeyword.SEMISUPERVISED in problem['problem']['task_keywords']:
         metrics_to_use = [{'metric': PerformanceMetric.F1_MACRO}]
+    first_metric = metrics_to_use[0]['metric'].name
+    number_of_folds = int(scoring_config['number_of_folds'])
+
+    # Stop evaluating the configurations that are worse than the others on their first folds
+    pruner = None
+    fold_callback = None
+    pruning_path = join(os.environ.get('D3MOUTPUTDIR'), 'temp', 'tuning', 'pruning_%s.jsonl' % pipeline_id)
+    if 'TA2_TUNING_PRUNING' in os.environ:
+        # The evaluations run in child processes, they share the history through a file
+        if os.path.exists(pruning_path):
+            os.remove(pruning_path)
+        pruner = MedianPruner(pruning_path)
+
+        def fold_callback(fold_index, fold_scores):
+            for _, row in fold_scores.iterrows():
+                if row['metric'] == first_metric:
+                    return pruner.report(1.0 - metrics_to_use[0]['metric'].normalize(row['value']))
+            return True
 
     def evaluate_tune(hyperparameter_configuration):
         new_hyperparams = []
@@ -68,14 +84,21 @@ def tune(pipeline_id, metrics, problem, dataset_uri, sample_dataset_uri, report_
                 pipeline=pipeline,
                 module_id=primitive_id,
                 name='hyperparams',
-                value=pickle.dumps(hy),
+                value=database.encode_value(hy),
             )
             new_hyperparams.append(db_hyperparams)
 
         pipeline.parameters += new_hyperparams
-        scores = evaluate(pipeline, kfold_tabular_split, dataset, metrics_to_use, problem, scoring_config, dataset_uri,
-                          timeout_run)
-        first_metric = metrics_to_use[0]['metric'].name
+        if pruner is not None:
+            pruner.start()
+        scores = evaluate(pipeline, kfold_tabular_split, dataset, metrics_to_use, problem, scoring_config,
+                          sample_dataset_uri or dataset_uri, timeout_run, fold_callback=fold_callback)
+        if pruner is not None:
+            if len(scores) < number_of_folds:
+                cost = pruner.get_pruned_cost()
+                logger.info('Tuning stopped after %d folds:\n%s, cost=%s', len(scores), scores, cost)
+                return cost
+            pruner.finish()
         score_values = []
         for fold_scores in scores.values():
             for metric, score_value in fold_scores.items():
@@ -90,10 +113,22 @@ def tune(pipeline_id, metrics, problem, dataset_uri, sample_dataset_uri, report_
 
     # Run tuning, gets best configuration
     tuning = HyperparameterTuning(tunable_primitives.values())
+    # Start from the best configurations of previous tunings
+    trials_dataset, trials_task = get_tuning_context(dataset_uri, problem)
+    initial_configurations = get_initial_configurations(
+        db, set(tunable_primitives.values()),
+        tuning.configspace.get_default_configuration().get_dictionary(),
+        trials_dataset, trials_task,
+    )
     create_outputfolders(join(os.environ.get('D3MOUTPUTDIR'), 'temp', 'tuning'))
-    best_configuration = tuning.tune(evaluate_tune, wallclock=timeout_tuning,
+    if n_jobs > 1:
+        # Load everything evaluate_tune() needs now, the forked processes shouldn't use the database
+        convert.to_d3m_json(pipeline)
+    best_configuration = tuning.tune(evaluate_tune, wallclock=timeout_tuning, n_jobs=n_jobs,
                                      output_dir=join(os.environ.get('D3MOUTPUTDIR'),
-                                                     'temp', 'tuning', str(pipeline_id)))
+                                                     'temp', 'tuning', str(pipeline_id)),
+                                     initial_configurations=initial_configurations)
+    store_trials(db, set(tunable_primitives.values()), tuning.trials, trials_dataset, trials_task)
 
     # Duplicate pipeline in database
     new_pipeline = database.duplicate_pipeline(db, pipeline, 'HyperparameterTuning from pipeline %s' % pipeline_id)
@@ -104,22 +139,25 @@ def tune(pipeline_id, metrics, problem, dataset_uri, sample_dataset_uri, report_
             query = db.query(database.PipelineParameter).filter(database.PipelineParameter.module_id == primitive.id)\
                 .filter(database.PipelineParameter.pipeline_id == new_pipeline.id)\
                 .filter(database.PipelineParameter.name == 'hyperparams')
-            if query.first():
-                original_parameters = pickle.loads(query.first().value)
+            parameter = query.first()
+            if parameter:
+                original_parameters = database.decode_value(parameter.value)
                 original_parameters.update(best_hyperparameters)
-                query.update({database.PipelineParameter.value: pickle.dumps(original_parameters)})
+                parameter.value = database.encode_value(original_parameters)
             else:
                 db.add(database.PipelineParameter(
                     pipeline=new_pipeline,
                     module_id=primitive.id,
                     name='hyperparams',
-                    value=pickle.dumps(best_hyperparameters),
+                    value=database.encode_value(best_hyperparameters),
                 ))
     db.commit()
 
     logger.info('Tuning done, generated new pipeline %s', new_pipeline.id)
 
     shutil.rmtree(join(os.environ.get('D3MOUTPUTDIR'), 'temp', 'tuning', str(pipeline_id)))
+    if os.path.exists(pruning_path):
+        os.remove(pruning_path)
 
     score(new_pipeline.id, dataset_uri, sample_dataset_uri, metrics, problem, scoring_config, timeout_run, report_rank, None,
           db_filename=join(os.environ.get('D3MOUTPUTDIR'), 'temp', 'db.sqlite3'))
@@ -0,0 +1,270 @@
+"""Cache of the outputs of the preprocessing steps shared by pipelines.
+
+Most pipelines start with the same steps (denormalize, dataset_to_dataframe,
+add_semantic_types, column_parser, extract_columns_by_semantic_types). Those
+primitives don't learn anything during fit, so their outputs only depend on
+their hyperparameters and on the data. When scoring a pipeline, we run that
+prefix once per fold and store its outputs on disk, keyed by the content of
+the prefix, the version of the dataset files and the fold. Pipelines that share the prefix then only run the
+rest of their steps, which takes the prefix outputs as inputs.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import uuid
+import d3m.runtime
+import d3m.metadata.base
+from d3m.metadata.pipeline import Pipeline
+from d3m_ta2_nyu.data_ingestion.dataset_cache import get_dataset_version
+
+
+logger = logging.getLogger(__name__)
+
+# Primitives whose produce() doesn't depend on what they saw during fit()
+STATELESS_PRIMITIVES = {
+    'd3m.primitives.data_transformation.denormalize.Common',
+    'd3m.primitives.data_transformation.dataset_to_dataframe.Common',
+    'd3m.primitives.data_transformation.add_semantic_types.Common',
+    'd3m.primitives.data_transformation.column_parser.Common',
+    'd3m.primitives.data_transformation.extract_columns_by_semantic_types.Common',
+}
+
+MAX_CACHE_SIZE = 2 * 1024 ** 3  # 2 GB
+
+
+def _hash(obj):
+    data = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def _step_index(data):
+    """Get the step index from a data reference like 'steps.3.produce'.
+    """
+    if data.startswith('steps.'):
+        return int(data.split('.')[1])
+    return None
+
+
+def _rename_reference(data, renames, offset):
+    """Point a data reference of the full pipeline into the suffix pipeline.
+    """
+    if data in renames:
+        return renames[data]
+    index = _step_index(data)
+    if index is None or index < offset:
+        raise ValueError("Reference %r can't be moved to suffix pipeline" % data)
+    return 'steps.%d.%s' % (index - offset, data.split('.', 2)[2])
+
+
+def _rename_data(data, renames, offset):
+    if isinstance(data, list):
+        return [_rename_reference(d, renames, offset) for d in data]
+    return _rename_reference(data, renames, offset)
+
+
+class PipelineSplit(object):
+    """A pipeline split in a cacheable prefix and the suffix that runs on it.
+    """
+    def __init__(self, prefix, suffix, key, offset):
+        self.prefix = prefix
+        self.suffix = suffix
+        self.key = key
+        self.offset = offset
+
+
+def split_pipeline(json_pipeline):
+    """Split a pipeline (JSON structure) after its leading stateless steps.
+
+    :return: A `PipelineSplit`, or None if the pipeline can't be split.
+    """
+    steps = json_pipeline['steps']
+
+    # Find the longest prefix of stateless primitives only using the input
+    offset = 0
+    for step in steps:
+        if step['type'] != 'PRIMITIVE' or step['primitive']['python_path'] not in STATELESS_PRIMITIVES:
+            break
+        if any(v['type'] != 'VALUE' for v in step.get('hyperparams', {}).values()):
+            break
+        arguments = [arg['data'] for arg in step.get('arguments', {}).values()]
+        if any(isinstance(data, list) or
+               (data != 'inputs.0' and (_step_index(data) is None or _step_index(data) >= offset))
+               for data in arguments):
+            break
+        offset += 1
+    if offset == 0 or offset == len(steps):
+        return None
+
+    # Find which outputs of the prefix are used by the suffix, they become the inputs of the suffix
+    boundary = []
+
+    def use(data):
+        for d in data if isinstance(data, list) else [data]:
+            index = _step_index(d)
+            if index is not None and index < offset and d not in boundary:
+                boundary.append(d)
+
+    for step in steps[offset:]:
+        for arg in step.get('arguments', {}).values():
+            use(arg['data'])
+        for hyperparam in step.get('hyperparams', {}).values():
+            if hyperparam['type'] in ('DATA', 'CONTAINER'):
+                use(hyperparam['data'])
+    for output in json_pipeline['outputs']:
+        use(output['data'])
+    if not boundary:
+        return None
+    renames = {data: 'inputs.%d' % i for i, data in enumerate(boundary)}
+
+    try:
+        suffix_steps = []
+        for step in steps[offset:]:
+            step = dict(step)
+            if 'arguments' in step:
+                step['arguments'] = {
+                    name: dict(arg, data=_rename_data(arg['data'], renames, offset))
+                    for name, arg in step['arguments'].items()
+                }
+            if 'hyperparams' in step:
+                hyperparams = {}
+                for name, hyperparam in step['hyperparams'].items():
+                    data = hyperparam['data']
+                    if hyperparam['type'] in ('DATA', 'CONTAINER'):
+                        data = _rename_data(data, renames, offset)
+                    elif hyperparam['type'] == 'PRIMITIVE':
+                        indices = data if isinstance(data, list) else [data]
+                        if any(i < offset for i in indices):
+                            return None
+                        data = [i - offset for i in data] if isinstance(data, list) else data - offset
+                    hyperparams[name] = dict(hyperparam, data=data)
+                step['hyperparams'] = hyperparams
+            suffix_steps.append(step)
+        suffix_outputs = [dict(output, data=_rename_data(output['data'], renames, offset))
+                          for output in json_pipeline['outputs']]
+    except ValueError:
+        return None
+
+    # Content key of the prefix: its steps (primitive digests, hyperparameters, connections) and the outputs used
+    key = _hash([steps[:offset], boundary])
+
+    prefix = dict(json_pipeline, id=str(uuid.UUID(key[:32])), name='prefix %s' % key, steps=steps[:offset],
+                  outputs=[{'data': data} for data in boundary])
+    suffix = dict(json_pipeline, steps=suffix_steps, outputs=suffix_outputs,
+                  inputs=[{'name': data} for data in boundary])
+    try:
+        return PipelineSplit(Pipeline.from_json_structure(prefix), Pipeline.from_json_structure(suffix), key, offset)
+    except Exception:
+        logger.exception("Error splitting pipeline")
+        return None
+
+
+def get_data_key(dataset_uri, *args):
+    """Key for a dataset (and the parameters used to split it).
+
+    This uses the version of the dataset files (their modification times and
+    sizes), like the dataset and evaluation caches, instead of hashing the data.
+
+    :return: The key, or None if the dataset is not a D3M dataset on the local
+        disk.
+    """
+    dataset_version = get_dataset_version(dataset_uri)
+    if dataset_version is None:
+        return None
+    return _hash([dataset_version, args])
+
+
+def run_prefix(split, cache, data_key, fold_index, train_inputs, test_inputs, problem):
+    """Get the outputs of the prefix on a fold, from the cache or by running it.
+
+    :return: A tuple ``(train_values, test_values, error)``.
+    """
+    key = None
+    if cache is not None and data_key is not None:
+        key = _hash([split.key, data_key, fold_index])
+        values = cache.get(key)
+        if values is not None:
+            return values + (None,)
+
+    fitted_prefix, _, result = d3m.runtime.fit(split.prefix, [train_inputs], problem_description=problem,
+                                               context=d3m.metadata.base.Context.TESTING, random_seed=0,
+                                               volumes_dir=os.environ.get('D3MSTATICDIR', None),
+                                               is_standard_pipeline=False)
+    if result.has_error():
+        return None, None, result.pipeline_run.status['message']
+    train_values = [result.values['outputs.%d' % i] for i in range(len(split.prefix.outputs))]
+
+    _, result = d3m.runtime.produce(fitted_prefix, [test_inputs])
+    if result.has_error():
+        return None, None, result.pipeline_run.status['message']
+    test_values = [result.values['outputs.%d' % i] for i in range(len(split.prefix.outputs))]
+
+    if key is not None:
+        try:
+            cache.put(key, (train_values, test_values))
+        except Exception:
+            logger.exception("Error storing prefix outputs")
+    return train_values, test_values, None
+
+
+class PrefixCache(object):
+    """Files holding prefix outputs, evicting the least recently used ones.
+    """
+    def __init__(self, folder, max_size=MAX_CACHE_SIZE):
+        self.folder = folder
+        self.max_size = max_size
+
+    def get(self, key):
+        path = os.path.join(self.folder, key + '.pkl')
+        try:
+            with open(path, 'rb') as fin:
+                value = pickle.load(fin)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.warning("Invalid prefix cache entry %s", path)
+            return None
+        try:
+            os.utime(path)  # Mark as recently used
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, key + '.pkl')
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'wb') as fout:
+            pickle.dump(value, fout, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for filename in os.listdir(self.folder):
+            if filename.endswith('.pkl'):
+                try:
+                    stat = os.stat(os.path.join(self.folder, filename))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.folder, filename))
+            except OSError:
+                pass
+            total_size -= size
+
+
+def get_prefix_cache():
+    """Get the cache for this search, or None if it is disabled.
+    """
+    if 'TA2_NO_PREFIX_CACHE' in os.environ or 'D3MOUTPUTDIR' not in os.environ:
+        return None
+    return PrefixCache(os.path.join(os.environ['D3MOUTPUTDIR'], 'temp', 'prefix_cache'))
@@ -1,6 +1,9 @@
 import os
 import logging
 import json
+import functools
+import pkg_resources
+import d3m
 from d3m import index
 
 logger = logging.getLogger(__name__)
@@ -8,8 +11,9 @@ logger = logging.getLogger(__name__)
 
 PRIMITIVES_BY_NAME_PATH = os.path.join(os.path.dirname(__file__), '../resource/primitives_by_name.json')
 PRIMITIVES_BY_TYPE_PATH = os.path.join(os.path.dirname(__file__), '../resource/primitives_by_type.json')
-
-INSTALLED_PRIMITIVES = sorted(index.search(), key=lambda x: x.endswith('SKlearn'), reverse=True)
+PRIMITIVES_METADATA_PATH = os.path.join(os.path.dirname(__file__), '../resource/primitives_metadata.json')
+# Increase when the content of the metadata index changes
+METADATA_INDEX_VERSION = 1
 
 BLACK_LIST = {
     'd3m.primitives.classification.random_classifier.Test',
@@ -49,20 +53,129 @@ BLACK_LIST = {
 }
 
 
+@functools.lru_cache(maxsize=1)
+def get_installed_primitives():
+    return sorted(index.search(), key=lambda x: x.endswith('SKlearn'), reverse=True)
+
+
+def get_primitive_distributions():
+    """Get the distribution (name and version) providing each installed primitive.
+
+    This reads the entry points, it doesn't import the primitives.
+    """
+    distributions = {}
+    for entry_point in pkg_resources.iter_entry_points('d3m.primitives'):
+        dist = entry_point.dist
+        distributions['d3m.primitives.%s' % entry_point.name] = \
+            '%s==%s' % (dist.project_name, dist.version) if dist is not None else None
+    return distributions
+
+
 def get_primitive_class(name):
     return index.get_primitive(name)
 
 
+def get_type_name(type_):
+    if isinstance(type_, type):
+        return '%s.%s' % (type_.__module__, type_.__qualname__)
+    return str(type_)
+
+
+def _get_metadata_entry(name):
+    metadata = get_primitive_class(name).metadata
+    primitive_dict = metadata.to_json_structure()
+    primitive_code = primitive_dict['primitive_code']
+
+    return {
+        'id': primitive_dict['id'],
+        'name': primitive_dict['name'],
+        'version': primitive_dict['version'],
+        'python_path': primitive_dict['python_path'],
+        'digest': primitive_dict.get('digest'),
+        'primitive_family': primitive_dict['primitive_family'],
+        'algorithm_types': primitive_dict['algorithm_types'],
+        'class_type_arguments': {
+            key: get_type_name(value)
+            for key, value in metadata.query()['primitive_code']['class_type_arguments'].items()
+        },
+        'arguments': primitive_code.get('arguments', {}),
+        'produce_methods': [method for method, description in primitive_code['instance_methods'].items()
+                            if description['kind'] == 'PRODUCE'],
+        'hyperparams': primitive_code.get('hyperparams', {}),
+    }
+
+
+def build_primitives_metadata(distributions=None):
+    """Write the metadata index of the installed primitives.
+
+    This imports every primitive, once, so that the other processes can get
+    their metadata without importing them.
+
+    :param distributions: The result of `get_primitive_distributions()`,
+        stored to know when the index is outdated.
+    """
+    if distributions is None:
+        distributions = get_primitive_distributions()
+    primitives = {}
+    for primitive_name in get_installed_primitives():
+        try:
+            primitives[primitive_name] = _get_metadata_entry(primitive_name)
+        except:
+            logger.error('Loading metadata about primitive %s', primitive_name)
+
+    data = {'version': METADATA_INDEX_VERSION, 'd3m_version': d3m.__version__, 'distributions': distributions,
+            'primitives': primitives}
+    temp_path = '%s.%d.tmp' % (PRIMITIVES_METADATA_PATH, os.getpid())
+    with open(temp_path, 'w') as fout:
+        json.dump(data, fout, sort_keys=True)
+    os.replace(temp_path, PRIMITIVES_METADATA_PATH)
+    logger.info('Wrote metadata index of %d primitives', len(primitives))
+
+    return primitives
+
+
+@functools.lru_cache(maxsize=1)
+def _get_primitives_metadata():
+    # Primitives installed, removed or upgraded since the index was written make it outdated
+    distributions = get_primitive_distributions()
+    if os.path.isfile(PRIMITIVES_METADATA_PATH):
+        with open(PRIMITIVES_METADATA_PATH) as fin:
+            data = json.load(fin)
+        if data['version'] == METADATA_INDEX_VERSION and data['d3m_version'] == d3m.__version__ and \
+                data.get('distributions') == distributions:
+            logger.info('Loading primitives metadata from file')
+            return data['primitives']
+        logger.info('Primitives metadata index is outdated, rebuilding it')
+
+    return build_primitives_metadata(distributions)
+
+
+def get_primitive_metadata(name):
+    """Get the metadata of a primitive, from the index (without importing it).
+
+    :return: A dict with the ``id``, ``name``, ``version``, ``python_path``,
+        ``digest``, ``primitive_family``, ``algorithm_types``,
+        ``class_type_arguments`` (as type names), ``arguments``,
+        ``produce_methods`` and ``hyperparams`` (description) of the
+        primitive.
+    """
+    primitives = _get_primitives_metadata()
+    if name not in primitives:
+        # Not installed when the index was written, get it from the class
+        primitives[name] = _get_metadata_entry(name)
+    return primitives[name]
+
+
 def get_primitive_family(name):
-    return get_primitive_class(name).metadata.to_json_structure()['primitive_family']
+    return get_primitive_metadata(name)['primitive_family']
 
 
 def get_primitive_algorithms(name):
-    return get_primitive_class(name).metadata.to_json_structure()['algorithm_types']
+    return get_primitive_metadata(name)['algorithm_types']
 
 
 def get_primitive_info(name):
-    primitive_dict = get_primitive_class(name).metadata.to_json_structure()
+    primitive_dict = get_primitive_metadata(name)
 
     return {
             'id': primitive_dict['id'],
@@ -82,7 +195,7 @@ def get_primitives_by_type():
         return primitives
 
     primitives = {}
-    for primitive_name in INSTALLED_PRIMITIVES:
+    for primitive_name in get_installed_primitives():
         if primitive_name not in BLACK_LIST:
             try:
                 family = get_primitive_family(primitive_name)
@@ -165,7 +278,7 @@ def get_primitives_by_name():
 
     primitives = []
 
-    for primitive_name in INSTALLED_PRIMITIVES:
+    for primitive_name in get_installed_primitives():
         if primitive_name not in BLACK_LIST:
             try:
                 primitive_info = get_primitive_info(primitive_name)
@@ -11,10 +11,9 @@ import json
 import csv
 import logging
 import os
-import pickle
 from queue import Empty, Queue
 from sqlalchemy import select
-from sqlalchemy.orm import aliased, joinedload, lazyload
+from sqlalchemy.orm import joinedload, lazyload
 from sqlalchemy.sql import func
 from os.path import join, exists
 import shutil
@@ -24,19 +23,30 @@ import time
 import d3m_automl_rpc.core_pb2_grpc as pb_core_grpc
 from uuid import uuid4, UUID
 from d3m_ta2_nyu import __version__
-from d3m_ta2_nyu.multiprocessing import Receiver, run_process
+from d3m_ta2_nyu.evaluation_cache import get_evaluation_key, get_scores
+from d3m_ta2_nyu.fitted_solution import get_exported_fitted_solution
+from d3m_ta2_nyu.multiprocessing import Receiver, WorkerPool, run_process
 from d3m_ta2_nyu.grpc_api import grpc_server
-from d3m_ta2_nyu.utils import Observable, ProgressStatus, is_collection, get_dataset_sample
+from d3m_ta2_nyu.utils import Observable, ProgressStatus, is_collection, get_dataset_sample, get_sample_size
 from d3m_ta2_nyu.workflow import database
-from d3m_ta2_nyu.workflow.convert import to_d3m_json
+from d3m_ta2_nyu.workflow.convert import get_cached_d3m_json, to_d3m_json
 from d3m_ta2_nyu.data_ingestion.data_reader import create_d3mdataset, create_d3mproblem
-from d3m.container import Dataset
+from d3m_ta2_nyu.data_ingestion.dataset_cache import load_dataset
 from d3m.metadata.problem import TaskKeyword, parse_problem_description
 
 
 MAX_RUNNING_PROCESSES = 6
+# The scheduler is woken up by job exits and new jobs, this is only a fallback
+JOB_POLL_INTERVAL = 10
 MINUTES_SCORE_PIPELINE = 10
+# Sample sizes of the first rungs of successive halving, the last rung uses all the data
+HALVING_SAMPLE_SIZES = [500, 2000, 10000]
+# Fraction (1/HALVING_RATE) of the pipelines of a rung promoted to the next one
+HALVING_RATE = 3
 TUNE_PIPELINES_COUNT = 5
+# Modules imported once by the worker processes, before they get jobs
+WORKER_PRELOAD = ['d3m_ta2_nyu.pipeline_score', 'd3m_ta2_nyu.pipeline_train',
+                  'd3m_ta2_nyu.pipeline_test', 'd3m_ta2_nyu.pipeline_tune']
 
 if 'TA2_DEBUG_BE_FAST' in os.environ:
     TUNE_PIPELINES_COUNT = 0
@@ -86,6 +96,8 @@ class Session(Observable):
         self.pipelines_tuning = set()
         # Pipelines already tuned, and pipelines created through tuning
         self.tuned_pipelines = set()
+        # Pipelines going through the rungs of successive halving, as (pipeline ID, first rung)
+        self.pipelines_halving = set()
         # Flag indicating we started scoring & tuning, and a
         # 'done_searching' signal should be sent once no pipeline is pending
         self.working = False
@@ -102,6 +114,11 @@ class Session(Observable):
         self.sample_dataset_uri = None
         self.timeout_run = None
         self.expected_search_end = None
+        # Rungs of successive halving, (sample size, sample URI) from the smallest to the full data
+        self.fidelities = None
+        # Scores by pipeline at each rung, and the pipelines already promoted from each rung
+        self.rung_scores = {}
+        self.rung_promoted = {}
 
     @property
     def problem_id(self):
@@ -179,6 +196,33 @@ class Session(Observable):
             if event == 'scoring_success':
                 self.write_scored_pipeline(pipeline_id)
 
+    def promote(self, rung, pipeline_id, score):
+        """Records a score at a rung of successive halving.
+
+        Like asynchronous successive halving (ASHA), the top fraction of a rung
+        is checked again each time it gets a score, so pipelines scored before
+        the rung had enough results can still be promoted later.
+
+        :return: The pipelines to promote to the next rung, i.e. the pipelines
+            in the top fraction of that rung that were not promoted yet. This
+            can include pipelines scored earlier.
+        """
+        with self.lock:
+            scores = self.rung_scores.setdefault(rung, {})
+            scores[pipeline_id] = score
+            if rung + 1 >= len(self.fidelities):
+                return []
+            ranked = sorted(scores, key=scores.get, reverse=self.metrics[0]['metric'].best_value() == 1)
+            promoted = self.rung_promoted.setdefault(rung, set())
+            new_promoted = [p for p in ranked[:len(scores) // HALVING_RATE] if p not in promoted]
+            promoted.update(new_promoted)
+            return new_promoted
+
+    def pipeline_halving_done(self, pipeline_id, first_rung=0):
+        with self.lock:
+            self.pipelines_halving.discard((pipeline_id, first_rung))
+            self.check_status()
+
     def pipeline_tuning_done(self, old_pipeline_id, new_pipeline_id=None):
         with self.lock:
             self.pipelines_tuning.discard(old_pipeline_id)
@@ -202,28 +246,24 @@ class Session(Observable):
         )
 
     def get_top_pipelines(self, db, metric, limit=None):
-        metric_name = metric.name
-        pipeline = aliased(database.Pipeline)
-        crossval_score = (
-            select([func.avg(database.CrossValidationScore.value)])
-            .where(database.CrossValidationScore.cross_validation_id ==
-                   database.CrossValidation.id)
-            .where(database.CrossValidationScore.metric == metric_name)
-            .where(database.CrossValidation.pipeline_id == pipeline.id)
-            .as_scalar()
-        )
+        score = database.PipelineScore
         if metric.best_value() == 1:
-            crossval_score_order = crossval_score.desc()
+            score_order = score.mean.desc()
         else:
-            crossval_score_order = crossval_score.asc()  # Error based metrics
+            score_order = score.mean.asc()  # Error based metrics
         q = (
-            db.query(pipeline, crossval_score)
-            .filter(pipeline.id.in_(self.pipelines))
-            .filter(crossval_score != None)
+            db.query(database.Pipeline, score.mean)
+            .join(score, score.pipeline_id == database.Pipeline.id)
+            .filter(score.metric == metric.name)
+            .filter(database.Pipeline.id.in_(self.pipelines))
             # FIXME: Using a joined load here results in duplicated results
-            .options(lazyload(pipeline.parameters))
-            .order_by(crossval_score_order)
+            .options(lazyload(database.Pipeline.parameters))
         )
+        if 'TA2_SUCCESSIVE_HALVING' in os.environ:
+            # Pipelines are ranked on the highest fidelity they were scored at
+            q = q.order_by(score.fidelity.desc(), score_order)
+        else:
+            q = q.order_by(score_order)
         if limit is not None:
             q = q.limit(limit)
         return q.all()
@@ -237,7 +277,7 @@ class Session(Observable):
             if not self.working:
                 return
             # If pipelines are still in the queue
-            if self.pipelines_scoring or self.pipelines_tuning:
+            if self.pipelines_scoring or self.pipelines_tuning or self.pipelines_halving:
                 return
 
             db = self.DBSession()
@@ -289,55 +329,67 @@ class Session(Observable):
             finally:
                 db.close()
 
+    def get_pipeline_json(self, pipeline_id):
+        """Get the JSON document of a pipeline.
+
+        The pipeline is only loaded from the database if it was not converted
+        already by this process.
+        """
+        obj = get_cached_d3m_json(pipeline_id)
+        if obj is not None:
+            return obj
+        db = self.DBSession()
+        try:
+            pipeline = (
+                db.query(database.Pipeline)
+                .filter(database.Pipeline.id == pipeline_id)
+                .options(joinedload(database.Pipeline.modules),
+                         joinedload(database.Pipeline.connections),
+                         joinedload(database.Pipeline.parameters))
+            ).one()
+            return to_d3m_json(pipeline)
+        finally:
+            db.close()
+
     def write_searched_pipeline(self, pipeline_id):
         if not self._searched_pipelines_dir:
             logger.info("Not writing log file")
             return
 
-        db = self.DBSession()
         try:
-            # Get pipeline
-            pipeline = db.query(database.Pipeline).get(pipeline_id)
+            obj = self.get_pipeline_json(pipeline_id)
 
             logger.warning("Writing searched_pipeline JSON for pipeline %s "
                            "origin=%s",
-                           pipeline_id, pipeline.origin)
+                           pipeline_id, obj['description'])
 
             filename = os.path.join(self._searched_pipelines_dir,
                                     '%s.json' % pipeline_id)
-            obj = to_d3m_json(pipeline)
             with open(filename, 'w') as fp:
                 json.dump(obj, fp, indent=2)
         except Exception:
             logger.exception("Error writing searched_pipeline for %s",
                              pipeline_id)
-        finally:
-            db.close()
 
     def write_scored_pipeline(self, pipeline_id):
         if not self._scored_pipelines_dir:
             logger.info("Not writing log file")
             return
 
-        db = self.DBSession()
         try:
-            # Get pipeline
-            pipeline = db.query(database.Pipeline).get(pipeline_id)
+            obj = self.get_pipeline_json(pipeline_id)
 
             logger.warning("Writing scored_pipeline JSON for pipeline %s "
                            "origin=%s",
-                           pipeline_id, pipeline.origin)
+                           pipeline_id, obj['description'])
 
             filename = os.path.join(self._scored_pipelines_dir,
                                     '%s.json' % pipeline_id)
-            obj = to_d3m_json(pipeline)
             with open(filename, 'w') as fp:
                 json.dump(obj, fp, indent=2)
         except Exception:
             logger.exception("Error writing scored_pipeline for %s",
                              pipeline_id)
-        finally:
-            db.close()
 
     def write_exported_pipeline(self, pipeline_id, rank=None):
         metric = self.metrics[0]['metric'].name
@@ -362,8 +414,7 @@ class Session(Observable):
                         crossval_id
                     )
                     .where(database.CrossValidationScore.metric == metric)
-                    .as_scalar()
-                )
+                ).scalar()
                 if score is None:
                     rank = 1000.0
                     logger.error("Writing pipeline JSON for pipeline %s, but "
@@ -373,9 +424,9 @@ class Session(Observable):
                 else:
                     logger.warning("Writing pipeline JSON for pipeline %s "
                                    "%s=%s origin=%s",
-                                   pipeline_id, metric, score.value,
+                                   pipeline_id, metric, score,
                                    pipeline.origin)
-                    rank = 1.0 - self.metrics[0]['metric'].normalize(score.value)
+                    rank = 1.0 - self.metrics[0]['metric'].normalize(score)
             else:
                 logger.warning("Writing pipeline JSON for pipeline %s with "
                                "provided rank %s. origin=%s",
@@ -423,10 +474,13 @@ class Job(object):
 
 
 class ScoreJob(Job):
+    # Time allowed on top of timeout_run, to load the data and store scores
+    timeout_margin = 5 * 60
+    # Time allowed when there is no timeout_run (scoring requests outside of a search)
     timeout = 10 * 60
 
     def __init__(self, ta2, pipeline_id, dataset_uri, metrics, problem, scoring_config, timeout_run, report_rank=False,
-                 sample_dataset_uri=None):
+                 sample_dataset_uri=None, evaluation_key=None):
         Job.__init__(self)
         self.ta2 = ta2
         self.pipeline_id = pipeline_id
@@ -437,10 +491,13 @@ class ScoreJob(Job):
         self.scoring_config = scoring_config
         self.timeout_run = timeout_run
         self.report_rank = report_rank
+        self.evaluation_key = evaluation_key
 
-    def start(self, db_filename, **kwargs):
+    def start(self, db_filename, worker_pool=None, cpus=1, **kwargs):
         self.msg = Receiver()
         self.proc = run_process('d3m_ta2_nyu.pipeline_score.score', 'score', self.msg,
+                                worker_pool=worker_pool,
+                                fold_workers=cpus,
                                 pipeline_id=self.pipeline_id,
                                 dataset_uri=self.dataset_uri,
                                 sample_dataset_uri=self.sample_dataset_uri,
@@ -449,6 +506,7 @@ class ScoreJob(Job):
                                 scoring_config=self.scoring_config,
                                 timeout_run=self.timeout_run,
                                 report_rank=self.report_rank,
+                                evaluation_key=self.evaluation_key,
                                 db_filename=db_filename)
         self.started = time.time()
         self.ta2.notify('scoring_start',
@@ -457,8 +515,13 @@ class ScoreJob(Job):
 
     def poll(self):
         if self.proc.poll() is None:
-            return False
-        if self.started + self.timeout < time.time():
+            # The process can't always stop itself (time_limit() is best-effort), this is the hard limit
+            if self.timeout_run:
+                timeout = self.timeout_run + self.timeout_margin
+            else:
+                timeout = self.timeout
+            if time.time() < self.started + timeout:
+                return False
             logger.error("Scoring process is stuck, terminating after %d "
                          "seconds", time.time() - self.started)
             self.proc.terminate()
@@ -495,10 +558,11 @@ class TrainJob(Job):
         self.problem = problem
         self.steps_to_expose = steps_to_expose
 
-    def start(self, db_filename, **kwargs):
+    def start(self, db_filename, worker_pool=None, **kwargs):
         logger.info("Training pipeline for %s", self.pipeline_id)
         self.msg = Receiver()
         self.proc = run_process('d3m_ta2_nyu.pipeline_train.train', 'train', self.msg,
+                                worker_pool=worker_pool,
                                 pipeline_id=self.pipeline_id,
                                 dataset=self.dataset,
                                 problem=self.problem,
@@ -538,21 +602,28 @@ class TrainJob(Job):
 
 
 class TestJob(Job):
-    def __init__(self, ta2, pipeline_id, dataset, steps_to_expose):
+    def __init__(self, ta2, pipeline_id, dataset, steps_to_expose, inline_outputs=False):
         Job.__init__(self)
         self.ta2 = ta2
         self.pipeline_id = pipeline_id
         self.dataset = dataset
         self.steps_to_expose = steps_to_expose
+        self.inline_outputs = inline_outputs
+        self.outputs = {}
 
-    def start(self, db_filename, **kwargs):
+    def start(self, db_filename, worker_pool=None, **kwargs):
         logger.info("Testing pipeline for %s", self.pipeline_id)
         self.msg = Receiver()
+        # Prefer a worker that has this fitted pipeline loaded already
         self.proc = run_process('d3m_ta2_nyu.pipeline_test.test', 'test', self.msg,
+                                worker_pool=worker_pool,
+                                affinity=('fitted', self.pipeline_id),
                                 pipeline_id=self.pipeline_id,
                                 dataset=self.dataset,
                                 storage_dir=self.ta2.runtime_folder,
                                 steps_to_expose=self.steps_to_expose,
+                                inline_outputs=self.inline_outputs,
+                                pool_size=worker_pool.size if worker_pool is not None else 1,
                                 db_filename=db_filename)
         self.ta2.notify('testing_start',
                         pipeline_id=self.pipeline_id,
@@ -563,18 +634,26 @@ class TestJob(Job):
             return False
 
         _, stderr = self.proc.communicate()
+        # Read the outputs sent right before the process finished
+        try:
+            while True:
+                self.message(*self.msg.recv(0))
+        except Empty:
+            pass
         log = logger.info if self.proc.returncode == 0 else logger.error
         log("Pipeline testing process done, returned %d (pipeline: %s)",
             self.proc.returncode, self.pipeline_id)
         if self.proc.returncode == 0:
             steps_to_expose = []
             for step_id in self.steps_to_expose:
-                if exists(join(self.ta2.runtime_folder, 'produce_%s_%s.csv' % (self.pipeline_id, step_id))):
+                if step_id in self.outputs or \
+                        exists(join(self.ta2.runtime_folder, 'produce_%s_%s.csv' % (self.pipeline_id, step_id))):
                     steps_to_expose.append(step_id)
             self.ta2.notify('testing_success',
                             pipeline_id=self.pipeline_id,
                             storage_dir=self.ta2.runtime_folder,
                             steps_to_expose=steps_to_expose,
+                            outputs=self.outputs,
                             job_id=id(self))
         else:
             error_logs = stderr.decode()
@@ -584,6 +663,16 @@ class TestJob(Job):
                             error_msg=error_logs)
         return True
 
+    def message(self, msg, *args):
+        if msg == 'inline_output':
+            step_id, path = args
+            with open(path, 'rb') as fin:
+                self.outputs[step_id] = fin.read()
+            os.remove(path)
+        else:
+            logger.error("Unexpected message from testing process %s",
+                         msg)
+
 
 class TuneHyperparamsJob(Job):
     def __init__(self, session, pipeline_id, problem, store_results=True, timeout_tuning=60):
@@ -594,7 +683,7 @@ class TuneHyperparamsJob(Job):
         self.store_results = store_results
         self.timeout_tuning = timeout_tuning
 
-    def start(self, db_filename, predictions_root, **kwargs):
+    def start(self, db_filename, predictions_root, worker_pool=None, cpus=1, **kwargs):
         self.runtime_folder = predictions_root
         logger.info("Running tuning for %s "
                     "(session %s has %d pipelines left to tune)",
@@ -609,6 +698,7 @@ class TuneHyperparamsJob(Job):
 
         self.proc = run_process('d3m_ta2_nyu.pipeline_tune.tune',
                                 'tune', self.msg,
+                                worker_pool=worker_pool,
                                 pipeline_id=self.pipeline_id,
                                 metrics=self.session.metrics,
                                 problem=self.problem,
@@ -617,6 +707,7 @@ class TuneHyperparamsJob(Job):
                                 sample_dataset_uri=self.session.sample_dataset_uri,
                                 timeout_tuning=self.timeout_tuning,
                                 timeout_run=MINUTES_SCORE_PIPELINE * 60,
+                                n_jobs=cpus,
                                 db_filename=db_filename)
         self.session.notify('tuning_start',
                             pipeline_id=self.pipeline_id,
@@ -626,8 +717,7 @@ class TuneHyperparamsJob(Job):
         if self.proc.poll() is None:
             return False
 
-        self.proc.stdin.close()
-        self.proc.stderr.close()
+        self.proc.communicate()
 
         log = logger.info if self.proc.returncode == 0 else logger.error
         log("Pipeline tuning process done, returned %d (pipeline: %s)",
@@ -663,6 +753,18 @@ class TuneHyperparamsJob(Job):
                          msg)
 
 
+class JobQueue(Queue):
+    """Queue of jobs waiting to run, that wakes up the scheduler on put.
+    """
+    def __init__(self, wakeup_event):
+        Queue.__init__(self)
+        self._wakeup_event = wakeup_event
+
+    def _put(self, item):
+        Queue._put(self, item)
+        self._wakeup_event.set()
+
+
 class ThreadPoolExecutor(futures.ThreadPoolExecutor):
     def submit(self, fn, *args, **kwargs):
         def wrapper(*args, **kwargs):
@@ -688,11 +790,19 @@ class D3mTa2(Observable):
 
         logger.info("output_folder=%r", self.output_folder)
 
-        self.dbengine, self.DBSession = database.connect(self.db_filename)
+        self.dbengine, self.DBSession = database.connect(self.db_filename, migrate=True)
 
         self.sessions = {}
-        self.executor = ThreadPoolExecutor(max_workers=int(os.environ['D3MCPU']))
-        self._run_queue = Queue()
+        self.cpu_budget = int(os.environ['D3MCPU'])
+        self.executor = ThreadPoolExecutor(max_workers=self.cpu_budget)
+        if 'TA2_NO_WORKER_POOL' in os.environ:
+            self.worker_pool = None
+        else:
+            self.worker_pool = WorkerPool(MAX_RUNNING_PROCESSES,
+                                          preload=WORKER_PRELOAD)
+        self._run_event = threading.Event()
+        self._run_queue = JobQueue(self._run_event)
+        self._scheduler_stats = {'running': 0, 'started': 0, 'finished': 0, 'cpus': 0}
         self._run_thread = threading.Thread(target=self._pipeline_running_thread)
         self._run_thread.setDaemon(True)
         self._run_thread.start()
@@ -815,17 +925,32 @@ class D3mTa2(Observable):
         self._run_queue.put(job)
         return id(job)
 
-    def test_pipeline(self, pipeline_id, dataset, steps_to_expose):
-        job = TestJob(self, pipeline_id, dataset, steps_to_expose)
+    def test_pipeline(self, pipeline_id, dataset, steps_to_expose, inline_outputs=False):
+        job = TestJob(self, pipeline_id, dataset, steps_to_expose, inline_outputs)
         self._run_queue.put(job)
         return id(job)
 
     def get_fitted_pipeline_uri(self, pipeline_id):
-        fitted_pipeline_uri = join(self.runtime_folder, 'fitted_solution_%s.pkl' % pipeline_id)
-        if exists(fitted_pipeline_uri):
-            return 'file://' + fitted_pipeline_uri
+        # Clients expect a single pickle file
+        exported = get_exported_fitted_solution(self.runtime_folder, pipeline_id)
+        if exported is None:
+            return None
+        fitted_pipeline_path, up_to_date = exported
+        if not up_to_date:
+            # Writing it loads the fitted pipeline and imports the primitives, do it in a separate process
+            msg_queue = Receiver()
+            try:
+                proc = run_process('d3m_ta2_nyu.fitted_solution.export', 'export', msg_queue,
+                                   storage_dir=self.runtime_folder, pipeline_id=pipeline_id)
+                _, stderr = proc.communicate()
+            finally:
+                msg_queue.close()
+            if proc.returncode != 0:
+                logger.error("Couldn't export fitted pipeline %s, process returned %d:\n%s",
+                             pipeline_id, proc.returncode, stderr.decode())
+                return None
 
-        return None
+        return 'file://' + fitted_pipeline_path
 
     def build_pipelines(self, session_id, dataset, task_keywords, metrics, timeout_search, timeout_run, template=None,
                         targets=None, features=None, tune=None, report_rank=False):
@@ -883,7 +1008,7 @@ class D3mTa2(Observable):
         def set_hyperparams(module, **hyperparams):
             db.add(database.PipelineParameter(
                 pipeline=pipeline_database, module=module,
-                name='hyperparams', value=pickle.dumps(hyperparams),
+                name='hyperparams', value=database.encode_value(hyperparams),
             ))
 
         try:
@@ -892,11 +1017,11 @@ class D3mTa2(Observable):
                 input_data = make_data_module('dataset')
                 db.add(database.PipelineParameter(
                     pipeline=pipeline_database, module=input_data,
-                    name='targets', value=pickle.dumps(targets),
+                    name='targets', value=database.encode_value(targets),
                 ))
                 db.add(database.PipelineParameter(
                     pipeline=pipeline_database, module=input_data,
-                    name='features', value=pickle.dumps(features),
+                    name='features', value=database.encode_value(features),
                 ))
             prev_step = None
             prev_steps = {}
@@ -974,6 +1099,8 @@ class D3mTa2(Observable):
             expected_search_end = now + timeout_search
 
         sample_dataset_uri = self._get_sample_uri(dataset_uri, session.problem)
+        if 'TA2_SUCCESSIVE_HALVING' in os.environ:
+            session.fidelities = self._get_fidelities(dataset_uri, session.problem)
 
         session.dataset_uri = dataset_uri
         session.sample_dataset_uri = sample_dataset_uri
@@ -1001,52 +1128,78 @@ class D3mTa2(Observable):
             problem=session.problem,
             targets=session.targets,
             features=session.features,
+            max_pending_evaluations=MAX_RUNNING_PROCESSES,
             db_filename=self.db_filename,
         )
 
         start = time.time()
         stopped = False
+        send_lock = threading.Lock()
+        threads = []
 
-        # Now we wait for pipelines to be sent over the pipe
-        while proc.poll() is None:
-            if not stopped:
-                if session.stop_requested:
-                    logger.error("Session stop requested, sending SIGTERM to "
-                                 "generator process")
-                    proc.terminate()
-                    stopped = True
-
-                if timeout_search is not None and time.time() > start + timeout_search:
-                    logger.error("Reached search timeout (%d > %d seconds), "
-                                 "sending SIGTERM to generator process",
-                                 time.time() - start, timeout_search)
-                    proc.terminate()
-                    stopped = True
+        try:
+            # Now we wait for pipelines to be sent over the pipe
+            while proc.poll() is None:
+                if not stopped:
+                    if session.stop_requested:
+                        logger.error("Session stop requested, sending SIGTERM to "
+                                     "generator process")
+                        proc.terminate()
+                        stopped = True
+
+                    if timeout_search is not None and time.time() > start + timeout_search:
+                        logger.error("Reached search timeout (%d > %d seconds), "
+                                     "sending SIGTERM to generator process",
+                                     time.time() - start, timeout_search)
+                        proc.terminate()
+                        stopped = True
 
-            try:
-                msg, *args = msg_queue.recv(3)
-            except Empty:
-                continue
-
-            if msg == 'eval':
-                if stopped:
-                    return
-                pipeline_id, = args
-                logger.info("Got pipeline %s from generator process",
-                            pipeline_id)
-                score = self.run_pipeline(session, dataset_uri, sample_dataset_uri, task, pipeline_id)
-
-                logger.info("Sending score to generator process")
-                try:  # Fixme, just to avoid Broken pipe error
-                    msg_queue.send(score)
-                except:
-                    logger.error("Broken pipe")
-                    return
-            else:
-                raise RuntimeError("Got unknown message from generator "
-                                   "process: %r" % msg)
+                try:
+                    msg, *args = msg_queue.recv(3)
+                except Empty:
+                    continue
+
+                if msg == 'eval':
+                    if stopped:
+                        return
+                    pipeline_id, = args
+                    logger.info("Got pipeline %s from generator process",
+                                pipeline_id)
+                    # Add it to the session now, so the session doesn't end before the thread starts scoring it
+                    session.add_scoring_pipeline(pipeline_id)
+                    # Score it in the background, the generator doesn't wait
+                    thread = threading.Thread(target=self._score_generated_pipeline,
+                                              args=(session, dataset_uri, sample_dataset_uri, task, pipeline_id,
+                                                    msg_queue, send_lock))
+                    thread.setDaemon(True)
+                    thread.start()
+                    threads.append(thread)
+                else:
+                    raise RuntimeError("Got unknown message from generator "
+                                       "process: %r" % msg)
+
+            logger.warning("Generator process exited with %r", proc.returncode)
+        finally:
+            # Wait for the scores, before the session gets tuned
+            for thread in threads:
+                thread.join()
 
-        logger.warning("Generator process exited with %r", proc.returncode)
+    def _score_generated_pipeline(self, session, dataset_uri, sample_dataset_uri, task_keywords, pipeline_id,
+                                  msg_queue, send_lock):
+        try:
+            score = self.run_pipeline(session, dataset_uri, sample_dataset_uri, task_keywords, pipeline_id)
+        except Exception:
+            logger.exception("Error scoring pipeline %s", pipeline_id)
+            score = None
+            # It was added to the session before this thread started
+            session.pipeline_scoring_done(pipeline_id)
+
+        logger.info("Sending score to generator process")
+        with send_lock:
+            try:  # Fixme, just to avoid Broken pipe error
+                msg_queue.send(('score', pipeline_id, score))
+            except:
+                logger.error("Broken pipe")
 
     def run_pipeline(self, session, dataset_uri, sample_dataset_uri, task_keywords, pipeline_id):
 
@@ -1054,19 +1207,69 @@ class D3mTa2(Observable):
 
         This is used by the pipeline synthesis code.
         """
+        if session.fidelities is None:
+            sample_size = get_sample_size(session.problem) if sample_dataset_uri else None
+            return self._score_on_sample(session, dataset_uri, sample_dataset_uri, sample_size, task_keywords,
+                                         pipeline_id)
+
+        # Successive halving: score on bigger samples while the pipeline is in the top of each rung
+        with session.lock:
+            session.pipelines_halving.add((pipeline_id, 0))
+        return self._run_halving(session, dataset_uri, task_keywords, pipeline_id, 0)
+
+    def _run_halving(self, session, dataset_uri, task_keywords, pipeline_id, first_rung):
+        try:
+            score = None
+            for rung in range(first_rung, len(session.fidelities)):
+                sample_size, rung_dataset_uri = session.fidelities[rung]
+                score = self._score_on_sample(session, dataset_uri, rung_dataset_uri, sample_size, task_keywords,
+                                              pipeline_id)
+                if score is None:
+                    break
+                promoted = session.promote(rung, pipeline_id, score)
+                for other_id in promoted:
+                    if other_id != pipeline_id:
+                        self._start_late_promotion(session, dataset_uri, task_keywords, other_id, rung + 1)
+                if pipeline_id not in promoted:
+                    break
+                logger.info("Promoting pipeline %s to rung %d", pipeline_id, rung + 1)
+            return score
+        finally:
+            session.pipeline_halving_done(pipeline_id, first_rung)
+
+    def _start_late_promotion(self, session, dataset_uri, task_keywords, pipeline_id, rung):
+        # The pipeline was scored earlier, its thread is done, score it at the next rungs in a new one
+        with session.lock:
+            if session.stop_requested:
+                return
+            session.pipelines_halving.add((pipeline_id, rung))
+        logger.info("Promoting pipeline %s to rung %d, after more pipelines were scored", pipeline_id, rung)
+        threading.Thread(target=self._run_halving,
+                         args=(session, dataset_uri, task_keywords, pipeline_id, rung)).start()
+
+    def _score_on_sample(self, session, dataset_uri, sample_dataset_uri, sample_size, task_keywords, pipeline_id):
         timeout_run = MINUTES_SCORE_PIPELINE * 60
         scoring_config = {'shuffle': 'true',
                           'stratified': 'true' if TaskKeyword.CLASSIFICATION in task_keywords else 'false',
                           'method': 'K_FOLD',
                           'number_of_folds': '2'}
 
+        evaluation_key = self._get_evaluation_key(session, dataset_uri, sample_size, scoring_config, pipeline_id)
+
         # Add the pipeline to the session, score it
         with session.with_observer_queue() as queue:
             session.add_scoring_pipeline(pipeline_id)
             logger.info("Created pipeline %s", pipeline_id)
-            self._run_queue.put(ScoreJob(self, pipeline_id, dataset_uri, session.metrics, session.problem,
-                                         scoring_config, timeout_run, session.report_rank, sample_dataset_uri))
-            session.notify('new_pipeline', pipeline_id=pipeline_id)
+            if evaluation_key is not None and self._add_cached_scores(pipeline_id, evaluation_key):
+                logger.info("Got scores of pipeline %s from a previous evaluation", pipeline_id)
+                session.notify('new_pipeline', pipeline_id=pipeline_id)
+                self.notify('scoring_start', pipeline_id=pipeline_id, job_id=None)
+                self.notify('scoring_success', pipeline_id=pipeline_id, job_id=None)
+            else:
+                self._run_queue.put(ScoreJob(self, pipeline_id, dataset_uri, session.metrics, session.problem,
+                                             scoring_config, timeout_run, session.report_rank, sample_dataset_uri,
+                                             evaluation_key))
+                session.notify('new_pipeline', pipeline_id=pipeline_id)
 
             while True:
                 event, kwargs = queue.get(True)
@@ -1108,7 +1311,40 @@ class D3mTa2(Observable):
         finally:
             db.close()
 
-    def _get_sample_uri(self, dataset_uri, problem):
+    def _get_evaluation_key(self, session, dataset_uri, sample_size, scoring_config, pipeline_id):
+        try:
+            return get_evaluation_key(session.get_pipeline_json(pipeline_id), dataset_uri, sample_size,
+                                      session.problem, session.metrics, scoring_config, session.report_rank)
+        except Exception:
+            logger.exception("Error computing evaluation key of pipeline %s", pipeline_id)
+            return None
+
+    def _add_cached_scores(self, pipeline_id, evaluation_key):
+        db = self.DBSession()
+        try:
+            cached = get_scores(db, evaluation_key)
+            if cached is None:
+                return False
+            scores, fidelity = cached
+            db.add(database.CrossValidation(pipeline_id=pipeline_id, fidelity=fidelity, scores=scores))
+            db.commit()
+            return True
+        finally:
+            db.close()
+
+    def _get_fidelities(self, dataset_uri, problem):
+        fidelities = []
+        for sample_size in HALVING_SAMPLE_SIZES:
+            sample_dataset_uri = self._get_sample_uri(dataset_uri, problem, sample_size)
+            if sample_dataset_uri is None:  # The data is not bigger than the sample
+                break
+            fidelities.append((sample_size, sample_dataset_uri))
+        fidelities.append((None, None))
+        logger.info("Successive halving on samples of %s rows, then all the data",
+                    ', '.join(str(size) for size, _ in fidelities[:-1]) or 'no')
+        return fidelities
+
+    def _get_sample_uri(self, dataset_uri, problem, sample_size=None):
         logger.info('About to sample dataset %s', dataset_uri)
         task_keywords = problem['problem']['task_keywords']
 
@@ -1116,29 +1352,59 @@ class D3mTa2(Observable):
             logger.info('Not doing sampling for task %s', '_'.join([x.name for x in task_keywords]))
             return None
 
-        dataset = Dataset.load(dataset_uri)
-
         if is_collection(dataset_uri[7:]):
             logger.info('Not doing sampling for collections')
             return None
 
-        dataset_sample_folder = 'file://%s/temp/dataset_sample/' % os.environ.get('D3MOUTPUTDIR')
+        dataset = load_dataset(dataset_uri)
+
+        if sample_size is None:
+            dataset_sample_folder = 'file://%s/temp/dataset_sample/' % os.environ.get('D3MOUTPUTDIR')
+        else:
+            dataset_sample_folder = 'file://%s/temp/dataset_sample_%d/' % (os.environ.get('D3MOUTPUTDIR'),
+                                                                            sample_size)
         dataset_sample_uri = None
 
         if os.path.exists(dataset_sample_folder[6:]):
             shutil.rmtree(dataset_sample_folder[6:])
 
-        dataset_sample = get_dataset_sample(dataset, problem, dataset_sample_folder)
+        dataset_sample = get_dataset_sample(dataset, problem, dataset_sample_folder, sample_size)
 
         if isinstance(dataset_sample, str):  # Was the dataset sampled?
             dataset_sample_uri = dataset_sample
 
         return dataset_sample_uri
 
+    def get_scheduler_stats(self):
+        """Get the queue depth and process slot utilization of the scheduler.
+        """
+        stats = dict(self._scheduler_stats)
+        stats['queued'] = self._run_queue.qsize()
+        stats['max_running'] = MAX_RUNNING_PROCESSES
+        stats['cpu_budget'] = self.cpu_budget
+        stats['utilization'] = stats['running'] / MAX_RUNNING_PROCESSES
+        return stats
+
+    def _watch_job(self, job):
+        """Wake up the scheduler as soon as the job's process exits.
+        """
+        def watch():
+            try:
+                job.proc.wait()
+            finally:
+                self._run_event.set()
+
+        thread = threading.Thread(target=watch)
+        thread.setDaemon(True)
+        thread.start()
+
     # Runs in a background thread
     def _pipeline_running_thread(self):
         running_jobs = {}
+        running_cpus = {}
         while True:
+            self._run_event.clear()
+
             # Poll jobs, remove finished ones
             remove = []
             for job in running_jobs.values():
@@ -1146,19 +1412,38 @@ class D3mTa2(Observable):
                     remove.append(id(job))
             for job_id in remove:
                 del running_jobs[job_id]
+                del running_cpus[job_id]
+            self._scheduler_stats['finished'] += len(remove)
 
-            # Start new jobs if we are under the maximum
-            if len(running_jobs) < MAX_RUNNING_PROCESSES:
+            # Start new jobs until all the slots are taken
+            while len(running_jobs) < MAX_RUNNING_PROCESSES:
                 try:
                     job = self._run_queue.get(False)
                 except Empty:
-                    pass
-                else:
-                    job.start(db_filename=self.db_filename,
-                              predictions_root=self.runtime_folder)
-                    running_jobs[id(job)] = job
-
-            time.sleep(3)
+                    break
+                # Share the free CPUs between the jobs that can start now
+                # (scoring jobs use them to run folds in parallel)
+                free_cpus = self.cpu_budget - sum(running_cpus.values())
+                starting = min(MAX_RUNNING_PROCESSES - len(running_jobs),
+                               self._run_queue.qsize() + 1)
+                cpus = max(1, free_cpus // starting)
+                job.start(db_filename=self.db_filename,
+                          predictions_root=self.runtime_folder,
+                          worker_pool=self.worker_pool,
+                          cpus=cpus)
+                running_jobs[id(job)] = job
+                running_cpus[id(job)] = cpus
+                self._watch_job(job)
+                self._scheduler_stats['started'] += 1
+
+            self._scheduler_stats['running'] = len(running_jobs)
+            self._scheduler_stats['cpus'] = sum(running_cpus.values())
+            if remove:
+                logger.info("Scheduler: %d running, %d queued",
+                            len(running_jobs), self._run_queue.qsize())
+
+            # Sleep until a job exits or a new job is queued
+            self._run_event.wait(JOB_POLL_INTERVAL)
 
 
 def create_outputfolders(folder_path):
@@ -3,10 +3,14 @@
 
 import contextlib
 import logging
-import json
+import math
+import multiprocessing
 from queue import Empty, Queue
+import signal
 import threading
+import traceback
 from d3m.metadata.problem import TaskKeyword
+from d3m_ta2_nyu.data_ingestion.dataset_cache import load_dataset_doc
 from sklearn.model_selection import train_test_split
 
 SAMPLE_SIZE = 2000
@@ -138,29 +142,112 @@ class ProgressStatus(object):
         return '%d%%' % int(self.current / self.total)
 
 
+@contextlib.contextmanager
+def time_limit(seconds, message='Reached timeout (%d seconds)'):
+    """Raise `TimeoutError` if the block takes more than `seconds` to run.
+
+    This is best-effort only. It uses SIGALRM, so it does nothing outside of
+    the main thread or if something else is already handling that signal,
+    and it can't interrupt native code that doesn't return to the
+    interpreter (a stuck fit for example). Callers need a hard limit as
+    well, like the scheduler killing the job process or `run_with_timeout()`.
+    """
+    if (seconds is None or
+            threading.current_thread() is not threading.main_thread() or
+            signal.getsignal(signal.SIGALRM) not in (signal.SIG_DFL, signal.SIG_IGN)):
+        yield
+        return
+
+    def handler(signum, frame):
+        raise TimeoutError(message % seconds)
+
+    previous_handler = signal.signal(signal.SIGALRM, handler)
+    signal.alarm(max(1, int(math.ceil(seconds))))
+    try:
+        yield
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+def run_with_timeout(function, seconds, message='Reached timeout (%d seconds)'):
+    """Call `function()` in a child process, terminating it after `seconds`.
+
+    Unlike `time_limit()`, this also stops code stuck in native calls. The
+    return value is sent back through a queue, so it has to be picklable.
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_child, args=(function, queue))
+    process.start()
+    try:
+        success, result = queue.get(timeout=seconds)
+    except Empty:
+        process.terminate()
+        raise TimeoutError(message % seconds)
+    finally:
+        process.join()
+    if not success:
+        raise RuntimeError(result)
+    return result
+
+
+def _run_child(function, queue):
+    try:
+        queue.put((True, function()))
+    except Exception:
+        queue.put((False, traceback.format_exc()))
+
+
 def is_collection(dataset_path):
-    with open(dataset_path) as fin:
-        dataset_doc = json.load(fin)
-        for data_resource in dataset_doc['dataResources']:
-            if data_resource.get('isCollection', False):
-                return True
+    dataset_doc = load_dataset_doc(dataset_path)
+    for data_resource in dataset_doc['dataResources']:
+        if data_resource.get('isCollection', False):
+            return True
 
     return False
 
 
 def get_collection_type(dataset_path):
-    with open(dataset_path) as fin:
-        dataset_doc = json.load(fin)
-        for data_resource in dataset_doc['dataResources']:
-            if data_resource.get('isCollection', False):
-                return data_resource['resType']
+    dataset_doc = load_dataset_doc(dataset_path)
+    for data_resource in dataset_doc['dataResources']:
+        if data_resource.get('isCollection', False):
+            return data_resource['resType']
 
     return None
 
 
-def get_dataset_sample(dataset, problem, dataset_sample_path=None):
+def get_sample_size(problem):
+    """Get the number of rows of the sample used to score pipelines.
+    """
     task_keywords = problem['problem']['task_keywords']
-    sample_size = SAMPLE_SIZE
+    if any(tk in [TaskKeyword.VIDEO, TaskKeyword.IMAGE, TaskKeyword.AUDIO] for tk in task_keywords):
+        return 500
+    return SAMPLE_SIZE
+
+
+def get_entry_point(dataset):
+    """Get the ID of the main resource of a dataset.
+    """
+    for res_id in dataset:
+        if ('https://metadata.datadrivendiscovery.org/types/DatasetEntryPoint'
+                in dataset.metadata.query([res_id])['semantic_types']):
+            return res_id
+    return next(iter(dataset))
+
+
+def get_dataset_size(dataset):
+    """Get the number of rows of the main resource of a dataset.
+    """
+    try:
+        return len(dataset[get_entry_point(dataset)])
+    except Exception:
+        return None
+
+
+def get_dataset_sample(dataset, problem, dataset_sample_path=None, sample_size=None):
+    task_keywords = problem['problem']['task_keywords']
+    if sample_size is None:
+        sample_size = get_sample_size(problem)
 
     if any(tk in [TaskKeyword.OBJECT_DETECTION, TaskKeyword.FORECASTING] for tk in task_keywords):
         logger.info('Not doing sampling for task %s', '_'.join([x.name for x in task_keywords]))
@@ -168,15 +255,7 @@ def get_dataset_sample(dataset, problem, dataset_sample_path=None):
 
     try:
         target_name = problem['inputs'][0]['targets'][0]['column_name']
-        for res_id in dataset:
-            if ('https://metadata.datadrivendiscovery.org/types/DatasetEntryPoint'
-                    in dataset.metadata.query([res_id])['semantic_types']):
-                break
-        else:
-            res_id = next(iter(dataset))
-
-        if any(tk in [TaskKeyword.VIDEO, TaskKeyword.IMAGE, TaskKeyword.AUDIO] for tk in task_keywords):
-            sample_size = 500
+        res_id = get_entry_point(dataset)
         original_size = len(dataset[res_id])
 
         if hasattr(dataset[res_id], 'columns') and len(dataset[res_id]) > sample_size:
@@ -1,8 +1,21 @@
 """Convert to/from the JSON representation.
 """
 
+import collections
+import copy
+import functools
 import importlib
-import pickle
+from sqlalchemy import event
+from d3m_ta2_nyu.primitive_loader import get_primitive_metadata
+from d3m_ta2_nyu.workflow import database
+from d3m_ta2_nyu.workflow.database import decode_value
+
+
+# Number of pipeline documents kept by to_d3m_json()
+MAX_CACHED_PIPELINES = 1000
+
+# pipeline id -> JSON document, least recently used first
+_pipeline_documents = collections.OrderedDict()
 
 
 def get_class(name):
@@ -10,6 +23,24 @@ def get_class(name):
     return getattr(importlib.import_module(package), classname)
 
 
+@functools.lru_cache(maxsize=512)
+def _get_primitive_description(name):
+    """Get the description of a primitive and its produce methods, for the steps.
+    """
+    metadata = get_primitive_metadata(name)
+    primitive_desc = {
+        key: value
+        for key, value in metadata.items()
+        if key in {'id', 'version', 'python_path', 'name', 'digest'} and value is not None
+    }
+
+    outputs = [{'id': k} for k in metadata['produce_methods']]
+    if name.endswith('.Fastlvm'):  # FIXME: Temporal solution, this module will be removed when DB is removed
+        outputs = [{'id': 'produce'}]
+
+    return primitive_desc, outputs
+
+
 def _add_step(steps, modules, params, module_to_step, mod):
     if mod.id in module_to_step:
         return module_to_step[mod.id]
@@ -43,17 +74,9 @@ def _add_step(steps, modules, params, module_to_step, mod):
             else:
                 inputs[conn.to_input_name] = '%s.%s' % (step, conn.from_output_name)
 
-    klass = get_class(mod.name)
-    primitive_desc = {
-        key: value
-        for key, value in klass.metadata.query().items()
-        if key in {'id', 'version', 'python_path', 'name', 'digest'}
-    }
-
-    outputs = [{'id': k} for k, v in klass.metadata.query()['primitive_code']['instance_methods'].items()
-               if v['kind'] == 'PRODUCE']
-    if mod.name.endswith('.Fastlvm'):  # FIXME: Temporal solution, this module will be removed when DB is removed
-        outputs = [{'id': 'produce'}]
+    primitive_desc, outputs = _get_primitive_description(mod.name)
+    primitive_desc = dict(primitive_desc)
+    outputs = [dict(output) for output in outputs]
 
     # Create step description
     if len(inputs) > 0:
@@ -77,7 +100,7 @@ def _add_step(steps, modules, params, module_to_step, mod):
 
     # If hyperparameters are set, export them
     if mod.id in params and 'hyperparams' in params[mod.id]:
-        hyperparams = pickle.loads(params[mod.id]['hyperparams'])
+        hyperparams = decode_value(params[mod.id]['hyperparams'])
         # We check whether the hyperparameters have a value or the complete description
         hyperparams = {
             k: {'type': v['type'] if isinstance(v,dict) and 'type' in v else 'VALUE',
@@ -95,7 +118,62 @@ def _add_step(steps, modules, params, module_to_step, mod):
 
 def to_d3m_json(pipeline):
     """Converts a Pipeline to the JSON schema from metalearning working group.
+
+    The documents are cached per pipeline, until the pipeline is changed.
+    """
+    document = _pipeline_documents.get(pipeline.id)
+    if document is None:
+        document = _to_d3m_json(pipeline)
+        if pipeline.id is not None:
+            _pipeline_documents[pipeline.id] = document
+            while len(_pipeline_documents) > MAX_CACHED_PIPELINES:
+                _pipeline_documents.popitem(last=False)
+    else:
+        _pipeline_documents.move_to_end(pipeline.id)
+    return copy.deepcopy(document)
+
+
+def get_cached_d3m_json(pipeline_id):
+    """Get the document of a pipeline if it was converted already, else None.
     """
+    document = _pipeline_documents.get(pipeline_id)
+    if document is None:
+        return None
+    return copy.deepcopy(document)
+
+
+def _invalidate_pipeline(pipeline_id):
+    _pipeline_documents.pop(pipeline_id, None)
+
+
+def _pipeline_changed(target, *args):
+    _invalidate_pipeline(target.id)
+
+
+def _pipeline_part_changed(target, *args):
+    if target.pipeline is not None:
+        _invalidate_pipeline(target.pipeline.id)
+    elif target.pipeline_id is not None:
+        _invalidate_pipeline(target.pipeline_id)
+
+
+def _pipeline_part_added(target, value, oldvalue, initiator):
+    # The relationships don't have backrefs, parts can be added from either side
+    if value is not None:
+        _invalidate_pipeline(value.id)
+
+
+for _attribute in (database.Pipeline.modules, database.Pipeline.connections, database.Pipeline.parameters):
+    event.listen(_attribute, 'append', _pipeline_changed)
+    event.listen(_attribute, 'remove', _pipeline_changed)
+for _attribute in (database.PipelineModule.pipeline, database.PipelineConnection.pipeline,
+                   database.PipelineParameter.pipeline):
+    event.listen(_attribute, 'set', _pipeline_part_added)
+event.listen(database.Pipeline.origin, 'set', _pipeline_changed)
+event.listen(database.PipelineParameter.value, 'set', _pipeline_part_changed)
+
+
+def _to_d3m_json(pipeline):
     steps = []
     modules = {mod.id: mod for mod in pipeline.modules}
     params = {}
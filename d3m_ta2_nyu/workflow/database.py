@@ -3,11 +3,17 @@
 
 import enum
 import functools
+import hashlib
+import json
 import logging
-from sqlalchemy import Column, ForeignKey, create_engine, func, not_, select, \
-    inspect
+import os
+import pickle
+import numpy as np
+from sqlalchemy import Column, ForeignKey, Index, create_engine, event, \
+    func, not_, select, inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import column_property, relationship, sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql import functions
 from sqlalchemy.types import Binary, Boolean, DateTime, Enum, Float, Integer, \
     String
@@ -86,7 +92,64 @@ class PipelineParameter(Base):
                        primary_key=True)
     module = relationship('PipelineModule')
     name = Column(String, primary_key=True)
+    # Canonical JSON, written with encode_value() (older databases have pickles)
     value = Column(String, nullable=True)
+    # Hash of the JSON value, set automatically
+    value_hash = Column(String, nullable=True)
+
+    __table_args__ = (
+        Index('ix_pipeline_parameters_value', 'name', 'value_hash'),
+    )
+
+
+def encode_value(value):
+    """Encode the value of a `PipelineParameter`, as canonical JSON.
+
+    Values that can't be represented in JSON are pickled.
+    """
+    try:
+        return json.dumps(value, sort_keys=True, separators=(',', ':'), default=_json_default)
+    except TypeError:
+        logger.warning("Parameter value can't be stored as JSON, pickling it: %r", value)
+        return pickle.dumps(value)
+
+
+def _json_default(obj):
+    # NumPy scalars, from SMAC configurations for example
+    if isinstance(obj, np.generic):
+        return obj.item()
+    # Sets, like the targets, are stored as sorted lists so their encoding is canonical
+    elif isinstance(obj, (set, frozenset)):
+        try:
+            return sorted(obj)
+        except TypeError:
+            return sorted(obj, key=repr)
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+
+def decode_value(data):
+    """Decode the value of a `PipelineParameter`.
+    """
+    if data is None:
+        return None
+    if isinstance(data, bytes):
+        return pickle.loads(data)
+    return json.loads(data)
+
+
+def hash_value(data):
+    """Get the hash of an encoded value, None for pickles.
+    """
+    if not isinstance(data, str):
+        return None
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def _set_value_hash(target, value, oldvalue, initiator):
+    target.value_hash = hash_value(value)
+
+
+event.listen(PipelineParameter.value, 'set', _set_value_hash)
 
 
 class CrossValidation(UuidMixin, Base):
@@ -96,6 +159,8 @@ class CrossValidation(UuidMixin, Base):
     pipeline = relationship('Pipeline')
     date = Column(DateTime, nullable=False,
                   server_default=functions.now())
+    # Number of rows of the data the pipeline was scored on
+    fidelity = Column(Integer, nullable=True)
     scores = relationship('CrossValidationScore', lazy='joined')
 
 
@@ -110,6 +175,53 @@ class CrossValidationScore(Base):
     value = Column(Float, nullable=False)
 
 
+class PipelineScore(Base):
+    """Mean score of a pipeline for a metric, kept up to date on flush.
+
+    Pipelines are ranked on the highest fidelity they were scored at, so this
+    is the mean over the cross-validations at that fidelity.
+    """
+    __tablename__ = 'pipeline_scores'
+    __table_args__ = (
+        Index('ix_pipeline_scores_ranking', 'metric', 'fidelity', 'mean'),
+    )
+
+    pipeline_id = Column(UUID, ForeignKey('pipelines.id'), primary_key=True)
+    metric = Column(String, primary_key=True)
+    fidelity = Column(Integer, nullable=False)
+    total = Column(Float, nullable=False)
+    fold_count = Column(Integer, nullable=False)
+    mean = Column(Float, nullable=False)
+    latest_cv_id = Column(UUID, ForeignKey('cross_validations.id'),
+                          nullable=False)
+
+
+class Evaluation(Base):
+    """Scores of a pipeline, reused by later searches on the same data.
+    """
+    __tablename__ = 'evaluations'
+
+    key = Column(String, primary_key=True)
+    date = Column(DateTime, nullable=False,
+                  server_default=functions.now())
+    fidelity = Column(Integer, nullable=True)
+    scores = Column(String, nullable=False)
+
+
+class TuningTrial(UuidMixin, Base):
+    """Hyperparameters of a primitive tried while tuning, and their cost.
+    """
+    __tablename__ = 'tuning_trials'
+
+    date = Column(DateTime, nullable=False,
+                  server_default=functions.now())
+    primitive = Column(String, nullable=False)
+    dataset = Column(String, nullable=False)
+    task = Column(String, nullable=False)
+    hyperparams = Column(String, nullable=False)
+    cost = Column(Float, nullable=False)
+
+
 class RunType(enum.Enum):
     TRAIN = 1
     TEST = 2
@@ -164,20 +276,164 @@ Pipeline.trained = column_property(
 )
 
 
-def connect(filename):
+# Seconds a connection waits for another one to release its lock
+BUSY_TIMEOUT = 60
+# Stored as the database's user_version, increase when tables, columns or indexes are added
+SCHEMA_VERSION = 1
+
+# (process ID, filename) -> (engine, sessionmaker)
+_engines = {}
+
+
+def connect(filename, migrate=False):
     """Connect to the database using an environment variable.
+
+    The engine is created once per process and file, the following calls
+    reuse it. Processes forked from this one create their own, instead of
+    sharing the pooled connections.
+
+    :param migrate: Create the tables, or update them if the database was
+        created by an older version. This is done once by the main process,
+        before it starts the job processes.
     """
+    key = os.getpid(), filename
+    if key in _engines:
+        if migrate:
+            _migrate(*_engines[key])
+        return _engines[key]
+
     logger.info("Connecting to SQL database")
     url = 'sqlite:///{0}'.format(filename)
-    engine = create_engine(url, echo=False)
+    # Threads of the main process share a pool of connections
+    engine = create_engine(url, echo=False, poolclass=QueuePool,
+                           connect_args={'timeout': BUSY_TIMEOUT, 'check_same_thread': False})
+    event.listen(engine, 'connect', _set_sqlite_pragmas)
+
+    DBSession = sessionmaker(bind=engine,
+                             autocommit=False,
+                             autoflush=False)
+    event.listen(DBSession, 'before_flush', _update_pipeline_scores)
+    if migrate:
+        _migrate(engine, DBSession)
 
-    if not engine.dialect.has_table(engine.connect(), 'pipelines'):
-        logger.warning("The tables don't seem to exist; creating")
-        Base.metadata.create_all(bind=engine)
+    _engines[key] = engine, DBSession
+    return _engines[key]
 
-    return engine, sessionmaker(bind=engine,
-                                autocommit=False,
-                                autoflush=False)
+
+def _migrate(engine, DBSession):
+    """Create the tables, or bring a database created by an older version up to date.
+    """
+    version = engine.execute('PRAGMA user_version').scalar()
+    if version >= SCHEMA_VERSION:
+        return
+    logger.warning("Creating or updating the tables (schema version %d -> %d)", version, SCHEMA_VERSION)
+    # Also creates the tables added since the database was created
+    Base.metadata.create_all(bind=engine)
+    _add_missing_columns(engine)
+    _fill_pipeline_scores(DBSession)
+    engine.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+
+def _update_pipeline_scores(session, flush_context, instances):
+    """Update the `PipelineScore` rows with the cross-validations being added.
+    """
+    rows = {}
+    for crossval in session.new:
+        if isinstance(crossval, CrossValidation):
+            _add_crossval_scores(session, rows, crossval)
+
+
+def _add_crossval_scores(session, rows, crossval):
+    """Add the scores of a cross-validation to the `PipelineScore` rows.
+
+    :param rows: Rows already loaded for this flush, by pipeline ID and
+        metric.
+    """
+    fidelity = crossval.fidelity or 0
+    metrics = {}
+    for score in crossval.scores:
+        total, count = metrics.get(score.metric, (0.0, 0))
+        metrics[score.metric] = total + score.value, count + 1
+    if not metrics:
+        return
+
+    pipeline_id = crossval.pipeline_id
+    if pipeline_id not in rows:
+        with session.no_autoflush:
+            rows[pipeline_id] = {
+                row.metric: row
+                for row in session.query(PipelineScore)
+                .filter(PipelineScore.pipeline_id == pipeline_id)
+            }
+    pipeline_rows = rows[pipeline_id]
+    current_fidelity = max([row.fidelity for row in pipeline_rows.values()] + [-1])
+    if fidelity < current_fidelity:
+        return
+    elif fidelity > current_fidelity:
+        # Scores at lower fidelities don't count anymore
+        for metric, row in list(pipeline_rows.items()):
+            if metric in metrics:
+                row.fidelity, row.total, row.fold_count = fidelity, 0.0, 0
+            else:
+                if row in session.new:
+                    session.expunge(row)
+                else:
+                    session.delete(row)
+                del pipeline_rows[metric]
+
+    for metric, (total, count) in metrics.items():
+        row = pipeline_rows.get(metric)
+        if row is None:
+            row = pipeline_rows[metric] = PipelineScore(pipeline_id=pipeline_id, metric=metric, fidelity=fidelity,
+                                                        total=0.0, fold_count=0)
+            session.add(row)
+        row.total += total
+        row.fold_count += count
+        row.mean = row.total / row.fold_count
+        row.latest_cv_id = crossval.id
+
+
+def _fill_pipeline_scores(DBSession):
+    """Compute the `PipelineScore` rows of a database created before that table.
+    """
+    db = DBSession()
+    try:
+        if db.query(PipelineScore).first() is not None or db.query(CrossValidation).first() is None:
+            return
+        logger.warning("Computing the pipeline scores table")
+        rows = {}
+        for crossval in db.query(CrossValidation).order_by(CrossValidation.date).all():
+            _add_crossval_scores(db, rows, crossval)
+        db.commit()
+    finally:
+        db.close()
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # With the write-ahead log, readers don't block the writer and the writer doesn't block readers
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA busy_timeout=%d' % (BUSY_TIMEOUT * 1000))
+    cursor.close()
+
+
+def _add_missing_columns(engine):
+    """Add the nullable columns and the indexes added since the database was created.
+    """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                logger.warning("Adding column %s.%s", table.name, column.name)
+                engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name, column.type.compile(engine.dialect)))
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                logger.warning("Adding index %s", index.name)
+                index.create(bind=engine)
 
 
 def with_db(wrapped):
@@ -3,13 +3,23 @@
 Those are supposed to be run without data or primitives available.
 """
 
+import multiprocessing
+import numpy
+import os
+import pandas
+import pickle
 import shutil
 import tempfile
+import time
 import unittest
 from unittest import mock
+from d3m_ta2_nyu import evaluation_cache, fitted_solution, pipeline_tune
+from d3m_ta2_nyu.multiprocessing import PoolProcess, Receiver, WorkerPool
 from d3m_ta2_nyu.ta2 import D3mTa2, Session, TuneHyperparamsJob
+from d3m_ta2_nyu.parameter_tuning.pruning import MedianPruner
+from d3m_ta2_nyu.parameter_tuning.tuning_trials import get_initial_configurations, store_trials
 from d3m_ta2_nyu.workflow import database
-from d3m.metadata.problem import PerformanceMetric
+from d3m.metadata.problem import PerformanceMetric, TaskKeyword
 
 
 class FakePrimitiveBuilder(object):
@@ -38,6 +48,47 @@ class FakePrimitiveBuilder(object):
 FakePrimitive = FakePrimitiveBuilder('FakePrimitive')
 
 
+# F1 of each fold, for the configurations evaluated by FakeTuning
+FOLD_SCORES = {0: [0.8, 0.8], 1: [0.8, 0.8], 2: [0.8, 0.8], 3: [0.8, 0.8], 4: [0.8, 0.8], 5: [0.1, 0.9]}
+
+
+class FakeTuning(object):
+    def __init__(self, primitives):
+        self.configspace = mock.Mock()
+        self.configspace.get_default_configuration.return_value.get_dictionary.return_value = {}
+        self.trials = []
+
+    def tune(self, runner, wallclock, output_dir, n_jobs=1, initial_configurations=None):
+        os.makedirs(output_dir)
+        for x in sorted(FOLD_SCORES):
+            # Like SMAC, evaluate each configuration in a child process
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=lambda: queue.put(runner({'x': x})))
+            process.start()
+            process.join()
+            self.trials.append(({'x': x}, queue.get(timeout=60)))
+        return {'x': 0}
+
+
+def fake_evaluate(pipeline, *args, fold_callback=None):
+    x = database.decode_value(pipeline.parameters[-1].value)['x']
+    scores = {}
+    for fold, value in enumerate(FOLD_SCORES[x]):
+        scores[fold] = {'F1_MACRO': value}
+        if fold_callback is not None and \
+                not fold_callback(fold, pandas.DataFrame([{'metric': 'F1_MACRO', 'value': value}])):
+            break
+    return scores
+
+
+def pool_job(msg_queue, value):
+    """Job run by the WorkerPool tests, in the workers.
+    """
+    if value == 'crash':
+        os._exit(3)
+    msg_queue.send((value, os.getpid()))
+
+
 class TestSession(unittest.TestCase):
     maxDiff = None
 
@@ -246,6 +297,300 @@ class TestSession(unittest.TestCase):
                            [(self._pipelines[0], 42.0),
                             (self._pipelines[1], 17.0)])
 
+    def test_fidelity(self):
+        db = self._ta2.DBSession()
+        session = Session(
+            mock.NonCallableMock(),
+            self._problem,
+            self._ta2.output_folder,
+            self._ta2.DBSession
+            )
+        session.add_scoring_pipeline(self._pipelines[0])
+        session.add_scoring_pipeline(self._pipelines[1])
+
+        # Pipelines are ranked on the scores at their highest fidelity
+        for pipeline, fidelity, value in [(0, 500, 0.9), (1, 500, 0.5), (1, 2000, 0.7)]:
+            db.add(database.CrossValidation(
+                pipeline_id=self._pipelines[pipeline],
+                fidelity=fidelity,
+                scores=[
+                    database.CrossValidationScore(fold=0,
+                                                  metric='F1_MACRO',
+                                                  value=value),
+                ],
+            ))
+        db.commit()
+        with mock.patch.dict(os.environ, {'TA2_SUCCESSIVE_HALVING': '1'}):
+            self.assertEqual(
+                [
+                    (pipeline.id, score)
+                    for (pipeline, score)
+                    in session.get_top_pipelines(db, PerformanceMetric.F1_MACRO)
+                ],
+                [(self._pipelines[1], 0.7),
+                 (self._pipelines[0], 0.9)],
+            )
+        # Without successive halving, only the scores count
+        with mock.patch.dict(os.environ):
+            os.environ.pop('TA2_SUCCESSIVE_HALVING', None)
+            self.assertEqual(
+                [
+                    (pipeline.id, score)
+                    for (pipeline, score)
+                    in session.get_top_pipelines(db, PerformanceMetric.F1_MACRO)
+                ],
+                [(self._pipelines[0], 0.9),
+                 (self._pipelines[1], 0.7)],
+            )
+
+        # Only the top third of a rung is promoted, pipelines scored early can
+        # be promoted when the rung gets more scores
+        session.fidelities = [(500, 'sample'), (None, None)]
+        self.assertEqual(
+            [session.promote(0, 'p%d' % i, score) for i, score in enumerate([0.9, 0.4, 0.6, 0.3, 0.2, 0.5, 0.8])],
+            [[], [], ['p0'], [], [], ['p2'], ['p6']],
+        )
+        self.assertEqual(session.promote(1, 'p0', 0.9), [])
+        db.close()
+
+    def test_tuning_trials(self):
+        db = self._ta2.DBSession()
+        default = {'A|x': 1, 'A|y': 'a', 'B|z': 0.5}
+        self.assertEqual(
+            get_initial_configurations(db, {'A', 'B'}, default, 'dataset', 'CLASSIFICATION'),
+            [default],
+        )
+
+        store_trials(db, {'A', 'B'}, [({'A|x': 2, 'A|y': 'b', 'B|z': 0.1}, 0.3),
+                                      ({'A|x': 3, 'A|y': 'a', 'B|z': 0.2}, 0.1),
+                                      ({'A|x': 4, 'A|y': 'a', 'B|z': 0.2}, float('inf'))],
+                     'dataset', 'CLASSIFICATION')
+        store_trials(db, {'A'}, [({'A|x': 5, 'A|y': 'c'}, 0.0)], 'other', 'CLASSIFICATION')
+        store_trials(db, {'A'}, [({'A|x': 6, 'A|y': 'c'}, 0.0)], 'dataset', 'REGRESSION')
+        db.commit()
+
+        # The best trials come first, the ones on the same dataset before the others
+        self.assertEqual(
+            get_initial_configurations(db, {'A', 'B'}, default, 'dataset', 'CLASSIFICATION'),
+            [default,
+             {'A|x': 3, 'A|y': 'a', 'B|z': 0.2},
+             {'A|x': 2, 'A|y': 'b', 'B|z': 0.1},
+             {'A|x': 5, 'A|y': 'c', 'B|z': 0.5}],
+        )
+        db.close()
+
+    def test_median_pruner(self):
+        pruner = MedianPruner(startup_trials=2)
+        for costs in [[0.2, 0.4], [0.3, 0.3]]:
+            pruner.start()
+            self.assertEqual([pruner.report(cost) for cost in costs], [True, True])
+            pruner.finish()
+
+        # Worse than the median after the first fold
+        pruner.start()
+        self.assertFalse(pruner.report(0.9))
+        self.assertEqual(pruner.get_pruned_cost(), 0.9)
+
+        # Worse than the median after the second fold, pessimistic cost
+        pruner.start()
+        self.assertTrue(pruner.report(0.2))
+        self.assertFalse(pruner.report(0.6))
+        self.assertAlmostEqual(pruner.get_pruned_cost(), 0.4)
+
+    def test_parameter_values(self):
+        value = {
+            'targets': {('learningData', 'class'), ('learningData', 'age')},
+            'columns': (1, 2),
+            'mapping': {0: 'a', 1: 'b'},
+        }
+        data = database.encode_value(value)
+        # Stored as JSON, not pickled
+        self.assertIsInstance(data, str)
+        self.assertEqual(
+            database.decode_value(data),
+            {
+                'targets': [['learningData', 'age'], ['learningData', 'class']],
+                'columns': [1, 2],
+                'mapping': {'0': 'a', '1': 'b'},
+            },
+        )
+        # The encoding doesn't depend on the order of the set
+        self.assertEqual(
+            database.encode_value({'x': {3, 1, 2}}),
+            database.encode_value({'x': frozenset([2, 3, 1])}),
+        )
+        self.assertIsNotNone(database.hash_value(data))
+
+    @mock.patch.object(evaluation_cache, 'get_dataset_version', return_value='version1')
+    def test_evaluation_key(self, get_dataset_version):
+        def make_pipeline(pipeline_id, value):
+            return {
+                'id': pipeline_id,
+                'created': '2021-01-01T00:00:00Z',
+                'steps': [{
+                    'type': 'PRIMITIVE',
+                    'primitive': {'id': 'tests.FakePrimitive-mocked', 'python_path': 'mock'},
+                    'arguments': {'inputs': {'type': 'CONTAINER', 'data': 'inputs.0'}},
+                    'outputs': [{'id': 'produce'}],
+                    'hyperparams': {'x': {'type': 'VALUE', 'data': value}},
+                }],
+                'outputs': [{'data': 'steps.0.produce'}],
+            }
+
+        problem = {'problem': {'task_keywords': [TaskKeyword.CLASSIFICATION]}, 'inputs': []}
+        metrics = [{'metric': PerformanceMetric.F1_MACRO}]
+        scoring_config = {'method': 'K_FOLD', 'folds': '2'}
+
+        def get_key(pipeline=make_pipeline('p1', 1), sample_size=None, metrics=metrics,
+                    scoring_config=scoring_config):
+            return evaluation_cache.get_evaluation_key(pipeline, 'file:///data/test.csv', sample_size, problem,
+                                                       metrics, scoring_config, False)
+
+        key = get_key()
+        self.assertIsNotNone(key)
+
+        # Equivalent pipelines (different ID and creation time, same steps) share their key
+        other = make_pipeline('p2', 1)
+        other['created'] = '2021-02-01T00:00:00Z'
+        self.assertEqual(evaluation_cache.get_pipeline_signature(other),
+                         evaluation_cache.get_pipeline_signature(make_pipeline('p1', 1)))
+        self.assertEqual(get_key(pipeline=other), key)
+
+        # Anything that changes the scores changes the key
+        self.assertNotEqual(evaluation_cache.get_pipeline_signature(make_pipeline('p1', 2)),
+                            evaluation_cache.get_pipeline_signature(make_pipeline('p1', 1)))
+        self.assertNotEqual(get_key(pipeline=make_pipeline('p1', 2)), key)
+        self.assertNotEqual(get_key(sample_size=1000), key)
+        self.assertNotEqual(get_key(metrics=[{'metric': PerformanceMetric.ACCURACY}]), key)
+        self.assertNotEqual(get_key(scoring_config={'method': 'K_FOLD', 'folds': '5'}), key)
+        get_dataset_version.return_value = 'version2'
+        self.assertNotEqual(get_key(), key)
+
+        # Datasets without a version aren't cached
+        get_dataset_version.return_value = None
+        self.assertIsNone(get_key())
+        get_dataset_version.return_value = 'version1'
+        with mock.patch.dict(os.environ, {'TA2_NO_EVALUATION_CACHE': '1'}):
+            self.assertIsNone(get_key())
+
+    def test_fitted_solution(self):
+        storage_dir = os.path.join(self._tmp, 'fitted_solutions')
+        os.mkdir(storage_dir)
+        runtime = {'weights': numpy.arange(300000.0), 'bias': numpy.arange(3), 'name': 'fitted'}
+        fitted_solution.save_fitted_solution(runtime, storage_dir, 'p0')
+
+        # The big array is stored in its own file and mapped in memory
+        folder = os.path.join(storage_dir, 'fitted_solution_p0')
+        self.assertEqual(sorted(os.listdir(folder)), ['array_0.npy', 'manifest.json', 'runtime.pkl'])
+        loaded = fitted_solution.load_fitted_solution(storage_dir, 'p0', verify_arrays=True)
+        self.assertIsInstance(loaded['weights'], numpy.memmap)
+        numpy.testing.assert_array_equal(loaded['weights'], runtime['weights'])
+        numpy.testing.assert_array_equal(loaded['bias'], runtime['bias'])
+        self.assertEqual(loaded['name'], 'fitted')
+
+        # Exported as a single pickle, which is up to date afterwards
+        path = fitted_solution.export_fitted_solution(storage_dir, 'p0')
+        self.assertEqual(path, os.path.join(storage_dir, 'fitted_solution_p0.pkl'))
+        self.assertEqual(fitted_solution.get_exported_fitted_solution(storage_dir, 'p0'), (path, True))
+        with open(path, 'rb') as fin:
+            exported = pickle.load(fin)
+        self.assertNotIsInstance(exported['weights'], numpy.memmap)
+        numpy.testing.assert_array_equal(exported['weights'], runtime['weights'])
+        self.assertEqual(exported['name'], 'fitted')
+
+        # A modified pickle is rejected
+        with open(os.path.join(folder, 'runtime.pkl'), 'ab') as fout:
+            fout.write(b'\0')
+        with self.assertRaises(ValueError):
+            fitted_solution.load_fitted_solution(storage_dir, 'p0')
+
+        # Fitted pipelines stored as a single pickle by older versions still load
+        with open(os.path.join(storage_dir, 'fitted_solution_p1.pkl'), 'wb') as fout:
+            pickle.dump({'name': 'legacy'}, fout)
+        self.assertEqual(fitted_solution.load_fitted_solution(storage_dir, 'p1'), {'name': 'legacy'})
+        self.assertEqual(fitted_solution.get_exported_fitted_solution(storage_dir, 'p1'),
+                         (os.path.join(storage_dir, 'fitted_solution_p1.pkl'), True))
+        self.assertIsNone(fitted_solution.get_exported_fitted_solution(storage_dir, 'p2'))
+
+    def test_worker_pool(self):
+        pool = WorkerPool(1, max_jobs=2)
+
+        def run_job(value):
+            msg_queue = Receiver()
+            try:
+                proc = pool.run('tests.pool_job', 'job', msg_queue, value=value)
+                returncode = proc.wait(60)
+                result = None if returncode else msg_queue.recv(10)
+            finally:
+                msg_queue.close()
+            return proc, returncode, result
+
+        def wait_idle():
+            start = time.time()
+            while not pool._idle:
+                self.assertLess(time.time() - start, 60, "Worker didn't start")
+                time.sleep(0.2)
+            return pool._idle[0].proc
+
+        # Workers import the job function from this file
+        env = {'PYTHONPATH': os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)),
+                                                          os.environ.get('PYTHONPATH')]))}
+        with mock.patch.dict(os.environ, env):
+            # The worker is still starting, the first job runs in a plain process
+            proc, returncode, result = run_job(0)
+            self.assertNotIsInstance(proc, PoolProcess)
+            self.assertEqual((returncode, result), (0, (0, proc.pid)))
+
+            # Then jobs run in the worker, which is replaced after max_jobs
+            worker = wait_idle()
+            for value in (1, 2):
+                proc, returncode, result = run_job(value)
+                self.assertIsInstance(proc, PoolProcess)
+                self.assertEqual((returncode, result), (0, (value, worker.pid)))
+            self.assertEqual(worker.returncode, 0)
+            self.assertNotIn(worker, [w.proc for w in pool._idle])
+
+            # A worker that dies during a job is reported and replaced
+            worker = wait_idle()
+            self.assertIsNone(worker.poll())
+            proc, returncode, _ = run_job('crash')
+            self.assertIsInstance(proc, PoolProcess)
+            self.assertEqual(returncode, 3)
+            self.assertIn(b'Worker process died', proc.communicate()[1])
+            self.assertEqual(worker.returncode, 3)
+
+            worker = wait_idle()
+            proc, returncode, result = run_job(4)
+            self.assertEqual((returncode, result), (0, (4, worker.pid)))
+
+        with pool._lock:
+            for idle in pool._idle:
+                idle.conn.close()
+                idle.proc.wait(10)
+
+    @mock.patch.object(pipeline_tune, 'score')
+    @mock.patch.object(pipeline_tune, 'store_trials')
+    @mock.patch.object(pipeline_tune, 'get_initial_configurations', return_value=[])
+    @mock.patch.object(pipeline_tune, 'get_new_hyperparameters', side_effect=lambda name, config: {'x': config['x']})
+    @mock.patch.object(pipeline_tune, 'evaluate', side_effect=fake_evaluate)
+    @mock.patch.object(pipeline_tune, 'HyperparameterTuning', FakeTuning)
+    @mock.patch.object(pipeline_tune, 'is_tunable', return_value=True)
+    @mock.patch.object(pipeline_tune, 'load_dataset')
+    def test_tuning_pruning(self, load_dataset, is_tunable, evaluate, get_new_hyperparameters,
+                            get_initial_configurations, store_trials, score):
+        problem = {'problem': {'task_keywords': [TaskKeyword.CLASSIFICATION]}, 'inputs': []}
+        with mock.patch.dict(os.environ, {'D3MOUTPUTDIR': self._tmp, 'TA2_TUNING_PRUNING': '1'}):
+            pipeline_tune.tune(self._pipelines[0], [{'metric': PerformanceMetric.F1_MACRO}], problem,
+                               'file:///data/test.csv', None, False, 60, 10, mock.NonCallableMock(),
+                               db_filename=self._ta2.db_filename)
+
+        # The last configuration is stopped after its first fold, even though the evaluations ran in child processes
+        trials = store_trials.call_args[0][2]
+        self.assertEqual([values for values, _ in trials], [{'x': x} for x in range(6)])
+        for _, cost in trials[:5]:
+            self.assertAlmostEqual(cost, 0.2)
+        self.assertAlmostEqual(trials[5][1], 0.9)
+
 
 if __name__ == '__main__':
     unittest.main()